@@ -13,4 +13,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "llm_reports.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from llm_reports.lifespan import lifespan  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(scope, receive, send)
+        return
+    await django_application(scope, receive, send)
@@ -0,0 +1,36 @@
+"""
+Django 的 ASGI handler 不处理 lifespan 事件，这里执行 settings.LIFESPAN_STARTUP/LIFESPAN_SHUTDOWN
+"""
+import logging
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+async def run_hooks(paths: list) -> None:
+    for path in paths:
+        await import_string(path)()
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await run_hooks(settings.LIFESPAN_STARTUP)
+            except Exception as e:
+                logger.exception("Lifespan startup failed")
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            try:
+                await run_hooks(settings.LIFESPAN_SHUTDOWN)
+            except Exception as e:
+                logger.exception("Lifespan shutdown failed")
+                await send({"type": "lifespan.shutdown.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.shutdown.complete"})
+            return
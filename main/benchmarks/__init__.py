@@ -0,0 +1,58 @@
+import sys
+import json
+import time
+import tracemalloc
+from pathlib import Path
+from datetime import datetime
+from typing import Callable
+
+
+def measure(fn: Callable[[], object], rows: int, repeat: int = 5) -> dict:
+    """取 repeat 次中最快的一次，换算成吞吐和每万行耗时；再单独运行一次统计内存峰值"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    # tracemalloc 会明显拖慢运行，不和计时放在一起
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "rows": rows,
+        "seconds": round(best, 6),
+        "rows_per_second": round(rows / best) if best else 0,
+        "ms_per_10k": round(best / rows * 10000 * 1000, 3) if rows else 0,
+        "peak_memory_bytes": peak,
+    }
+
+
+def save(results: dict, directory: Path, name: str) -> Path:
+    """保存为 <directory>/<name>-<时间>.json，附带运行环境，便于之后对比"""
+    directory.mkdir(parents=True, exist_ok=True)
+    created = datetime.now()
+    path = directory / f"{name}-{created.strftime('%Y%m%d-%H%M%S')}.json"
+    path.write_text(json.dumps({
+        "created": created.isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        **results,
+    }, indent=2, ensure_ascii=False))
+    return path
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.2) -> list:
+    """
+    对比两次结果中相同的用例，返回 [(case, baseline 秒数, 当前秒数, 比值, 是否退化)]
+    当前耗时超过 baseline 的 (1 + threshold) 倍视为退化
+    """
+    rows = []
+    for case, stats in current["results"].items():
+        base = baseline["results"].get(case)
+        if not base or not base["seconds"]:
+            continue
+        ratio = stats["seconds"] / base["seconds"]
+        rows.append((case, base["seconds"], stats["seconds"], ratio, ratio > 1 + threshold))
+    return rows
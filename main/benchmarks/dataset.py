@@ -0,0 +1,113 @@
+"""
+按 Data 集合的结构生成测试数据：custom 和线上一致，evaluation 中有已标注/未标注的文档和各种标注结果
+相同的 seed 生成相同的数据；input2/output2/evaluation 在文档之间共享，1m 条大约占用 1.5GB 内存
+"""
+import random
+from datetime import datetime, timedelta
+from typing import Iterator, List
+
+from main.handlers.stats import CATEGORIES, get_week_end_date, get_week_start_date
+from main.utils.mongo import SUCCESS_MESSAGE_ID
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+ENVS = ("prod", "prod", "prod", "dev")
+CLIENTS = (
+    ("app", "english", "LLMAppEnglishProvider"),
+    ("app", "chinese", "LLMAppChineseProvider"),
+    ("car", "english", "LLMCarEnglishProvider"),
+    ("car", "chinese", "LLMCarChineseProvider"),
+)
+QUERIES = (
+    ("how much energy did i use for charging", "View_history_charging_energy", "用户历史充电电量"),
+    ("open the window", "Open_window", "打开车窗"),
+    ("set temperature to 22 degrees", "Set_temperature", "设置温度"),
+    ("navigate to the nearest charging station", "Navigate_charging_station", "导航到充电站"),
+    ("play some music", "Play_music", "播放音乐"),
+    ("what's the weather tomorrow", "Query_weather", "查询天气"),
+)
+# 未标注文档的比例，已标注文档中各标注结果的权重
+UNLABELED_RATIO = 0.4
+CATEGORY_WEIGHTS = {
+    "SUCCESS": 70,
+    "ERROR_STT": 6,
+    "ERROR_INTENT": 8,
+    "ERROR_TASK_RUNNING": 4,
+    "ERROR_LANGUAGE": 2,
+    "ERROR_TRANSLATE": 3,
+    "ERROR_LLM_ANSWER": 5,
+    "ERROR_UNKNOWN": 2,
+}
+
+
+def message_evaluation(category: str, message_id: str) -> dict:
+    """成功的对话以 SUCCESS_MESSAGE_ID 作为 receive message 的 id"""
+    receive_id = SUCCESS_MESSAGE_ID if category == "SUCCESS" else message_id
+    return {
+        f"{message_id}-send": {"__sys_message_type": "send", "intent": "SUCCESS"},
+        receive_id: {"__sys_message_type": "receive", "intent": category},
+    }
+
+
+def iter_docs(n: int, seed: int = 0, start_date: str = "2025-01-01",
+              days: int = 28) -> Iterator[dict]:
+    rnd = random.Random(seed)
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    day_starts = {(start + timedelta(days=i)).strftime("%Y-%m-%d"): start + timedelta(days=i)
+                  for i in range(days)}
+    dates = list(day_starts)
+    weeks = {date: get_week_start_date(date) for date in dates}
+    week_ends = {week: get_week_end_date(week) for week in weeks.values()}
+    queries = [(
+        text,
+        [{"role": "user", "content": text}],
+        output1,
+        {"intent": intent, "slots": {}, "model_version": "llama0.3.1"},
+    ) for text, output1, intent in QUERIES]
+    categories = list(CATEGORY_WEIGHTS)
+    weights = list(CATEGORY_WEIGHTS.values())
+    evaluations = {
+        category: [message_evaluation(category, f"{category.lower()}-{i}") for i in range(8)]
+        for category in CATEGORIES
+    }
+
+    for _ in range(n):
+        date = rnd.choice(dates)
+        started = day_starts[date] + timedelta(seconds=rnd.uniform(0, 86399))
+        detect_time_cost = round(rnd.lognormvariate(-0.3, 0.5), 6)
+        total_time_cost = round(detect_time_cost + rnd.uniform(0.05, 0.4), 6)
+        client_type, language, provider = rnd.choice(CLIENTS)
+        text, input2, output1, output2 = rnd.choice(queries)
+        if rnd.random() < UNLABELED_RATIO:
+            evaluation = {}
+        else:
+            category = rnd.choices(categories, weights)[0]
+            evaluation = rnd.choice(evaluations[category])
+        yield {
+            "custom": {
+                "input1": text,
+                "input1_text": text,
+                "input2": input2,
+                "output1": output1,
+                "output2": output2,
+                "detect_time_cost": detect_time_cost,
+                "total_time_cost": total_time_cost,
+                "client_type": client_type,
+                "language": language,
+                "provider": provider,
+                "detector": "EndpointVllmClient",
+                "start_time": f"{started.isoformat()}+00:00",
+                "end_time": f"{(started + timedelta(seconds=total_time_cost)).isoformat()}+00:00",
+                "timezone_str": "UTC",
+                "env": rnd.choice(ENVS),
+                "session_text": "",
+                "date": date,
+                "week_start_date": weeks[date],
+                "week_end_date": week_ends[weeks[date]],
+            },
+            "evaluation": {"message_evaluation": evaluation},
+        }
+
+
+def make_docs(n: int, seed: int = 0, **kwargs) -> List[dict]:
+    return list(iter_docs(n, seed, **kwargs))
@@ -0,0 +1,203 @@
+"""
+进程内的 ASGI 压测：不经过网络，直接调用 llm_reports.asgi.application，MongoDB 换成 MemoryDatabase
+clients 个并发客户端按 mix 的权重随机请求各个接口，统计每个接口的延迟分位数、吞吐和错误率
+MemoryDatabase 在 Python 中执行查询和聚合，延迟包含这部分 CPU 开销，结果适合在不同提交之间对比，
+不代表线上的绝对延迟
+"""
+import math
+import time
+import random
+import asyncio
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from urllib.parse import urlencode
+
+from django.test import override_settings
+
+from main.benchmarks import dataset
+from main.handlers.stats import stats_cache
+from main.benchmarks.memory_mongo import MemoryDatabase
+from main.utils.mongo import mongo_client
+
+ENDPOINTS = {
+    "daily_accuracy": "/api/stats/daily_accuracy",
+    "weekly_accuracy": "/api/stats/weekly_accuracy",
+    "range_accuracy": "/api/stats/range_accuracy",
+    "range_daily_accuracy": "/api/stats/range_daily_accuracy",
+    "list_errors": "/api/stats/list_errors",
+}
+# 仪表盘打开时大部分是按天/范围的统计，偶尔翻看错误列表
+DEFAULT_MIX = {
+    "daily_accuracy": 3,
+    "weekly_accuracy": 1,
+    "range_accuracy": 2,
+    "range_daily_accuracy": 2,
+    "list_errors": 2,
+}
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    """"daily_accuracy=3,list_errors=1" -> {"daily_accuracy": 3, "list_errors": 1}"""
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"unknown endpoint {name}, must be one of {', '.join(ENDPOINTS)}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def make_params(endpoint: str, rnd: random.Random, dates: List[str]) -> dict:
+    """dates 为数据覆盖的日期，升序"""
+    env = rnd.choice(["", *sorted(set(dataset.ENVS))])
+    if endpoint == "daily_accuracy":
+        return {"env": env, "date": rnd.choice(dates)}
+    if endpoint == "weekly_accuracy":
+        return {"env": env}
+    if endpoint in ("range_accuracy", "range_daily_accuracy"):
+        start = rnd.randrange(len(dates))
+        end = min(len(dates) - 1, start + rnd.choice([0, 6, 13, 29]))
+        return {"env": env, "start_date": dates[start], "end_date": dates[end]}
+    return {"env": env, "date": rnd.choice([*dates, ""]), "limit": rnd.choice([20, 100])}
+
+
+async def asgi_get(app, path: str, params: dict) -> tuple:
+    """发送一个 GET 请求，返回 (status, body)"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": urlencode(params).encode(),
+        "root_path": "",
+        "headers": [(b"host", b"loadtest")],
+        "client": ("127.0.0.1", 0),
+        "server": ("loadtest", 80),
+    }
+    finished = asyncio.Event()
+    received = False
+    status, body = 0, []
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # Django 会一直等待断开连接的消息，响应发送完之后再返回
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+            if not message.get("more_body"):
+                finished.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        finished.set()
+    return status, b"".join(body)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """nearest-rank 分位数，values 已排序"""
+    if not values:
+        return 0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(latencies: List[float], errors: int, seconds: float) -> dict:
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "error_rate": round(errors / count, 4) if count else 0,
+        "rps": round(count / seconds, 1) if seconds else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0,
+    }
+
+
+async def run(app,
+              dates: List[str],
+              mix: Optional[Dict[str, int]] = None,
+              clients: int = 50,
+              requests: int = 1000,
+              seed: int = 0) -> dict:
+    """clients 个客户端并发请求，共 requests 个请求，返回 {endpoint: 统计, "total": 统计}"""
+    mix = mix or DEFAULT_MIX
+    names, weights = list(mix), list(mix.values())
+    rnd = random.Random(seed)
+    plan = [(name, make_params(name, rnd, dates))
+            for name in rnd.choices(names, weights, k=requests)]
+    queue = iter(plan)
+    latencies = {name: [] for name in names}
+    errors = dict.fromkeys(names, 0)
+
+    async def client():
+        for name, params in queue:
+            start = time.perf_counter()
+            try:
+                status, _ = await asgi_get(app, ENDPOINTS[name], params)
+            except Exception:
+                status = 500
+            latencies[name].append(time.perf_counter() - start)
+            if status >= 400:
+                errors[name] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(clients)])
+    seconds = time.perf_counter() - start
+
+    report = {name: summarize(latencies[name], errors[name], seconds) for name in names}
+    report["total"] = summarize([v for values in latencies.values() for v in values],
+                                sum(errors.values()), seconds)
+    return report
+
+
+def recent_dates(days: int) -> List[str]:
+    """到今天为止的 days 天，升序；包含当天才能覆盖实时计算的路径"""
+    start = datetime.now() - timedelta(days=days - 1)
+    return [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+
+
+@contextmanager
+def memory_backend(docs: List[dict], cache: bool = True, rollups: bool = False):
+    """
+    把 mongo_client 换成装有 docs 的 MemoryDatabase，并关闭每个请求的耗时日志
+    rollups 为 False 时不读写 DailyStats/WeeklyStats，不需要 MySQL；cache 为 False 时关闭结果缓存
+    """
+    previous_db = mongo_client.__dict__.get("db")
+    maxsize = stats_cache.maxsize
+    # 每个请求一条的耗时日志会淹没结果，也会影响计时
+    request_logger = logging.getLogger("main.middleware.request_timer")
+    level = request_logger.level
+    request_logger.setLevel(logging.WARNING)
+    mongo_client.db = MemoryDatabase({"Data": docs})
+    stats_cache.clear()
+    if not cache:
+        stats_cache.maxsize = 0
+    try:
+        with override_settings(STATS_ROLLUPS=rollups):
+            yield
+    finally:
+        request_logger.setLevel(level)
+        stats_cache.maxsize = maxsize
+        stats_cache.clear()
+        if previous_db is None:
+            del mongo_client.db
+        else:
+            mongo_client.db = previous_db
@@ -0,0 +1,494 @@
+"""
+内存版的 Motor 替身，只用于测试和离线压测（main.benchmarks），不在服务中使用。
+
+只实现了本项目用到的查询/聚合子集，接口与 motor 的 collection/cursor 保持一致（async）。
+"""
+import copy
+import math
+import functools
+from typing import Any, Iterable, List, Optional
+
+import bson
+from bson import ObjectId
+
+_MISSING = object()
+
+
+def get_path(doc: Any, path: str, default: Any = _MISSING) -> Any:
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return default
+    return value
+
+
+def _type_rank(value: Any) -> int:
+    # BSON 比较顺序：null < 数字 < 字符串 < 对象 < 数组 < ObjectId < bool
+    if value is None or value is _MISSING:
+        return 0
+    if isinstance(value, bool):
+        return 6
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, list):
+        return 4
+    if isinstance(value, ObjectId):
+        return 5
+    return 7
+
+
+def compare(a: Any, b: Any) -> int:
+    ra, rb = _type_rank(a), _type_rank(b)
+    if ra != rb:
+        return -1 if ra < rb else 1
+    if ra == 0:
+        return 0
+    if ra == 3:
+        a, b = list(a.items()), list(b.items())
+    if a == b:
+        return 0
+    return -1 if a < b else 1
+
+
+def _comparable(a: Any, b: Any) -> bool:
+    return a is not _MISSING and _type_rank(a) == _type_rank(b)
+
+
+def _match_operator(value: Any, op: str, arg: Any) -> bool:
+    if op == "$eq":
+        return _match_value(value, arg)
+    if op == "$ne":
+        return not _match_value(value, arg)
+    if op == "$gt":
+        return _comparable(value, arg) and compare(value, arg) > 0
+    if op == "$gte":
+        return _comparable(value, arg) and compare(value, arg) >= 0
+    if op == "$lt":
+        return _comparable(value, arg) and compare(value, arg) < 0
+    if op == "$lte":
+        return _comparable(value, arg) and compare(value, arg) <= 0
+    if op == "$in":
+        return any(_match_value(value, item) for item in arg)
+    if op == "$nin":
+        return not any(_match_value(value, item) for item in arg)
+    if op == "$exists":
+        return (value is not _MISSING) == bool(arg)
+    raise NotImplementedError(f"query operator {op} is not supported")
+
+
+def _match_value(value: Any, expected: Any) -> bool:
+    if value is _MISSING:
+        return expected is None
+    if isinstance(value, list) and not isinstance(expected, list):
+        return any(_match_value(item, expected) for item in value)
+    return compare(value, expected) == 0
+
+
+def match(doc: dict, query: Optional[dict]) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            if not all(match(doc, q) for q in condition):
+                return False
+        elif key == "$or":
+            if not any(match(doc, q) for q in condition):
+                return False
+        elif key == "$expr":
+            if not evaluate(doc, condition):
+                return False
+        else:
+            value = get_path(doc, key)
+            if isinstance(condition, dict) and condition and all(
+                    k.startswith("$") for k in condition):
+                if not all(_match_operator(value, op, arg) for op, arg in condition.items()):
+                    return False
+            elif not _match_value(value, condition):
+                return False
+    return True
+
+
+def _set_path(doc: dict, path: str, value: Any) -> None:
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc: dict, path: str) -> None:
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def project(doc: dict, projection: Any) -> dict:
+    if not projection:
+        return doc
+    if not isinstance(projection, dict):
+        projection = {path: 1 for path in projection}
+    include_id = projection.get("_id", 1)
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if fields and all(v for v in fields.values()):
+        result = {}
+        if include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+        for path in fields:
+            value = get_path(doc, path)
+            if value is not _MISSING:
+                _set_path(result, path, copy.deepcopy(value))
+        return result
+    result = copy.deepcopy(doc)
+    for path in fields:
+        _unset_path(result, path)
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def evaluate(doc: dict, expr: Any, variables: Optional[dict] = None) -> Any:
+    """计算聚合表达式，`$$name` 从 variables 中取值"""
+    variables = variables or {}
+    if isinstance(expr, str) and expr.startswith("$$"):
+        name, _, path = expr[2:].partition(".")
+        value = doc if name == "ROOT" else variables.get(name, _MISSING)
+        return get_path(value, path, None) if path else value
+    if isinstance(expr, str) and expr.startswith("$"):
+        return get_path(doc, expr[1:], None)
+    if isinstance(expr, list):
+        return [evaluate(doc, item, variables) for item in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) == 1:
+        op, arg = next(iter(expr.items()))
+        if op.startswith("$"):
+            return _evaluate_operator(doc, op, arg, variables)
+    return {k: evaluate(doc, v, variables) for k, v in expr.items()}
+
+
+def _evaluate_operator(doc: dict, op: str, arg: Any, variables: dict) -> Any:
+
+    def ev(e):
+        return evaluate(doc, e, variables)
+
+    if op == "$literal":
+        return arg
+    if op == "$ifNull":
+        for item in arg:
+            value = ev(item)
+            if value is not None and value is not _MISSING:
+                return value
+        return None
+    if op == "$cond":
+        if isinstance(arg, dict):
+            arg = [arg["if"], arg["then"], arg["else"]]
+        return ev(arg[1]) if ev(arg[0]) else ev(arg[2])
+    if op == "$let":
+        scope = dict(variables)
+        scope.update({k: ev(v) for k, v in arg["vars"].items()})
+        return evaluate(doc, arg["in"], scope)
+    if op in ("$map", "$filter"):
+        items = ev(arg["input"]) or []
+        name = arg.get("as", "this")
+        result = []
+        for item in items:
+            scope = dict(variables, **{name: item})
+            if op == "$map":
+                result.append(evaluate(doc, arg["in"], scope))
+            elif evaluate(doc, arg["cond"], scope):
+                result.append(item)
+        return result
+    if op == "$objectToArray":
+        value = ev(arg)
+        return [{"k": k, "v": v} for k, v in value.items()] if isinstance(value, dict) else None
+    if op == "$and":
+        return all(ev(item) for item in arg)
+    if op == "$or":
+        return any(ev(item) for item in arg)
+    if op == "$not":
+        return not ev(arg[0] if isinstance(arg, list) else arg)
+    if op in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+        c = compare(ev(arg[0]), ev(arg[1]))
+        return {
+            "$eq": c == 0,
+            "$ne": c != 0,
+            "$gt": c > 0,
+            "$gte": c >= 0,
+            "$lt": c < 0,
+            "$lte": c <= 0,
+        }[op]
+    if op == "$in":
+        needle, haystack = ev(arg[0]), ev(arg[1]) or []
+        return any(compare(needle, item) == 0 for item in haystack)
+    if op == "$size":
+        return len(ev(arg))
+    if op == "$arrayElemAt":
+        items, index = ev(arg[0]), ev(arg[1])
+        if not items or not -len(items) <= index < len(items):
+            return None
+        return items[index]
+    if op == "$bsonSize":
+        value = ev(arg)
+        return len(bson.encode(value)) if isinstance(value, dict) else None
+    if op == "$type":
+        value = ev(arg)
+        return {0: "null", 1: "double", 2: "string", 3: "object", 4: "array"}.get(
+            _type_rank(value), "unknown") if value is not _MISSING else "missing"
+    if op in ("$add", "$multiply", "$max", "$min"):
+        values = [ev(item) for item in (arg if isinstance(arg, list) else [arg])]
+        if op in ("$max", "$min"):
+            values = [v for v in values if v is not None]
+            if not values:
+                return None
+            return max(values) if op == "$max" else min(values)
+        if any(v is None for v in values):
+            return None
+        return sum(values) if op == "$add" else functools.reduce(lambda a, b: a * b, values, 1)
+    if op in ("$subtract", "$divide"):
+        a, b = ev(arg[0]), ev(arg[1])
+        if a is None or b is None:
+            return None
+        return a - b if op == "$subtract" else a / b
+    if op in ("$ln", "$ceil", "$floor", "$abs"):
+        value = ev(arg)
+        if value is None:
+            return None
+        return {"$ln": math.log, "$ceil": math.ceil, "$floor": math.floor, "$abs": abs}[op](value)
+    raise NotImplementedError(f"expression operator {op} is not supported")
+
+
+def _sort(docs: List[dict], sort: Any) -> List[dict]:
+    if isinstance(sort, dict):
+        sort = list(sort.items())
+
+    def cmp(a, b):
+        for key, direction in sort:
+            c = compare(get_path(a, key, None), get_path(b, key, None))
+            if c:
+                return c * direction
+        return 0
+
+    return sorted(docs, key=functools.cmp_to_key(cmp))
+
+
+class _Accumulator:
+
+    def __init__(self, op: str, expr: Any):
+        self.op, self.expr = op, expr
+        self.value = [] if op == "$push" else None
+
+    def add(self, doc: dict) -> None:
+        value = evaluate(doc, self.expr)
+        if self.op == "$sum":
+            self.value = (self.value or 0) + (value if isinstance(value, (int, float)) else 0)
+        elif self.op == "$push":
+            self.value.append(value)
+        elif self.op == "$first":
+            if self.value is None:
+                self.value = value
+        elif value is not None:
+            if self.value is None:
+                self.value = value
+            elif self.op == "$min":
+                self.value = min(self.value, value)
+            elif self.op == "$max":
+                self.value = max(self.value, value)
+
+    def result(self) -> Any:
+        if self.op == "$sum" and self.value is None:
+            return 0
+        return self.value
+
+
+def _group(docs: Iterable[dict], spec: dict) -> List[dict]:
+    groups = {}
+    for doc in docs:
+        key = evaluate(doc, spec["_id"])
+        hashable = repr(key)
+        if hashable not in groups:
+            groups[hashable] = (key, {
+                name: _Accumulator(*next(iter(acc.items())))
+                for name, acc in spec.items() if name != "_id"
+            })
+        for accumulator in groups[hashable][1].values():
+            accumulator.add(doc)
+    return [
+        dict({"_id": key}, **{name: acc.result() for name, acc in accumulators.items()})
+        for key, accumulators in groups.values()
+    ]
+
+
+def _project_stage(doc: dict, spec: dict) -> dict:
+    if all(v in (0, False) for v in spec.values()) or all(
+            v in (1, True) for v in spec.values()):
+        return project(doc, spec)
+    result = {}
+    if spec.get("_id", 1) and "_id" in doc:
+        result["_id"] = doc["_id"]
+    for key, value in spec.items():
+        if key == "_id" and value in (0, 1, True, False):
+            continue
+        if value in (1, True):
+            value = "$" + key
+        computed = evaluate(doc, value)
+        if computed is not _MISSING:
+            _set_path(result, key, computed)
+    return result
+
+
+def _unwound(doc: dict, path: str, item: Any) -> dict:
+    # 嵌套的路径会修改子文档，需要深拷贝
+    doc = copy.deepcopy(doc) if "." in path else copy.copy(doc)
+    _set_path(doc, path, item)
+    return doc
+
+
+def run_pipeline(docs: Iterable[dict], pipeline: List[dict]) -> List[dict]:
+    docs = list(docs)
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            docs = [doc for doc in docs if match(doc, spec)]
+        elif name == "$project":
+            docs = [_project_stage(doc, spec) for doc in docs]
+        elif name in ("$addFields", "$set"):
+            docs = [dict(doc, **{k: evaluate(doc, v) for k, v in spec.items()}) for doc in docs]
+        elif name == "$group":
+            docs = _group(docs, spec)
+        elif name == "$sort":
+            docs = _sort(docs, spec)
+        elif name == "$limit":
+            docs = docs[:spec]
+        elif name == "$skip":
+            docs = docs[spec:]
+        elif name == "$unwind":
+            path = (spec["path"] if isinstance(spec, dict) else spec)[1:]
+            docs = [
+                _unwound(doc, path, item) for doc in docs
+                for item in (get_path(doc, path, None) or [])
+            ]
+        elif name == "$count":
+            docs = [{spec: len(docs)}] if docs else []
+        else:
+            raise NotImplementedError(f"pipeline stage {name} is not supported")
+    return docs
+
+
+class MemoryCursor:
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = 0
+        self._docs = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = [(key_or_list, direction)] if direction is not None else key_or_list
+        return self
+
+    def skip(self, skip: int):
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        self._batch_size = batch_size
+        return self
+
+    def max_time_ms(self, max_time_ms: int):
+        return self
+
+    def _load(self) -> List[dict]:
+        docs = self._loader()
+        if self._sort:
+            docs = _sort(docs, self._sort)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return docs
+
+    def __aiter__(self):
+        self._docs = iter(self._load())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        docs = self._load()
+        return docs[:length] if length else docs
+
+
+class MemoryCollection:
+
+    def __init__(self, name: str = "Data", documents: Iterable[dict] = ()):
+        self.name = name
+        self.documents: List[dict] = []
+        self.insert_many(documents)
+
+    def insert_many(self, documents: Iterable[dict]) -> None:
+        for doc in documents:
+            doc = dict(doc)
+            doc.setdefault("_id", ObjectId())
+            self.documents.append(doc)
+
+    def find(self, filter: Optional[dict] = None, projection: Any = None, **kwargs) -> MemoryCursor:
+        return MemoryCursor(lambda: [
+            project(doc, projection) if projection else copy.deepcopy(doc)
+            for doc in self.documents
+            if match(doc, filter)
+        ])
+
+    async def find_one(self, filter: Optional[dict] = None, projection: Any = None, sort=None,
+                       **kwargs) -> Optional[dict]:
+        cursor = self.find(filter, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        docs = await cursor.limit(1).to_list()
+        return docs[0] if docs else None
+
+    async def count_documents(self, filter: Optional[dict] = None, **kwargs) -> int:
+        return sum(1 for doc in self.documents if match(doc, filter))
+
+    async def distinct(self, key: str, filter: Optional[dict] = None, **kwargs) -> List[Any]:
+        values = []
+        for doc in self.documents:
+            value = get_path(doc, key)
+            if value is not _MISSING and match(doc, filter) and value not in values:
+                values.append(value)
+        return values
+
+    def aggregate(self, pipeline: List[dict], **kwargs) -> MemoryCursor:
+        return MemoryCursor(lambda: copy.deepcopy(run_pipeline(self.documents, pipeline)))
+
+
+class MemoryDatabase:
+
+    def __init__(self, collections: Optional[dict] = None):
+        self.collections = {
+            name: MemoryCollection(name, docs) for name, docs in (collections or {}).items()
+        }
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+        return self.collections[name]
+
+    def get_collection(self, name: str, **kwargs) -> MemoryCollection:
+        return self[name]
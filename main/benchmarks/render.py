@@ -0,0 +1,30 @@
+"""list_errors 行构造和响应序列化：逐条构造 NluData vs 批量 TypedDict 校验，Ninja 默认 JSONRenderer vs orjson"""
+from ninja.renderers import JSONRenderer
+
+from main.benchmarks import measure
+from main.handlers.stats import NluData, error_rows, receive_intent
+from main.utils.renderer import FastJSONRenderer
+
+
+def per_row(docs):
+    """改造前 ListErrorsHandler 的做法"""
+    result = []
+    for doc in docs:
+        r = NluData(**doc["custom"]).model_dump()
+        r["label_type"] = receive_intent(doc)
+        result.append(r)
+    return result
+
+
+def run(docs: list, repeat: int = 5) -> dict:
+    rows = len(docs)
+    data = error_rows(docs)
+    stdlib, fast = JSONRenderer(), FastJSONRenderer()
+    return {
+        "rows_per_row_validation": measure(lambda: per_row(docs), rows, repeat),
+        "rows_batched_typed_dict": measure(lambda: error_rows(docs), rows, repeat),
+        "render_ninja_json": measure(lambda: stdlib.render(None, data, response_status=200), rows,
+                                     repeat),
+        "render_fast_json": measure(lambda: fast.render(None, data, response_status=200), rows,
+                                    repeat),
+    }
@@ -0,0 +1,12 @@
+"""统计接口的计数和 NluData 校验"""
+from main.benchmarks import measure
+from main.handlers.stats import NluData, docs_stats
+
+
+def run(docs: list, repeat: int = 5) -> dict:
+    rows = len(docs)
+    return {
+        "docs_stats": measure(lambda: docs_stats(docs), rows, repeat),
+        "nlu_data_validation": measure(lambda: [NluData(**doc["custom"]) for doc in docs], rows,
+                                       repeat),
+    }
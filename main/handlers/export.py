@@ -0,0 +1,132 @@
+import json
+import logging
+import tempfile
+from typing import AsyncIterator, Optional
+
+from ninja.errors import HttpError
+from pydantic import Field
+from django.conf import settings
+from django.http import FileResponse, HttpRequest, StreamingHttpResponse
+
+from main.handlers.stats import NluData, RangeAccuracyRequest, parse_params, receive_intent
+from main.utils.export import (
+    CONTENT_TYPES,
+    STREAM_FORMATS,
+    resolve_format,
+    stream_rows,
+    write_rows,
+)
+from main.utils.mongo import mongo_client, date_query, range_query
+
+logger = logging.getLogger(__name__)
+
+# NluData 的字段展开成列，dict/list 类型的字段存为 JSON 字符串
+EXPORT_COLUMNS = [
+    (name, "float" if name in ("detect_time_cost", "total_time_cost") else "string")
+    for name in NluData.model_fields
+] + [("output_intent", "string"), ("label", "string")]
+EXPORT_PROJECTION = {
+    "_id": 0,
+    "evaluation.message_evaluation": 1,
+    **{f"custom.{name}": 1 for name in NluData.model_fields},
+}
+# 每批在内存中的最大行数
+EXPORT_MAX_BATCH_SIZE = 50000
+
+
+def record_row(doc: dict) -> dict:
+    custom = doc.get("custom") or {}
+    row = {}
+    for name in NluData.model_fields:
+        value = custom.get(name)
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False)
+        row[name] = value
+    row["output_intent"] = (custom.get("output2") or {}).get("intent")
+    row["label"] = receive_intent(doc) or ""
+    return row
+
+
+class ExportRequest(RangeAccuracyRequest):
+    # 有 date 时只导出这一天，否则导出 [start_date, end_date]
+    date: Optional[str] = ""
+    format: str = "parquet"
+    batch_size: int = Field(default=10000, ge=1, le=EXPORT_MAX_BATCH_SIZE)
+
+    def query(self) -> dict:
+        if self.date:
+            return date_query(self.date, self.env)
+        return range_query(self.start_date, self.end_date, self.env)
+
+
+async def export_rows(query: dict, batch_size: int = 10000) -> AsyncIterator[dict]:
+    async for doc in mongo_client.iter_find(query,
+                                            projection=EXPORT_PROJECTION,
+                                            batch_size=batch_size,
+                                            label="export",
+                                            max_time_ms=settings.MONGO_EXPORT_MAX_TIME_MS):
+        yield record_row(doc)
+
+
+def get_format(req: ExportRequest) -> str:
+    try:
+        return resolve_format(req.format)
+    except ValueError as e:
+        raise HttpError(400, str(e))
+
+
+def log_export(format: str, result: dict) -> None:
+    logger.info(f"Export: {format} | "
+                f"Rows: {result['rows']} | "
+                f"Duration: {result['seconds']}s | "
+                f"Throughput: {result['rows_per_second']} rows/s")
+
+
+async def export_records(req: ExportRequest, fileobj) -> dict:
+    """把匹配的记录按批写到 fileobj，返回实际格式、行数和吞吐"""
+    format = get_format(req)
+    result = await write_rows(export_rows(req.query(), req.batch_size),
+                              fileobj,
+                              format,
+                              EXPORT_COLUMNS,
+                              batch_size=req.batch_size)
+    log_export(format, result)
+    return dict(result, format=format)
+
+
+async def stream_records(req: ExportRequest, format: str) -> AsyncIterator[bytes]:
+    """边从游标读取边按批写出 csv/arrow"""
+    result = {}
+    async for chunk in stream_rows(export_rows(req.query(), req.batch_size),
+                                   format,
+                                   EXPORT_COLUMNS,
+                                   batch_size=req.batch_size,
+                                   result=result):
+        yield chunk
+    log_export(format, result)
+
+
+async def ExportHandler(request: HttpRequest):
+    """
+    按 env/date/range 导出 NLU 记录，parquet/arrow 需要 pyarrow，否则导出 csv
+    csv/arrow 边读边发送；parquet 的元数据在文件末尾，先写到临时文件，完成后发送
+    """
+    req = parse_params(ExportRequest, request)
+    format = get_format(req)
+    filename = f"nlu_records.{format}"
+    if format in STREAM_FORMATS:
+        response = StreamingHttpResponse(stream_records(req, format),
+                                         content_type=CONTENT_TYPES[format])
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+    fileobj = tempfile.TemporaryFile()
+    result = await export_records(req, fileobj)
+    fileobj.seek(0)
+    response = FileResponse(fileobj,
+                            as_attachment=True,
+                            filename=filename,
+                            content_type=CONTENT_TYPES[format])
+    response["X-Export-Rows"] = result["rows"]
+    response["X-Export-Rows-Per-Second"] = result["rows_per_second"]
+    return response
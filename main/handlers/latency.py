@@ -0,0 +1,226 @@
+"""
+detect_time_cost/total_time_cost 的分位数：每天按 (detector, provider) 计算 DDSketch 并保存到 LatencyStats，
+按周、按范围的分位数由每天的草图合并得到，不需要重新读取文档
+"""
+from typing import Dict, List, Optional
+
+from ninja.errors import HttpError
+from django.conf import settings
+from django.http import HttpRequest
+
+from main import models
+from main.handlers.stats import (
+    RangeAccuracyRequest,
+    dates_freshness,
+    get_stats_mode,
+    get_week_end_date,
+    get_week_start_date,
+    is_closed_date,
+    parse_params,
+    persistable,
+    range_dates,
+    stats_cache,
+    stats_cache_ttl,
+)
+from main.utils.cache import cached
+from main.utils.mongo import mongo_client, dates_query
+from main.utils.sketch import DDSketch, MIN_VALUE
+
+LATENCY_METRICS = {
+    "detect": "custom.detect_time_cost",
+    "total": "custom.total_time_cost",
+}
+# 草图按这些维度保存，更粗的分组由草图合并
+LATENCY_DIMENSIONS = ("detector", "provider")
+LATENCY_INTERVALS = ("range", "day", "week")
+LATENCY_PROJECTION = {
+    "_id": 0,
+    "custom.date": 1,
+    **{f"custom.{name}": 1 for name in LATENCY_DIMENSIONS},
+    **{path: 1 for path in LATENCY_METRICS.values()},
+}
+
+# {(detector, provider): {"detect": DDSketch, "total": DDSketch}}
+Sketches = Dict[tuple, Dict[str, DDSketch]]
+
+
+def latency_pipeline(query: dict, ln_gamma: float) -> List[dict]:
+    """在 MongoDB 中分桶计数：每个文档展开成两个耗时，按 (日期, 维度, 耗时, 桶) 分组"""
+    value = "$latency.value"
+    return [
+        {"$match": query},
+        {"$project": {
+            "_id": 0,
+            "date": "$custom.date",
+            **{name: f"$custom.{name}" for name in LATENCY_DIMENSIONS},
+            "latency": [{"metric": metric, "value": f"${path}"}
+                        for metric, path in LATENCY_METRICS.items()],
+        }},
+        {"$unwind": "$latency"},
+        # 按类型比较，只保留数字类型的耗时
+        {"$match": {"latency.value": {"$gte": float("-inf")}}},
+        {"$group": {
+            "_id": {
+                "date": "$date",
+                **{name: f"${name}" for name in LATENCY_DIMENSIONS},
+                "metric": "$latency.metric",
+                "bin": {"$cond": [
+                    {"$gt": [value, MIN_VALUE]},
+                    {"$ceil": {"$divide": [{"$ln": value}, ln_gamma]}},
+                    None,
+                ]},
+            },
+            "count": {"$sum": 1},
+            "min": {"$min": value},
+            "max": {"$max": value},
+            "sum": {"$sum": value},
+        }},
+    ]
+
+
+def new_sketches() -> Dict[str, DDSketch]:
+    return {metric: DDSketch() for metric in LATENCY_METRICS}
+
+
+async def query_latency(query: dict,
+                        mode: str = "aggregate",
+                        label: str = "") -> Dict[str, Sketches]:
+    """{date: Sketches}，没有文档的日期不会出现"""
+    days: Dict[str, Sketches] = {}
+    if mode == "aggregate":
+        ln_gamma = DDSketch().ln_gamma
+        for group in await mongo_client.aggregate(latency_pipeline(query, ln_gamma)):
+            key = group["_id"]
+            sketches = days.setdefault(key["date"], {}).setdefault(
+                tuple(key.get(name) for name in LATENCY_DIMENSIONS), new_sketches())
+            index = int(key["bin"]) if key.get("bin") is not None else None
+            sketches[key["metric"]].add_bin(index, group["count"], group["min"], group["max"],
+                                            group["sum"])
+        return days
+
+    async for doc in mongo_client.iter_find(query, projection=LATENCY_PROJECTION, label=label):
+        custom = doc["custom"]
+        sketches = days.setdefault(custom["date"], {}).setdefault(
+            tuple(custom.get(name) for name in LATENCY_DIMENSIONS), new_sketches())
+        for metric, path in LATENCY_METRICS.items():
+            value = custom.get(path.split(".")[-1])
+            if isinstance(value, (int, float)):
+                sketches[metric].add(value)
+    return days
+
+
+def dump_sketches(sketches: Sketches) -> List[dict]:
+    return [{
+        **dict(zip(LATENCY_DIMENSIONS, key)),
+        **{metric: sketch.to_dict() for metric, sketch in metrics.items()},
+    } for key, metrics in sketches.items()]
+
+
+def load_sketches(groups: List[dict]) -> Sketches:
+    return {
+        tuple(group.get(name) for name in LATENCY_DIMENSIONS):
+        {metric: DDSketch.from_dict(group[metric]) for metric in LATENCY_METRICS}
+        for group in groups
+    }
+
+
+async def latency_stats(env: str, dates: List[str], mode: str = "aggregate", label: str = "",
+                        tz: Optional[str] = None) -> Dict[str, Sketches]:
+    """
+    dates 中每一天的草图 {date: Sketches}，和 daily_stats 一样：
+    已经结束的日期先读 LatencyStats，缺失的一次查询补齐并保存，当天总是实时计算
+    """
+    env, result = env or "", {}
+    if settings.STATS_ROLLUPS:
+        closed = [date for date in dates if is_closed_date(date, tz)]
+        for date, r in (await models.LatencyStats.get_rollups(env, closed)).items():
+            result[date] = load_sketches(r.groups)
+    missing = [date for date in dates if date not in result]
+    if not missing:
+        return result
+    queried = await query_latency(dates_query(missing, env), mode, label=label)
+    computed = {date: queried.get(date, {}) for date in missing}
+    closed = await persistable(env, {
+        date: dump_sketches(sketches)
+        for date, sketches in computed.items() if is_closed_date(date, tz)
+    })
+    if closed:
+        await models.LatencyStats.save_rollups(env, closed)
+    result.update(computed)
+    return result
+
+
+def merge_sketches(days: List[Sketches], by: tuple) -> Dict[tuple, Dict[str, DDSketch]]:
+    """合并多天的草图，按 by 中的维度分组"""
+    indexes = [LATENCY_DIMENSIONS.index(name) for name in by]
+    merged: Dict[tuple, Dict[str, DDSketch]] = {}
+    for sketches in days:
+        for key, metrics in sketches.items():
+            target = merged.setdefault(tuple(key[i] for i in indexes), new_sketches())
+            for metric, sketch in metrics.items():
+                target[metric].merge(sketch)
+    return merged
+
+
+def latency_groups(days: List[Sketches], by: tuple) -> List[dict]:
+    """按总耗时的样本数倒序"""
+    merged = merge_sketches(days, by)
+    groups = [{
+        **dict(zip(by, key)),
+        **{metric: sketch.summary() for metric, sketch in metrics.items()},
+    } for key, metrics in merged.items()]
+    return sorted(groups, key=lambda group: -group["total"]["count"])
+
+
+def parse_by(value: Optional[str]) -> tuple:
+    names = {name.strip() for name in (value or "").split(",") if name.strip()}
+    if names - set(LATENCY_DIMENSIONS):
+        raise HttpError(400, f"by must be in {', '.join(LATENCY_DIMENSIONS)}")
+    return tuple(name for name in LATENCY_DIMENSIONS if name in names)
+
+
+async def latency_freshness(request: HttpRequest) -> tuple:
+    """(max_age, version, complete)，以保存的 LatencyStats 为版本"""
+    try:
+        req = RangeAccuracyRequest(**request.GET.dict())
+        dates = range_dates(req.start_date, req.end_date)
+    except (ValueError, HttpError):
+        return 0, None, False
+    return await dates_freshness(req.env, dates, models.LatencyStats.rollup_version)
+
+
+@cached(stats_cache, stats_cache_ttl, latency_freshness)
+async def LatencyHandler(request: HttpRequest):
+    """
+    范围内 detect_time_cost/total_time_cost 的 p50/p90/p99/max，
+    by 为分组维度（detector,provider），interval 为 range（整个范围）/day/week
+    """
+    req = parse_params(RangeAccuracyRequest, request)
+    by = parse_by(request.GET.get("by"))
+    interval = request.GET.get("interval") or LATENCY_INTERVALS[0]
+    if interval not in LATENCY_INTERVALS:
+        raise HttpError(400, f"interval must be one of {', '.join(LATENCY_INTERVALS)}")
+    dates = range_dates(req.start_date, req.end_date)
+    days = await latency_stats(req.env, dates, get_stats_mode(request), label="latency")
+
+    items = []
+    if interval == "range":
+        items.append({
+            "start_date": req.start_date,
+            "end_date": req.end_date,
+            "groups": latency_groups(list(days.values()), by),
+        })
+    elif interval == "day":
+        # 日期倒序，没有数据的日期不返回
+        items.extend({"date": date, "groups": latency_groups([days[date]], by)}
+                     for date in dates if days[date])
+    else:
+        weeks: Dict[str, List[Sketches]] = {}
+        for date in dates:
+            weeks.setdefault(get_week_start_date(date), []).append(days[date])
+        items.extend({
+            "week_start_date": week,
+            "week_end_date": get_week_end_date(week),
+            "groups": latency_groups(week_days, by),
+        } for week, week_days in weeks.items() if any(week_days))
+    return {"env": req.env, "by": list(by), "interval": interval, "items": items}
@@ -0,0 +1,10 @@
+from django.http import HttpRequest, HttpResponse
+
+from main.utils.metrics import registry
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+async def MetricsHandler(request: HttpRequest):
+    """Prometheus 文本格式的指标"""
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,269 @@
+"""
+后台预计算：补齐过去日期/周的 DailyStats/WeeklyStats，每天零点后把昨天的统计算好
+可以用 manage.py precompute 运行，也可以在 PRECOMPUTE_IN_LIFESPAN 打开时随 ASGI 进程在后台运行；
+结果缓存在进程内，只有随 ASGI 进程运行时才预热常用接口的结果缓存，并且只对这个 worker 有效
+补齐的进度按环境保存到 Checkpoint，中断后从上次完成的周继续
+"""
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlencode
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.http import HttpRequest, QueryDict
+
+from main import models
+from main.handlers import stats
+from main.handlers.latency import latency_stats
+from main.handlers.stats import (
+    breakdown_stats,
+    daily_stats,
+    get_dates,
+    get_week_dates,
+    get_week_start_date,
+    is_closed_date,
+    is_closed_week,
+    recompute_rollups,
+    weekly_stats,
+)
+from main.utils.metrics import registry
+from main.utils.mongo import mongo_client
+
+logger = logging.getLogger(__name__)
+
+# 和每日统计一起预先计算的分组统计
+PRECOMPUTE_BREAKDOWNS = [("output_intent",)]
+BACKFILL_CHECKPOINT = "precompute.backfill"
+
+BACKFILL_REMAINING = registry.gauge("precompute_backfill_remaining_weeks",
+                                    "Weeks left in the running rollup backfill", ("env",))
+
+
+async def list_envs() -> List[str]:
+    """PRECOMPUTE_ENVS 中的环境，为空时从 MongoDB 查出所有环境；"" 为全部环境的统计"""
+    envs = settings.PRECOMPUTE_ENVS or sorted(
+        env for env in await mongo_client.distinct("custom.env") if env)
+    return ["", *envs]
+
+
+def yesterday(tz: Optional[str] = None) -> str:
+    now = datetime.now(ZoneInfo(tz)) if tz else datetime.now()
+    return (now - timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def seconds_until_rollover(timezones: List[str], delay: float,
+                           now: Optional[datetime] = None) -> float:
+    """到下一个时区零点后 delay 秒的时间"""
+    now = now or datetime.now(ZoneInfo("UTC"))
+    seconds = []
+    for tz in timezones:
+        local = now.astimezone(ZoneInfo(tz))
+        midnight = datetime.combine(local.date() + timedelta(days=1), datetime.min.time(),
+                                    tzinfo=local.tzinfo)
+        rollover = midnight + timedelta(seconds=delay)
+        # 零点之后、delay 之前还没有滚动今天的统计
+        if local < midnight - timedelta(days=1) + timedelta(seconds=delay):
+            rollover -= timedelta(days=1)
+        seconds.append((rollover - local).total_seconds())
+    return max(min(seconds), 0)
+
+
+def make_request(path: str, params: dict) -> HttpRequest:
+    """构造和真实请求相同 path/GET 参数的请求，结果缓存的 key 相同"""
+    request = HttpRequest()
+    request.method = "GET"
+    request.path = request.path_info = path
+    request.GET = QueryDict(urlencode(params))
+    return request
+
+
+def warm_requests(env: str, date: str, ranges: List[int]) -> List[tuple]:
+    """仪表盘打开时的请求 [(handler, path, params)]，env 为 "" 时不带 env 参数"""
+    params = {"env": env} if env else {}
+    requests = [
+        (stats.DailyAccuracyHandler, "/api/stats/daily_accuracy", {**params, "date": date}),
+        (stats.WeeklyAccuracyHandler, "/api/stats/weekly_accuracy", params),
+    ]
+    end = datetime.strptime(date, "%Y-%m-%d")
+    for days in ranges:
+        start_date = (end - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        range_params = {**params, "start_date": start_date, "end_date": date}
+        requests.append((stats.RangeAccuracyHandler, "/api/stats/range_accuracy", range_params))
+        requests.append(
+            (stats.RangeDailyAccuracyHandler, "/api/stats/range_daily_accuracy", range_params))
+    return requests
+
+
+def log_progress(env: str, done: int, total: int, seconds: float) -> None:
+    rate = done / seconds if seconds else 0
+    eta = (total - done) / rate if rate else 0
+    logger.info(f"Precompute: env={env or '(all)'} | "
+                f"Weeks: {done}/{total} | "
+                f"Rate: {rate:.2f} weeks/s | "
+                f"ETA: {eta:.0f}s")
+
+
+class Precomputer:
+
+    def __init__(self,
+                 envs: Optional[List[str]] = None,
+                 days: int = 0,
+                 concurrency: int = 0,
+                 progress: Optional[Callable[[str, int, int, float], None]] = None):
+        self.envs = envs
+        self.days = days or settings.PRECOMPUTE_BACKFILL_DAYS
+        self.concurrency = concurrency or settings.PRECOMPUTE_CONCURRENCY
+        self.progress = progress or log_progress
+
+    async def get_envs(self) -> List[str]:
+        return self.envs if self.envs is not None else await list_envs()
+
+    async def backfill(self, restart: bool = False) -> Dict[str, int]:
+        """
+        从昨天往前 days 天，按周补齐每个环境缺失的统计，返回 {env: 计算的天数}
+        最多 concurrency 个周同时计算；中断后比 Checkpoint 中记录的周更晚的周已经补齐过，直接跳过，
+        补齐完成后清除进度，下次从昨天重新检查，补齐停止运行期间缺失的日期
+        """
+        envs = await self.get_envs()
+        checkpoint = {} if restart else await models.Checkpoint.get_value(BACKFILL_CHECKPOINT, {})
+        semaphore = asyncio.Semaphore(self.concurrency)
+        end_date = yesterday()
+        start_date = (datetime.strptime(end_date, "%Y-%m-%d") -
+                      timedelta(days=self.days - 1)).strftime("%Y-%m-%d")
+        computed = await asyncio.gather(*[
+            self.backfill_env(env, start_date, end_date, checkpoint, semaphore) for env in envs
+        ])
+        return dict(zip(envs, computed))
+
+    async def backfill_env(self, env: str, start_date: str, end_date: str, checkpoint: dict,
+                           semaphore: asyncio.Semaphore) -> int:
+        # 最早一周之前没有数据，不需要计算
+        first_week_start_date = await mongo_client.find_first_week_start_date(env=env)
+        if not first_week_start_date:
+            return 0
+        start_date = max(start_date, first_week_start_date)
+        done_until = checkpoint.get(env)
+        # 倒序，最近的周最先计算
+        weeks = sorted({get_week_start_date(date) for date in get_dates(start_date, end_date)},
+                       reverse=True)
+        if done_until:
+            weeks = [week for week in weeks if week < done_until]
+        finished, frontier, computed = set(), 0, 0
+        started = time.perf_counter()
+        BACKFILL_REMAINING.set(len(weeks), env)
+
+        async def backfill_week(week: str):
+            nonlocal frontier, computed
+            dates = [date for date in get_week_dates(week) if start_date <= date <= end_date]
+            async with semaphore:
+                saved = await models.DailyStats.get_rollups(env, dates)
+                missing = [date for date in dates if date not in saved and is_closed_date(date)]
+                if missing:
+                    await daily_stats(env, missing, label="precompute")
+                    computed += len(missing)
+                # 耗时草图和分组统计和每日统计分开保存，缺失的日期分别补齐
+                closed = [date for date in dates if is_closed_date(date)]
+                await latency_stats(env, closed, label="precompute")
+                await breakdown_stats(env, closed, PRECOMPUTE_BREAKDOWNS, label="precompute")
+                if is_closed_week(week):
+                    await weekly_stats(env, [week], label="precompute")
+            finished.add(week)
+            # 从最近的周开始连续完成的部分才记录进度，并发计算时完成的顺序不确定
+            advanced = False
+            while frontier < len(weeks) and weeks[frontier] in finished:
+                frontier += 1
+                advanced = True
+            if advanced:
+                checkpoint[env] = weeks[frontier - 1]
+                await models.Checkpoint.set_value(BACKFILL_CHECKPOINT, dict(checkpoint))
+            BACKFILL_REMAINING.set(len(weeks) - len(finished), env)
+            self.progress(env, len(finished), len(weeks), time.perf_counter() - started)
+
+        await asyncio.gather(*[backfill_week(week) for week in weeks])
+        if env in checkpoint:
+            del checkpoint[env]
+            await models.Checkpoint.set_value(BACKFILL_CHECKPOINT, dict(checkpoint))
+        return computed
+
+    async def rollover(self, timezones: Optional[List[str]] = None) -> List[str]:
+        """
+        各个时区的昨天在该时区刚刚结束，按该时区判断日期和周是否结束：
+        先让已经保存的统计失效（可能是结束前按其他时区算好的部分数据），再重新计算，返回计算的日期
+        """
+        timezones = timezones or settings.PRECOMPUTE_TIMEZONES
+        days = {yesterday(tz): tz for tz in timezones}
+        # 单个环境失效时会连带 "" 的统计，"" 放在最后计算
+        envs = sorted(await self.get_envs(), key=lambda env: env == "")
+        for date, tz in sorted(days.items()):
+            for env in envs:
+                await recompute_rollups(env, [date], tz=tz)
+                await latency_stats(env, [date], label="precompute", tz=tz)
+                await breakdown_stats(env, [date], PRECOMPUTE_BREAKDOWNS, label="precompute",
+                                      tz=tz)
+        return sorted(days)
+
+    async def warm(self) -> int:
+        """按仪表盘常用的参数调用各个统计接口，结果进入 stats_cache，返回预热的请求数"""
+        date = yesterday()
+        requests = [
+            request for env in await self.get_envs()
+            for request in warm_requests(env, date, settings.PRECOMPUTE_WARM_RANGES)
+        ]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def warm_one(handler, path, params):
+            async with semaphore:
+                await handler(make_request(path, params))
+
+        await asyncio.gather(*[warm_one(*request) for request in requests])
+        return len(requests)
+
+    async def run(self, backfill: bool = True, warm: bool = True) -> None:
+        """
+        补齐统计并预热缓存，之后每天零点后滚动昨天的统计；出错时记录日志，不退出
+        warm 只在 ASGI 进程中打开，其他进程（如 manage.py precompute）的结果缓存不会被请求用到
+        """
+        try:
+            if backfill:
+                await self.backfill()
+            if warm:
+                await self.warm()
+        except Exception:
+            logger.exception("Precompute failed")
+        while True:
+            await asyncio.sleep(
+                seconds_until_rollover(settings.PRECOMPUTE_TIMEZONES,
+                                       settings.PRECOMPUTE_ROLLOVER_DELAY))
+            try:
+                dates = await self.rollover()
+                count = await self.warm() if warm else 0
+                logger.info(f"Precompute rollover: {', '.join(dates)} | Warmed: {count}")
+            except Exception:
+                logger.exception("Precompute rollover failed")
+            # 避免在同一个零点之后重复滚动
+            await asyncio.sleep(1)
+
+
+_task: Optional[asyncio.Task] = None
+
+
+async def start():
+    """ASGI lifespan startup：PRECOMPUTE_IN_LIFESPAN 打开时在后台运行 Precomputer"""
+    global _task
+    if settings.PRECOMPUTE_IN_LIFESPAN and _task is None:
+        _task = asyncio.create_task(Precomputer().run())
+
+
+async def stop():
+    """ASGI lifespan shutdown"""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
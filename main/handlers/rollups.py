@@ -0,0 +1,353 @@
+"""
+增量维护 DailyStats/WeeklyStats：标注变化时减去文档原来的标注结果、加上新的标注结果，而不是重新统计整天
+change stream 模式需要 MongoDB 6.0+ 副本集，并对 Data 开启 changeStreamPreAndPostImages，才能拿到修改前后的文档；
+拿不到时（或者轮询模式）只知道文档所在的日期，重新计算这些日期的统计
+"""
+import json
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import json_util
+from django.conf import settings
+from pymongo.errors import OperationFailure
+
+from main import models
+from main.handlers.latency import LATENCY_DIMENSIONS, LATENCY_METRICS
+from main.handlers.stats import (
+    DIMENSIONS,
+    StatsAccumulator,
+    count_doc,
+    get_field,
+    get_week_end_date,
+    get_week_start_date,
+    is_closed_date,
+    recompute_rollups,
+    rollup_stats,
+)
+from main.utils.mongo import mongo_client, watermark_query
+
+logger = logging.getLogger(__name__)
+
+SYNC_MODES = ("auto", "change_stream", "poll")
+# Checkpoint 中保存的进度
+CHANGE_STREAM_CHECKPOINT = "rollup_sync.resume_token"
+WATERMARK_CHECKPOINT = "rollup_sync.watermark"
+# 不支持 change stream：40573 不是副本集，40324 版本太旧不认识 $changeStream
+CHANGE_STREAM_UNSUPPORTED = {40573, 40324}
+CHANGE_PIPELINE = [
+    {"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}},
+]
+# 影响统计的字段：标注结果，和决定统计归属的 env/date
+ROLLUP_FIELDS = ("evaluation", "custom.env", "custom.date")
+# 耗时草图用到的字段
+LATENCY_FIELDS = ("custom.env", "custom.date",
+                  *(f"custom.{name}" for name in LATENCY_DIMENSIONS), *LATENCY_METRICS.values())
+# 分组统计用到的维度字段
+BREAKDOWN_FIELDS = ("custom.env", "custom.date", *DIMENSIONS.values())
+WATCHED_FIELDS = tuple(dict.fromkeys((*ROLLUP_FIELDS, *LATENCY_FIELDS, *BREAKDOWN_FIELDS)))
+
+Key = Tuple[str, str]
+# 一批变更中最早和最晚一次变更的时间
+Span = Tuple[datetime, datetime]
+
+
+def doc_keys(doc: dict) -> Set[Key]:
+    """文档计入的 (env, date)，env 为 "" 的统计包含所有环境"""
+    custom = doc.get("custom") or {}
+    date = custom.get("date")
+    if not date:
+        return set()
+    return {(custom.get("env") or "", date), ("", date)}
+
+
+def touches_field(name: str, path: str) -> bool:
+    """修改的字段 name 是 path 本身、上级字段（整个替换）或下级字段"""
+    return name == path or path.startswith(f"{name}.") or name.startswith(f"{path}.")
+
+
+def touches_rollups(change: dict) -> bool:
+    if change["operationType"] != "update":
+        return True
+    description = change.get("updateDescription") or {}
+    fields = [*description.get("updatedFields", {}), *description.get("removedFields", [])]
+    return any(touches_field(name, path) for name in fields for path in WATCHED_FIELDS)
+
+
+def fields_changed(before: Optional[dict], after: Optional[dict], paths: Iterable[str]) -> bool:
+    """插入、删除文档，或者 paths 中的字段变化"""
+    if before is None or after is None:
+        return True
+    return any(get_field(before, path) != get_field(after, path) for path in paths)
+
+
+def latency_changed(before: Optional[dict], after: Optional[dict]) -> bool:
+    return fields_changed(before, after, LATENCY_FIELDS)
+
+
+def breakdown_changed(before: Optional[dict], after: Optional[dict]) -> bool:
+    return fields_changed(before, after, BREAKDOWN_FIELDS)
+
+
+def widen_span(spans: dict, key, at: Optional[datetime]) -> None:
+    if at is None:
+        return
+    earliest, latest = spans.get(key, (at, at))
+    spans[key] = (min(earliest, at), max(latest, at))
+
+
+def group_keys(keys: Iterable[Key]) -> Dict[str, List[str]]:
+    """{env: 排好序的 dates}"""
+    envs: Dict[str, Set[str]] = {}
+    for env, date in keys:
+        envs.setdefault(env, set()).add(date)
+    return {env: sorted(dates) for env, dates in envs.items()}
+
+
+def change_time(change: dict) -> Optional[datetime]:
+    """变更发生的时间，wallTime 需要 MongoDB 6.0+，否则用 clusterTime"""
+    at = change.get("wallTime")
+    if at is None and change.get("clusterTime") is not None:
+        at = change["clusterTime"].as_datetime()
+    if at is not None and at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    return at
+
+
+class RollupDeltas:
+    """按 (env, date) 累计一批变更的增量，计数可以为负"""
+
+    def __init__(self):
+        self.days: Dict[Key, StatsAccumulator] = {}
+        # 每个 (env, date) 最早和最晚一次变更的时间，和统计保存的时间比较，判断统计包含了哪些变更
+        self.spans: Dict[Key, Span] = {}
+        # 耗时草图不能减去数据，有插入、删除的 (env, date) 的草图直接失效
+        self.latency: Set[Key] = set()
+        # 维度值变化的 (env, date)，分组统计直接失效
+        self.breakdown: Set[Key] = set()
+
+    def add(self, doc: dict, sign: int = 1, at: Optional[datetime] = None) -> None:
+        acc = StatsAccumulator()
+        count_doc(acc, doc)
+        for key in doc_keys(doc):
+            day = self.days.setdefault(key, StatsAccumulator())
+            day.merge(acc) if sign > 0 else day.subtract(acc)
+            widen_span(self.spans, key, at)
+
+    def change(self, before: Optional[dict], after: Optional[dict],
+               at: Optional[datetime] = None) -> None:
+        if before is not None:
+            self.add(before, -1, at)
+        if after is not None:
+            self.add(after, 1, at)
+        keys = doc_keys(before or {}) | doc_keys(after or {})
+        if latency_changed(before, after):
+            self.latency.update(keys)
+        if breakdown_changed(before, after):
+            self.breakdown.update(keys)
+
+    async def apply(self) -> dict:
+        """把增量加到已保存的统计上，没有保存或已失效的统计跳过，下次访问时完整计算"""
+        result = {"daily": 0, "weekly": 0, "breakdown": 0, "latency": 0}
+        envs: Dict[str, Dict[str, StatsAccumulator]] = {}
+        for (env, date), acc in self.days.items():
+            if not acc.is_zero():
+                envs.setdefault(env, {})[date] = acc
+        for env, days in envs.items():
+            spans = {date: self.spans[env, date] for date in days if (env, date) in self.spans}
+            result["daily"] += await apply_deltas(models.DailyStats, env, days, spans,
+                                                  lambda date: date)
+            # 每周的统计按周合并增量，和每天的统计是否保存无关
+            weeks, spans = {}, {}
+            for date, acc in days.items():
+                week = get_week_start_date(date)
+                weeks.setdefault(week, StatsAccumulator()).merge(acc)
+                for at in self.spans.get((env, date), ()):
+                    widen_span(spans, week, at)
+            result["weekly"] += await apply_deltas(models.WeeklyStats, env, weeks, spans,
+                                                   lambda week: (week, get_week_end_date(week)))
+        # 分组统计按维度值保存，变更中的维度值可能不完整：标注或维度值变化时直接失效重新计算
+        breakdown = self.breakdown | {(env, date) for env, days in envs.items() for date in days}
+        for env, dates in group_keys(breakdown).items():
+            result["breakdown"] += await models.BreakdownStats.invalidate(env, dates)
+        for env, dates in group_keys(self.latency).items():
+            result["latency"] += await models.LatencyStats.invalidate(env, dates)
+        # 统计的版本已经变化，各个进程的结果缓存按版本取结果，不需要（也无法）在这里清空
+        return result
+
+
+async def apply_deltas(model, env: str, deltas: Dict[str, StatsAccumulator],
+                       spans: Dict[str, Span], rollup_key) -> int:
+    """
+    deltas 为 {date 或 week_start_date: 增量}，spans 为变更的时间范围，返回更新的统计数
+    统计在最晚的变更之后保存时已经包含了所有变更，跳过；在变更之间保存时只包含一部分变更，
+    合并后出现负数说明统计已经和数据对不上，这两种情况都让它失效重新计算
+    """
+    updated, drifted, partial = {}, [], []
+    for key, r in (await model.get_rollups(env, list(deltas))).items():
+        if key in spans:
+            earliest, latest = spans[key]
+            if r.updated >= latest:
+                continue
+            if r.updated >= earliest:
+                partial.append(key)
+                continue
+        acc = StatsAccumulator.from_stats(rollup_stats(r)).merge(deltas[key])
+        if acc.is_negative():
+            drifted.append(key)
+            continue
+        updated[rollup_key(key)] = acc.result()
+    if updated:
+        await model.save_rollups(env, updated)
+    if drifted:
+        logger.warning(f"Rollup drift: {model.__name__} | Env: {env} | Keys: {drifted}")
+    if drifted or partial:
+        await model.invalidate(env, drifted + partial)
+    return len(updated)
+
+
+async def recompute_keys(keys: Iterable[Key]) -> int:
+    """重新计算 (env, date) 的统计，当天还没有保存的统计，不需要计算"""
+    envs = group_keys((env, date) for env, date in keys if is_closed_date(date))
+    # 重新计算某个环境时会让全部环境 (env="") 的统计失效，所以全部环境最后计算
+    for env in sorted(envs, key=lambda env: env == ""):
+        await recompute_rollups(env, envs[env])
+    return sum(len(dates) for dates in envs.values())
+
+
+def encode_value(value):
+    """resume token 和水位线中的 ObjectId/datetime 转成可以保存到 JSONField 的值"""
+    return json.loads(json_util.dumps(value))
+
+
+def decode_value(value):
+    return json_util.loads(json.dumps(value))
+
+
+class RollupMaintainer:
+
+    def __init__(self,
+                 mode: str = "",
+                 batch_size: int = 0,
+                 interval: int = 0,
+                 collection_name: str = "Data"):
+        self.mode = mode or settings.ROLLUP_SYNC_MODE
+        if self.mode not in SYNC_MODES:
+            raise ValueError(f"mode must be one of {', '.join(SYNC_MODES)}")
+        self.batch_size = batch_size or settings.ROLLUP_SYNC_BATCH_SIZE
+        self.interval = interval or settings.ROLLUP_SYNC_INTERVAL
+        self.collection_name = collection_name
+        self.processed = 0
+
+    async def run(self, once: bool = False) -> int:
+        """一直同步下去；once 为 True 时处理完当前积压的变更就返回，返回处理的变更数"""
+        if self.mode != "poll":
+            try:
+                await self.watch(once)
+                return self.processed
+            except OperationFailure as e:
+                if self.mode != "auto" or e.code not in CHANGE_STREAM_UNSUPPORTED:
+                    raise
+                logger.warning(f"Change streams are not supported ({e}), "
+                               f"polling {settings.ROLLUP_WATERMARK_FIELD} instead")
+        while True:
+            count = await self.poll()
+            if count < self.batch_size:
+                if once:
+                    return self.processed
+                await asyncio.sleep(self.interval)
+
+    async def watch(self, once: bool = False) -> None:
+        token = await models.Checkpoint.get_value(CHANGE_STREAM_CHECKPOINT)
+        collection = mongo_client.db[self.collection_name]
+        async with collection.watch(CHANGE_PIPELINE,
+                                    full_document="whenAvailable",
+                                    full_document_before_change="whenAvailable",
+                                    resume_after=decode_value(token) if token else None,
+                                    max_await_time_ms=self.interval * 1000) as stream:
+            while stream.alive:
+                changes = []
+                while len(changes) < self.batch_size:
+                    change = await stream.try_next()
+                    if change is None:
+                        break
+                    changes.append(change)
+                if changes:
+                    await self.apply_changes(changes)
+                    await models.Checkpoint.set_value(CHANGE_STREAM_CHECKPOINT,
+                                                      encode_value(stream.resume_token))
+                elif once:
+                    return
+
+    async def apply_changes(self, changes: List[dict]) -> dict:
+        """
+        有修改前后的文档时按增量更新统计；缺少任何一个时不知道标注怎么变的，
+        按文档现在所在的日期重新计算，删除的文档没有 pre-image 时无法处理，只记录日志
+        """
+        deltas, stale, lookup = RollupDeltas(), set(), []
+        for change in changes:
+            if not touches_rollups(change):
+                continue
+            operation = change["operationType"]
+            before = change.get("fullDocumentBeforeChange")
+            after = change.get("fullDocument")
+            if operation in ("update", "replace", "delete") and before is None:
+                if operation == "delete":
+                    logger.warning(f"Deleted document without pre-image: {change['documentKey']}")
+                else:
+                    lookup.append(change["documentKey"]["_id"])
+                continue
+            if operation in ("insert", "update", "replace") and after is None:
+                stale.update(doc_keys(before or {}))
+                lookup.append(change["documentKey"]["_id"])
+                continue
+            deltas.change(before, after, change_time(change))
+        if lookup:
+            for doc in await mongo_client.find({"_id": {"$in": lookup}},
+                                               self.collection_name,
+                                               projection={"custom.env": 1, "custom.date": 1},
+                                               label="rollup_sync"):
+                stale.update(doc_keys(doc))
+        result = await deltas.apply()
+        result["recomputed"] = await recompute_keys(stale)
+        self.processed += len(changes)
+        logger.info(f"Rollup sync: {len(changes)} changes | "
+                    f"Daily: {result['daily']} | "
+                    f"Weekly: {result['weekly']} | "
+                    f"Recomputed: {result['recomputed']}")
+        return result
+
+    async def poll(self) -> int:
+        """
+        按 (ROLLUP_WATERMARK_FIELD, _id) 取出上次之后修改过的文档，重新计算它们所在的日期
+        第一次运行时从当前最新的文档开始，之前的修改由 recompute/backfill 处理
+        """
+        field = settings.ROLLUP_WATERMARK_FIELD
+        sort = [(field, 1), ("_id", 1)]
+        projection = {"custom.env": 1, "custom.date": 1, field: 1}
+        checkpoint = await models.Checkpoint.get_value(WATERMARK_CHECKPOINT)
+        if checkpoint is None:
+            latest = await mongo_client.find_one({field: {"$exists": True}},
+                                                 self.collection_name,
+                                                 projection={field: 1},
+                                                 sort=[(field, -1), ("_id", -1)])
+            if latest is not None:
+                await models.Checkpoint.set_value(
+                    WATERMARK_CHECKPOINT, encode_value([get_field(latest, field), latest["_id"]]))
+            return 0
+        docs = await mongo_client.find(watermark_query(field, *decode_value(checkpoint)),
+                                       self.collection_name,
+                                       sort=sort,
+                                       projection=projection,
+                                       label="rollup_sync",
+                                       limit=self.batch_size)
+        if not docs:
+            return 0
+        recomputed = await recompute_keys({key for doc in docs for key in doc_keys(doc)})
+        last = docs[-1]
+        await models.Checkpoint.set_value(WATERMARK_CHECKPOINT,
+                                          encode_value([get_field(last, field), last["_id"]]))
+        self.processed += len(docs)
+        logger.info(f"Rollup sync: {len(docs)} documents | Recomputed: {recomputed}")
+        return len(docs)
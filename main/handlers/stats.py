@@ -1,23 +1,38 @@
+import json
+import zlib
+import base64
 import logging
-from typing import List, Optional, Union
+from typing import AsyncIterator, Iterable, List, Optional, Union
+from typing_extensions import NotRequired, TypedDict
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
+from bson import ObjectId
 from pydantic import (
     BaseModel,
     Field,
+    TypeAdapter,
+    ValidationError,
     computed_field,
     field_validator,
 )
 from ninja.errors import HttpError
-from django.http import HttpRequest
-from functools import cached_property
+from django.conf import settings
+from django.http import HttpRequest, StreamingHttpResponse
 
 from main.utils.response import (
     OkResponse,
     FailedResponse,
 )
 from main import models, results
-from main.utils.mongo import mongo_client
+from main.utils.cache import ResultCache, cached, conditional
+from main.utils.metrics import cache_collector, registry
+from main.utils.renderer import dumps
+from main.utils.mongo import (
+    mongo_client,
+    dates_query,
+    errors_query,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -86,37 +101,85 @@ class NluData(BaseModel):
         return self.output2["intent"]
 
 
-class Counter(BaseModel):
-    SUCCESS: int = 0
-    ERROR_STT: int = 0
-    ERROR_INTENT: int = 0
-    ERROR_TASK_RUNNING: int = 0
-    ERROR_LANGUAGE: int = 0
-    ERROR_TRANSLATE: int = 0
-    ERROR_LLM_ANSWER: int = 0
-    ERROR_UNKNOWN: int = 0
-    _total: int = 0  # 私有字段存储总数
-    _labeled: int = 0
-    _unlabeled: int = 0
-
-    def increment(self, field: str, amount: int = 1) -> None:
-        current = getattr(self, field, 0)
-        setattr(self, field, current + amount)
-        self._total += amount
+# 各个接口只拉取自己用到的字段
+ACCURACY_PROJECTION = {"_id": 0, "evaluation.message_evaluation": 1}
+LIST_ERRORS_PROJECTION = {
+    "evaluation.message_evaluation": 1,
+    **{f"custom.{name}": 1 for name in NluData.model_fields},
+}
+
+
+# 标注结果，即 receive message 的 intent
+CATEGORIES = (
+    "SUCCESS",
+    "ERROR_STT",
+    "ERROR_INTENT",
+    "ERROR_TASK_RUNNING",
+    "ERROR_LANGUAGE",
+    "ERROR_TRANSLATE",
+    "ERROR_LLM_ANSWER",
+    "ERROR_UNKNOWN",
+)
+CATEGORY_INDEX = {category: index for index, category in enumerate(CATEGORIES)}
+
+
+class StatsAccumulator:
+    """按标注类别计数，可以合并多个部分结果（按分片、按天、按 worker）"""
+    __slots__ = ("counts", "labeled", "unlabeled")
+
+    def __init__(self):
+        self.counts = [0] * len(CATEGORIES)
+        self.labeled = 0
+        self.unlabeled = 0
+
+    @classmethod
+    def from_stats(cls, stats: dict) -> "StatsAccumulator":
+        acc = cls()
+        acc.counts = [stats["counts"][category] for category in CATEGORIES]
+        acc.labeled = stats["labels"]["labeled"]
+        acc.unlabeled = stats["labels"]["unlabeled"]
+        return acc
+
+    def increment(self, category: str, amount: int = 1) -> None:
+        index = CATEGORY_INDEX.get(category)
+        if index is None:
+            raise ValueError(f"unknown evaluation category: {category}")
+        self.counts[index] += amount
+
+    def merge(self, other: "StatsAccumulator") -> "StatsAccumulator":
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.labeled += other.labeled
+        self.unlabeled += other.unlabeled
+        return self
+
+    def subtract(self, other: "StatsAccumulator") -> "StatsAccumulator":
+        for index, count in enumerate(other.counts):
+            self.counts[index] -= count
+        self.labeled -= other.labeled
+        self.unlabeled -= other.unlabeled
+        return self
+
+    def is_zero(self) -> bool:
+        return not (any(self.counts) or self.labeled or self.unlabeled)
+
+    def is_negative(self) -> bool:
+        """增量合并后出现负数，说明保存的统计和增量对不上"""
+        return min(self.counts) < 0 or self.labeled < 0 or self.unlabeled < 0
 
-    @computed_field
     @property
     def total(self) -> int:
-        return self._total
+        return sum(self.counts)
 
-    @computed_field
-    @cached_property
+    @property
     def rates(self) -> dict[str, str]:
-        success_rate = round(self.SUCCESS / self.total * 100, 3) if self.total > 0 else 0
-        stt_rate = 100 - round(self.ERROR_STT / self.total * 100, 3) if self.total > 0 else 0
-        intent_rate = 100 - round(self.ERROR_INTENT / self.total * 100, 3) if self.total > 0 else 0
-        task_running_rate = 100 - round(self.ERROR_TASK_RUNNING / self.total *
-                                        100, 3) if self.total > 0 else 0
+        # 每次读取时计算，计数变化后不会过期
+        total = self.total
+        success, stt, intent, task_running = self.counts[:4]
+        success_rate = round(success / total * 100, 3) if total > 0 else 0
+        stt_rate = 100 - round(stt / total * 100, 3) if total > 0 else 0
+        intent_rate = 100 - round(intent / total * 100, 3) if total > 0 else 0
+        task_running_rate = 100 - round(task_running / total * 100, 3) if total > 0 else 0
         return {
             "SUCCESS": f"{success_rate}%",
             "SUCCESS_STT_RATE": f"{stt_rate}%",
@@ -124,90 +187,560 @@ class Counter(BaseModel):
             "SUCCESS_TASK_RUNNING_RATE": f"{task_running_rate}%",
         }
 
-    @computed_field
     @property
     def labels(self) -> dict[str, int]:
         return {
-            "labeled": self._labeled,
-            "unlabeled": self._unlabeled,
+            "labeled": self.labeled,
+            "unlabeled": self.unlabeled,
         }
 
+    def result(self) -> dict:
+        labels = self.labels
+        return {
+            "counts": dict(zip(CATEGORIES, self.counts), labels=labels),
+            "rates": self.rates,
+            "labels": labels,
+        }
+
+
+def count_doc(acc: StatsAccumulator, doc: dict) -> None:
+    evaluation = doc["evaluation"]["message_evaluation"]
+    if not evaluation:
+        acc.unlabeled += 1
+        return
+    acc.labeled += 1
+    for _, value in evaluation.items():
+        if value["__sys_message_type"] == "receive":
+            eval_result = value["intent"]
+            # `eval_result` is one of the following:
+            # - "ERROR_STT", "ERROR_INTENT", "ERROR_TASK_RUNNING", "ERROR_LANGUAGE",
+            # - "ERROR_TRANSLATE", "ERROR_LLM_ANSWER", "ERROR_UNKNOWN"
+            acc.increment(eval_result)
+            break
+
 
 def docs_stats(docs: List[dict]):
-    counter = Counter()
+    acc = StatsAccumulator()
     for doc in docs:
-        evaluation = doc["evaluation"]["message_evaluation"]
-        if not evaluation:
-            counter._unlabeled += 1
+        count_doc(acc, doc)
+    return acc.result()
+
+
+# message_evaluation 转成 [{"k": message_id, "v": evaluation}, ...]
+EVALUATIONS = {"$objectToArray": {"$ifNull": ["$evaluation.message_evaluation", {}]}}
+# 第一个 receive message 的标注结果，和 docs_stats 中的 break 对应
+RECEIVE_INTENT = {
+    "$arrayElemAt": [{
+        "$map": {
+            "input": {
+                "$filter": {
+                    "input": EVALUATIONS,
+                    "cond": {"$eq": ["$$this.v.__sys_message_type", "receive"]},
+                }
+            },
+            "in": "$$this.v.intent",
+        }
+    }, 0]
+}
+
+
+def accuracy_pipeline(query: dict, group_by: Optional[dict] = None) -> List[dict]:
+    """
+    docs_stats 的服务端版本，只返回 (是否标注, 标注结果) 的分组计数
+    group_by 为额外的分组字段，如 {"date": "custom.date"}
+    """
+    group_by = group_by or {}
+    return [
+        {"$match": query},
+        {"$project": {
+            "_id": 0,
+            **{name: f"${path}" for name, path in group_by.items()},
+            "labeled": {"$gt": [{"$size": EVALUATIONS}, 0]},
+            "intent": RECEIVE_INTENT,
+        }},
+        {"$group": {
+            "_id": {
+                **{name: f"${name}" for name in group_by},
+                "labeled": "$labeled",
+                "intent": "$intent",
+            },
+            "count": {"$sum": 1},
+        }},
+    ]
+
+
+def groups_stats(groups: List[dict]):
+    """把 accuracy_pipeline 的分组结果汇总成和 docs_stats 一样的结构"""
+    acc = StatsAccumulator()
+    for group in groups:
+        key, count = group["_id"], group["count"]
+        if not key["labeled"]:
+            acc.unlabeled += count
             continue
-        counter._labeled += 1
-        for _, value in evaluation.items():
-            if value["__sys_message_type"] == "receive":
-                eval_result = value["intent"]
-                # `eval_result` is one of the following:
-                # - "ERROR_STT", "ERROR_INTENT", "ERROR_TASK_RUNNING", "ERROR_LANGUAGE",
-                # - "ERROR_TRANSLATE", "ERROR_LLM_ANSWER", "ERROR_UNKNOWN"
-                counter.increment(eval_result)
-                break
-    result = {
-        "counts": counter.model_dump(exclude=["rates", "total"]),
-        "rates": counter.rates,
-        "labels": counter.labels,
+        acc.labeled += count
+        if key.get("intent"):
+            acc.increment(key["intent"], count)
+    return acc.result()
+
+
+# aggregate: 在 MongoDB 中分组计数；scan: 拉取文档后在 Python 中计数
+STATS_MODES = ("aggregate", "scan")
+
+
+def get_stats_mode(request: HttpRequest) -> str:
+    mode = request.GET.get("mode") or STATS_MODES[0]
+    if mode not in STATS_MODES:
+        raise HttpError(400, f"mode must be one of {', '.join(STATS_MODES)}")
+    return mode
+
+
+def get_field(doc: dict, path: str):
+    for part in path.split("."):
+        doc = doc.get(part) if isinstance(doc, dict) else None
+    return doc
+
+
+async def query_grouped_stats(query: dict,
+                              group_by: dict,
+                              mode: str = "aggregate",
+                              label: str = "",
+                              batch_size: Optional[int] = None) -> dict[tuple, dict]:
+    """一次查询按 group_by 分组统计，返回 {(分组值, ...): stats}，没有文档的分组不会出现"""
+    if mode == "aggregate":
+        groups = {}
+        for group in await mongo_client.aggregate(accuracy_pipeline(query, group_by)):
+            key = tuple(group["_id"].get(name) for name in group_by)
+            groups.setdefault(key, []).append(group)
+        return {key: groups_stats(items) for key, items in groups.items()}
+
+    accs = {}
+    projection = dict(ACCURACY_PROJECTION, **{path: 1 for path in group_by.values()})
+    async for doc in mongo_client.iter_find(query,
+                                            projection=projection,
+                                            batch_size=batch_size,
+                                            label=label):
+        key = tuple(get_field(doc, path) for path in group_by.values())
+        if key not in accs:
+            accs[key] = StatsAccumulator()
+        count_doc(accs[key], doc)
+    return {key: acc.result() for key, acc in accs.items()}
+
+
+def is_empty(stats: dict) -> bool:
+    return not (stats["labels"]["labeled"] or stats["labels"]["unlabeled"])
+
+
+def today(tz: Optional[str] = None) -> str:
+    """服务器时区（tz 为 None）或 tz 时区的今天"""
+    now = datetime.now(ZoneInfo(tz)) if tz else datetime.now()
+    return now.strftime("%Y-%m-%d")
+
+
+def get_week_start_date(date: str) -> str:
+    d = datetime.strptime(date, "%Y-%m-%d")
+    return (d - timedelta(days=d.weekday())).strftime("%Y-%m-%d")
+
+
+def get_week_end_date(week_start_date: str) -> str:
+    return (datetime.strptime(week_start_date, "%Y-%m-%d") + timedelta(days=7)).strftime("%Y-%m-%d")
+
+
+def get_dates(start_date: str, end_date: str) -> List[str]:
+    """[start_date, end_date] 之间的日期，倒序"""
+    dates, date = [], datetime.strptime(end_date, "%Y-%m-%d")
+    while date.strftime("%Y-%m-%d") >= start_date:
+        dates.append(date.strftime("%Y-%m-%d"))
+        date = date - timedelta(days=1)
+    return dates
+
+
+def get_week_dates(week_start_date: str) -> List[str]:
+    start = datetime.strptime(week_start_date, "%Y-%m-%d")
+    return [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
+
+
+def check_date(value: str, name: str = "date") -> str:
+    """日期必须是 YYYY-MM-DD，会保存到统计中，不能带多余的字符"""
+    try:
+        valid = datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d") == value
+    except ValueError:
+        valid = False
+    if not valid:
+        raise ValueError(f"{name} must be in the format YYYY-MM-DD")
+    return value
+
+
+def parse_params(model, request: HttpRequest):
+    """用查询参数构造请求模型，参数不合法时返回 400"""
+    try:
+        return model(**request.GET.dict())
+    except ValidationError as e:
+        raise HttpError(400, "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+                                       for error in e.errors()))
+
+
+def is_closed_date(date: str, tz: Optional[str] = None) -> bool:
+    """
+    当天和以后的数据还会增加，只有过去的日期才能保存统计结果
+    tz 为判断是否过去的时区，默认为服务器时区
+    """
+    return date < today(tz)
+
+
+def is_closed_week(week_start_date: str, tz: Optional[str] = None) -> bool:
+    return get_week_end_date(week_start_date) <= today(tz)
+
+
+def merge_stats(items: Iterable[dict]) -> dict:
+    """合并多个统计结果的计数，rates 按合并后的总数重新计算，而不是取平均"""
+    acc = StatsAccumulator()
+    for stats in items:
+        acc.merge(StatsAccumulator.from_stats(stats))
+    return acc.result()
+
+
+def rollup_stats(r) -> dict:
+    return {"counts": r.counts, "rates": r.rates, "labels": r.labels}
+
+
+ENV_MAX_LENGTH = models.DailyStats._meta.get_field("env").max_length
+
+
+async def rollup_start_date(env: str) -> Optional[str]:
+    """
+    保存统计之前检查 env：超过字段长度时返回 400；
+    返回 env 最早一周的开始日期，没有数据的 env（比如拼错的）返回 None，不保存它的统计
+    """
+    if len(env) > ENV_MAX_LENGTH:
+        raise HttpError(400, f"env must be at most {ENV_MAX_LENGTH} characters")
+    return await mongo_client.find_first_week_start_date(env=env)
+
+
+async def persistable(env: str, rollups: dict, key_date=lambda key: key) -> dict:
+    """rollups 中可以保存的统计：早于 env 最早一周的日期没有数据，不保存，避免很长的范围写入大量空统计"""
+    if not settings.STATS_ROLLUPS or not rollups:
+        return {}
+    start_date = await rollup_start_date(env)
+    if not start_date:
+        return {}
+    return {key: value for key, value in rollups.items() if key_date(key) >= start_date}
+
+
+def range_dates(start_date: str, end_date: str) -> List[str]:
+    """get_dates，超过 STATS_MAX_RANGE_DAYS 天的范围返回 400"""
+    span = (datetime.strptime(end_date, "%Y-%m-%d") -
+            datetime.strptime(start_date, "%Y-%m-%d")).days + 1
+    if span > settings.STATS_MAX_RANGE_DAYS:
+        raise HttpError(400, f"date range must be at most {settings.STATS_MAX_RANGE_DAYS} days")
+    return get_dates(start_date, end_date)
+
+
+async def daily_stats(env: str,
+                      dates: List[str],
+                      mode: str = "aggregate",
+                      label: str = "",
+                      tz: Optional[str] = None):
+    """
+    dates 中每一天的统计 {date: stats}，没有数据的日期也会返回（空统计）
+    已经结束的日期先读 DailyStats，缺失的一次查询补齐并保存；当天总是实时计算
+    tz 为判断日期是否结束的时区，默认为服务器时区
+    """
+    env, result = env or "", {}
+    if settings.STATS_ROLLUPS:
+        closed = [date for date in dates if is_closed_date(date, tz)]
+        for date, r in (await models.DailyStats.get_rollups(env, closed)).items():
+            result[date] = rollup_stats(r)
+    missing = [date for date in dates if date not in result]
+    if not missing:
+        return result
+    grouped = await query_grouped_stats(dates_query(missing, env), {"date": "custom.date"},
+                                        mode,
+                                        label=label)
+    computed = {date: grouped.get((date,)) or docs_stats([]) for date in missing}
+    closed = await persistable(
+        env, {date: stats for date, stats in computed.items() if is_closed_date(date, tz)})
+    if closed:
+        await models.DailyStats.save_rollups(env, closed)
+    result.update(computed)
+    return result
+
+
+async def weekly_stats(env: str,
+                       week_start_dates: List[str],
+                       mode: str = "aggregate",
+                       label: str = "",
+                       tz: Optional[str] = None):
+    """和 daily_stats 一样，按周统计 {week_start_date: stats}，已经结束的周先读 WeeklyStats"""
+    env, result = env or "", {}
+    if settings.STATS_ROLLUPS:
+        closed = [week for week in week_start_dates if is_closed_week(week, tz)]
+        for week, r in (await models.WeeklyStats.get_rollups(env, closed)).items():
+            result[week] = rollup_stats(r)
+    missing = [week for week in week_start_dates if week not in result]
+    if not missing:
+        return result
+    # 缺失的周由每天的统计合并而来，每天的统计同样优先读 DailyStats
+    days = {week: get_week_dates(week) for week in missing}
+    daily = await daily_stats(env, [date for dates in days.values() for date in dates], mode,
+                              label, tz)
+    computed = {week: merge_stats(daily[date] for date in dates) for week, dates in days.items()}
+    closed = await persistable(env, {
+        (week, get_week_end_date(week)): stats
+        for week, stats in computed.items() if is_closed_week(week, tz)
+    }, key_date=lambda key: key[0])
+    if closed:
+        await models.WeeklyStats.save_rollups(env, closed)
+    result.update(computed)
+    return result
+
+
+# 分组统计的维度和对应的字段
+DIMENSIONS = {
+    "language": "custom.language",
+    "client_type": "custom.client_type",
+    "provider": "custom.provider",
+    "detector": "custom.detector",
+    "model_version": "custom.output2.model_version",
+    # 模型预测的意图，即 NluData.output_intent
+    "output_intent": "custom.output2.intent",
+}
+
+
+def parse_dimensions(values: List[str]) -> List[tuple]:
+    """
+    ["language", "provider,model_version"] -> [("language",), ("provider", "model_version")]
+    逗号分隔的维度为交叉分组，维度按 DIMENSIONS 的顺序排列；没有指定时每个维度单独分组
+    """
+    slices = []
+    for value in values or DIMENSIONS:
+        names = {name.strip() for name in value.split(",") if name.strip()}
+        unknown = names - set(DIMENSIONS)
+        if unknown or not names:
+            raise HttpError(400, f"dimensions must be in {', '.join(DIMENSIONS)}")
+        dimensions = tuple(name for name in DIMENSIONS if name in names)
+        if dimensions not in slices:
+            slices.append(dimensions)
+    return slices
+
+
+def split_groups(grouped: dict, dimensions: List[str], dimension_slice: tuple,
+                 dates: List[str]) -> dict:
+    """
+    grouped 为按 (date, *dimensions) 分组的统计，合并成按 dimension_slice 分组的每日统计
+    返回 {date: {(维度值, ...): stats}}
+    """
+    indexes = [1 + dimensions.index(name) for name in dimension_slice]
+    days = {date: {} for date in dates}
+    for key, stats in grouped.items():
+        if key[0] in days:
+            days[key[0]].setdefault(tuple(key[i] for i in indexes), []).append(stats)
+    return {
+        date: {values: merge_stats(items) for values, items in groups.items()}
+        for date, groups in days.items()
     }
+
+
+async def breakdown_stats(env: str,
+                          dates: List[str],
+                          slices: List[tuple],
+                          mode: str = "aggregate",
+                          label: str = "",
+                          tz: Optional[str] = None) -> dict:
+    """
+    dates 内按每组维度分组的统计 {dimension_slice: {(维度值, ...): stats}}
+    已经结束的日期先读 BreakdownStats；缺失的日期和维度一次查询，按所有用到的维度和日期分组，
+    再在 Python 中合并成每组维度的结果并保存
+    """
+    env = env or ""
+    days = {dimension_slice: {} for dimension_slice in slices}
+    if settings.STATS_ROLLUPS:
+        closed = [date for date in dates if is_closed_date(date, tz)]
+        for dimension_slice in slices:
+            rollups = await models.BreakdownStats.get_rollups(env, ",".join(dimension_slice),
+                                                              closed)
+            for date, r in rollups.items():
+                days[dimension_slice][date] = {
+                    tuple(group["values"]): {
+                        key: group[key] for key in ("counts", "rates", "labels")
+                    } for group in r.groups
+                }
+    missing = {
+        dimension_slice: [date for date in dates if date not in days[dimension_slice]]
+        for dimension_slice in slices
+    }
+    missing_dates = sorted({date for items in missing.values() for date in items}, reverse=True)
+    if missing_dates:
+        # 只按缺少统计的维度组合用到的维度分组
+        used = {name for dimension_slice in slices if missing[dimension_slice]
+                for name in dimension_slice}
+        dimensions = [name for name in DIMENSIONS if name in used]
+        group_by = {"date": "custom.date", **{name: DIMENSIONS[name] for name in dimensions}}
+        grouped = await query_grouped_stats(dates_query(missing_dates, env), group_by, mode,
+                                            label=label)
+        for dimension_slice, dates_missing in missing.items():
+            if not dates_missing:
+                continue
+            computed = split_groups(grouped, dimensions, dimension_slice, dates_missing)
+            closed = await persistable(env, {
+                date: [{"values": list(values), **stats} for values, stats in groups.items()]
+                for date, groups in computed.items() if is_closed_date(date, tz)
+            })
+            if closed:
+                await models.BreakdownStats.save_rollups(env, ",".join(dimension_slice), closed)
+            days[dimension_slice].update(computed)
+
+    result = {}
+    for dimension_slice, per_day in days.items():
+        groups = {}
+        for day in per_day.values():
+            for values, stats in day.items():
+                groups.setdefault(values, []).append(stats)
+        result[dimension_slice] = {values: merge_stats(items) for values, items in groups.items()}
     return result
 
 
+async def invalidate_rollups(env: str, dates: List[str]) -> dict:
+    """标注修改后，让对应日期和所在周的统计失效，下次访问时重新计算"""
+    week_start_dates = sorted({get_week_start_date(date) for date in dates})
+    stats_cache.clear()
+    return {
+        "daily": await models.DailyStats.invalidate(env or "", dates),
+        "weekly": await models.WeeklyStats.invalidate(env or "", week_start_dates),
+        "breakdown": await models.BreakdownStats.invalidate(env or "", dates),
+        "latency": await models.LatencyStats.invalidate(env or "", dates),
+    }
+
+
+async def recompute_rollups(env: str, dates: List[str], mode: str = "aggregate",
+                            tz: Optional[str] = None) -> dict:
+    """让统计失效后立即重新计算每日和每周的统计，tz 为判断日期是否结束的时区"""
+    result = await invalidate_rollups(env, dates)
+    week_start_dates = sorted({get_week_start_date(date) for date in dates})
+    await daily_stats(env, dates, mode, label="recompute_rollups", tz=tz)
+    await weekly_stats(env, week_start_dates, mode, label="recompute_rollups", tz=tz)
+    return result
+
+
+stats_cache = ResultCache(settings.STATS_CACHE_SIZE)
+registry.collector(cache_collector("stats", stats_cache))
+
+
+def stats_cache_ttl(request: HttpRequest) -> float:
+    """结束日期已经过去的结果长时间缓存，包含当天的结果只缓存很短时间"""
+    end_date = request.GET.get("end_date") or request.GET.get("date") or today()
+    if is_closed_date(end_date):
+        return settings.STATS_CACHE_TTL
+    return settings.STATS_CACHE_TTL_OPEN
+
+
+def weekly_cache_ttl(request: HttpRequest) -> float:
+    # 过了零点可能有新的一周结束
+    tomorrow = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+    return min(settings.STATS_CACHE_TTL, (tomorrow - datetime.now()).total_seconds())
+
+
+async def dates_freshness(env: str, dates: List[str], rollup_version=None) -> tuple:
+    """
+    (max_age, version, complete)：全部是过去的日期时以保存的统计为版本（默认为每日统计），
+    包含当天时没有版本，只短时间缓存
+    """
+    if not dates or not all(is_closed_date(date) for date in dates):
+        return settings.STATS_CACHE_TTL_OPEN, None, False
+    if not settings.STATS_ROLLUPS:
+        return settings.STATS_HTTP_MAX_AGE, None, False
+    rollup_version = rollup_version or models.DailyStats.rollup_version
+    return (settings.STATS_HTTP_MAX_AGE, *await rollup_version(env or "", dates))
+
+
+async def daily_freshness(request: HttpRequest) -> tuple:
+    try:
+        req = DailyAccuracyRequest(**request.GET.dict())
+    except ValueError:
+        return 0, None, False
+    return await dates_freshness(req.env, [req.date] if req.date else [])
+
+
+async def range_freshness(request: HttpRequest) -> tuple:
+    """和 RangeAccuracyHandler/RangeDailyAccuracyHandler 统计相同的日期"""
+    try:
+        req = RangeAccuracyRequest(**request.GET.dict())
+        start_date = req.start_date
+        if request.path.endswith("range_daily_accuracy"):
+            start_date = min(req.start_date, req.end_date)
+        dates = range_dates(start_date, req.end_date)
+    except (ValueError, HttpError):
+        return 0, None, False
+    return await dates_freshness(req.env, dates)
+
+
+async def weekly_freshness(request: HttpRequest) -> tuple:
+    """结果只包含已经结束的周，以保存的每周统计和最近一周为版本，过了零点可能有新的一周结束"""
+    max_age = min(settings.STATS_HTTP_MAX_AGE, int(weekly_cache_ttl(request)))
+    if not settings.STATS_ROLLUPS:
+        return max_age, None, False
+    version, complete = await models.WeeklyStats.rollup_version(request.GET.get("env") or "")
+    last_week_start_date = get_week_start_date(today())
+    return max_age, f"{last_week_start_date}-{version}", complete
+
+
+class DailyAccuracyRequest(BaseModel):
+    env: Optional[str] = None
+    date: Optional[str] = ""
+
+    @field_validator("date")
+    def validate_date(cls, v):
+        return check_date(v) if v else v
+
+
+@conditional(daily_freshness)
+@cached(stats_cache, stats_cache_ttl, daily_freshness)
 async def DailyAccuracyHandler(request: HttpRequest):
     """每日的准确率"""
-    env = request.GET.get("env")
-    date = request.GET.get("date")
+    req = parse_params(DailyAccuracyRequest, request)
+    env, date = req.env, req.date
     if not date:
         raise HttpError(400, "date is required")
-    # 暂时不要缓存
-    # r = models.DailyStats.objects.filter(env=env, date=date).first()
-    # if r:
-    #     return OkResponse(data=results.DailyStats.model_validate(r))
-    docs = await mongo_client.find_by_date(date=date, env=env)
-    stats = docs_stats(docs)
+    stats = await daily_stats(env, [date], get_stats_mode(request), label="daily_accuracy")
     r = models.DailyStats(env=env,
                           date=date,
-                          counts=stats["counts"],
-                          rates=stats["rates"],
-                          labels=stats["labels"])
-    # r.save()
+                          counts=stats[date]["counts"],
+                          rates=stats[date]["rates"],
+                          labels=stats[date]["labels"])
     return results.DailyStats.model_validate(r)
 
 
+@conditional(weekly_freshness)
+@cached(stats_cache, weekly_cache_ttl, weekly_freshness)
 async def WeeklyAccuracyHandler(request: HttpRequest):
     """每周的准确率"""
     env = request.GET.get("env")
-    finished, result = 0, []
-    week_start_date = datetime.now() - timedelta(days=datetime.now().weekday())
-    while True:
+    mode = get_stats_mode(request)
+    # 从上周开始往前，遇到 5 个没有数据的周就停止
+    last_week_start_date = datetime.now() - timedelta(days=datetime.now().weekday() + 7)
+    first_week_start_date = await mongo_client.find_first_week_start_date(env=env)
+    if not first_week_start_date or first_week_start_date > last_week_start_date.strftime(
+            "%Y-%m-%d"):
+        return []
+    # 比最早一周还早的周都没有数据，不需要再查，所有周一次取出来
+    week_start_dates = []
+    week_start_date = last_week_start_date
+    while week_start_date.strftime("%Y-%m-%d") >= first_week_start_date:
+        week_start_dates.append(week_start_date.strftime("%Y-%m-%d"))
         week_start_date = week_start_date - timedelta(days=7)
-        # 暂时不要缓存
-        # r = models.WeeklyStats.objects.filter(
-        #     env=env,
-        #     week_start_date=week_start_date.strftime("%Y-%m-%d")).first()
-        # if r:
-        #     result.append(results.WeeklyStats.model_validate(r))
-        #     continue
-        docs = await mongo_client.find_by_week(
-            env=env, week_start_date=week_start_date.strftime("%Y-%m-%d"))
-        if not docs:
+    stats = await weekly_stats(env, week_start_dates, mode, label="weekly_accuracy")
+    finished, result = 0, []
+    for week_start_date in week_start_dates:
+        if is_empty(stats[week_start_date]):
             finished += 1
             if finished >= 5:
                 break
             continue
-        stats = docs_stats(docs)
         r = models.WeeklyStats(env=env,
-                               week_start_date=week_start_date.strftime("%Y-%m-%d"),
-                               week_end_date=(week_start_date +
-                                              timedelta(days=7)).strftime("%Y-%m-%d"),
-                               counts=stats["counts"],
-                               rates=stats["rates"],
-                               labels=stats["labels"])
-        # r.save()
+                               week_start_date=week_start_date,
+                               week_end_date=get_week_end_date(week_start_date),
+                               counts=stats[week_start_date]["counts"],
+                               rates=stats[week_start_date]["rates"],
+                               labels=stats[week_start_date]["labels"])
         result.append(results.WeeklyStats.model_validate(r))
     return result
 
@@ -235,65 +768,305 @@ class RangeAccuracyRequest(BaseModel):
         return v
 
 
+@conditional(range_freshness)
+@cached(stats_cache, stats_cache_ttl, range_freshness)
 async def RangeAccuracyHandler(request: HttpRequest):
     """范围的准确率"""
-    req = RangeAccuracyRequest(**request.GET)
+    req = parse_params(RangeAccuracyRequest, request)
     if not req.start_date or not req.end_date:
         # return FailedResponse(message="start_date and end_date are required")
         raise HttpError(400, "start_date and end_date are required")
-    docs = await mongo_client.find_by_range(req.start_date, req.end_date, env=req.env)
-    r = docs_stats(docs)
+    # 合并每天的统计，只有缺失的日期和当天需要查询 MongoDB
+    dates = range_dates(req.start_date, req.end_date)
+    stats = await daily_stats(req.env, dates, get_stats_mode(request), label="range_accuracy")
+    r = merge_stats(stats.values())
     r["start_date"] = req.start_date
     r["end_date"] = req.end_date
     return r
 
 
+@conditional(range_freshness)
+@cached(stats_cache, stats_cache_ttl, range_freshness)
 async def RangeDailyAccuracyHandler(request: HttpRequest):
     """范围的每日准确率"""
-    req = RangeAccuracyRequest(**request.GET)
+    req = parse_params(RangeAccuracyRequest, request)
     if not req.start_date or not req.end_date:
         # return FailedResponse(message="start_date and end_date are required")
         raise HttpError(400, "start_date and end_date are required")
 
+    # 结果按日期倒序，没有数据的日期不返回
+    # start_date 晚于 end_date 时只统计 end_date 当天
+    dates = range_dates(min(req.start_date, req.end_date), req.end_date)
+    stats = await daily_stats(req.env, dates, get_stats_mode(request), label="range_daily_accuracy")
     result = []
-    date = req.end_date
-    while True:
-        docs = await mongo_client.find_by_date(date=date, env=req.env)
-        if docs:
-            stats = docs_stats(docs)
-            r = models.DailyStats(env=req.env,
-                                  date=date,
-                                  counts=stats["counts"],
-                                  rates=stats["rates"],
-                                  labels=stats["labels"])
-            result.append(results.DailyStats.model_validate(r))
-        date = (datetime.strptime(date, "%Y-%m-%d") + timedelta(days=-1)).strftime("%Y-%m-%d")
-        if date < req.start_date:
-            break
+    for date in dates:
+        if is_empty(stats[date]):
+            continue
+        r = models.DailyStats(env=req.env,
+                              date=date,
+                              counts=stats[date]["counts"],
+                              rates=stats[date]["rates"],
+                              labels=stats[date]["labels"])
+        result.append(results.DailyStats.model_validate(r))
     return result
 
 
+async def slices_freshness(request: HttpRequest, slices: List[tuple]) -> tuple:
+    """分组统计的 (max_age, version, complete)，以保存的 BreakdownStats 为版本"""
+    try:
+        req = RangeAccuracyRequest(**request.GET.dict())
+        dates = range_dates(req.start_date, req.end_date)
+    except (ValueError, HttpError):
+        return 0, None, False
+    dimensions = [",".join(dimension_slice) for dimension_slice in slices]
+    return await dates_freshness(
+        req.env, dates,
+        lambda env, dates: models.BreakdownStats.rollup_version(env, dimensions, dates))
+
+
+async def breakdown_freshness(request: HttpRequest) -> tuple:
+    try:
+        slices = parse_dimensions(request.GET.getlist("dimensions"))
+    except HttpError:
+        return 0, None, False
+    return await slices_freshness(request, slices)
+
+
+@cached(stats_cache, stats_cache_ttl, breakdown_freshness)
+async def BreakdownHandler(request: HttpRequest):
+    """
+    范围内按维度分组的准确率，dimensions 可以指定多次，逗号分隔的维度为交叉分组，
+    如 dimensions=language&dimensions=provider,model_version；所有分组一次查询得到
+    """
+    req = parse_params(RangeAccuracyRequest, request)
+    slices = parse_dimensions(request.GET.getlist("dimensions"))
+    dates = range_dates(req.start_date, req.end_date)
+    stats = await breakdown_stats(req.env, dates, slices, get_stats_mode(request),
+                                  label="breakdown")
+    breakdowns = []
+    for dimension_slice in slices:
+        # 标注数多的分组在前
+        groups = sorted(stats[dimension_slice].items(),
+                        key=lambda item: (-item[1]["labels"]["labeled"], str(item[0])))
+        breakdowns.append({
+            "dimensions": list(dimension_slice),
+            "groups": [{"values": dict(zip(dimension_slice, values)), **s} for values, s in groups],
+        })
+    return results.BreakdownStats(env=req.env,
+                                  start_date=req.start_date,
+                                  end_date=req.end_date,
+                                  breakdowns=breakdowns)
+
+
+ERROR_CATEGORIES = tuple(category for category in CATEGORIES if category.startswith("ERROR_"))
+INTENT_SLICE = ("output_intent",)
+
+
+def intent_errors(values: tuple, stats: dict) -> dict:
+    counts = stats["counts"]
+    return {
+        "output_intent": values[0],
+        "labeled": stats["labels"]["labeled"],
+        "errors": sum(counts[category] for category in ERROR_CATEGORIES),
+        "counts": {category: counts[category] for category in ERROR_CATEGORIES},
+        "success_rate": stats["rates"]["SUCCESS"],
+    }
+
+
+async def intent_errors_freshness(request: HttpRequest) -> tuple:
+    return await slices_freshness(request, [INTENT_SLICE])
+
+
+@cached(stats_cache, stats_cache_ttl, intent_errors_freshness)
+async def IntentErrorsHandler(request: HttpRequest):
+    """
+    范围内每个预测意图 (output_intent) 的各类错误数和成功率，按错误数倒序取前 top_k 个
+    和 breakdown 的 dimensions=output_intent 共用一次分组查询和保存的每日统计
+    """
+    req = parse_params(RangeAccuracyRequest, request)
+    try:
+        top_k = int(request.GET.get("top_k") or 10)
+    except ValueError:
+        raise HttpError(400, "top_k must be an integer")
+    dates = range_dates(req.start_date, req.end_date)
+    stats = await breakdown_stats(req.env, dates, [INTENT_SLICE], get_stats_mode(request),
+                                  label="intent_errors")
+    items = [intent_errors(values, s) for values, s in stats[INTENT_SLICE].items()]
+    items.sort(key=lambda item: (-item["errors"], -item["labeled"], str(item["output_intent"])))
+    return {
+        "env": req.env,
+        "start_date": req.start_date,
+        "end_date": req.end_date,
+        "intents": len(items),
+        "items": items[:top_k] if top_k > 0 else items,
+    }
+
+
+class InvalidateRollupsRequest(BaseModel):
+    env: Optional[str] = ""
+    dates: List[str]
+    recompute: bool = False
+
+
+async def InvalidateRollupsHandler(request: HttpRequest, payload: InvalidateRollupsRequest):
+    """标注修改后让对应日期（和所在周）的统计失效，recompute 为 true 时立即重新计算"""
+    # 在这里校验日期，和查询参数一样返回 400（请求体校验失败时 ninja 返回 422）
+    try:
+        for date in payload.dates:
+            check_date(date, "dates")
+    except ValueError as e:
+        raise HttpError(400, str(e))
+    if payload.recompute:
+        return await recompute_rollups(payload.env, payload.dates, get_stats_mode(request))
+    return await invalidate_rollups(payload.env, payload.dates)
+
+
+async def CacheStatsHandler(request: HttpRequest):
+    """统计接口的缓存命中情况"""
+    return stats_cache.stats()
+
+
+def receive_intent(doc: dict) -> Optional[str]:
+    """receive message 的标注结果，没有标注时返回 None"""
+    for _, value in (doc["evaluation"]["message_evaluation"] or {}).items():
+        if value["__sys_message_type"] == "receive":
+            # one of the following:
+            # - "ERROR_STT", "ERROR_INTENT", "ERROR_TASK_RUNNING", "ERROR_LANGUAGE",
+            # - "ERROR_TRANSLATE", "ERROR_LLM_ANSWER", "ERROR_UNKNOWN"
+            return value["intent"]
+    return None
+
+
+# 按 NluData 的字段生成 TypedDict，校验后直接得到 dict，省去构造模型再 model_dump
+NLU_DATA_ROWS = TypeAdapter(List[TypedDict("NluDataRow", {
+    name: field.annotation if field.is_required() else NotRequired[field.annotation]
+    for name, field in NluData.model_fields.items()
+})])
+NLU_DATA_DEFAULTS = {
+    name: field.default for name, field in NluData.model_fields.items() if not field.is_required()
+}
+
+
+def error_rows(docs: List[dict]) -> List[dict]:
+    """一次校验整批数据，结果（包括字段顺序）与逐条 NluData(**custom).model_dump() 相同"""
+    rows = []
+    for r, doc in zip(NLU_DATA_ROWS.validate_python([doc["custom"] for doc in docs]), docs):
+        # 按 NluData 的字段顺序重新组装，缺少的字段（如 env/user_id）填默认值
+        row = {name: r[name] if name in r else NLU_DATA_DEFAULTS[name]
+               for name in NluData.model_fields}
+        row["output_intent"] = row["output2"]["intent"]
+        eval_result = receive_intent(doc)
+        if eval_result is not None:
+            row["label_type"] = eval_result
+        rows.append(row)
+    return rows
+
+
+def encode_cursor(doc: dict) -> str:
+    value = json.dumps([doc["custom"]["start_time"], str(doc["_id"])])
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Optional[tuple]:
+    if not cursor:
+        return None
+    try:
+        start_time, _id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HttpError(400, "invalid cursor")
+    return start_time, ObjectId(_id) if ObjectId.is_valid(_id) else _id
+
+
+class ListErrorsRequest(BaseModel):
+    env: Optional[str] = ""
+    date: Optional[str] = ""
+    label_type: Optional[str] = ""
+    language: Optional[str] = ""
+    client_type: Optional[str] = ""
+    provider: Optional[str] = ""
+    # json: 分页返回；ndjson: 流式返回全部（或 limit 条）数据，每行一条
+    format: str = "json"
+    limit: int = Field(default=0, ge=0)
+    cursor: Optional[str] = ""
+
+    @field_validator("format")
+    def validate_format(cls, v):
+        if v not in ("json", "ndjson"):
+            raise ValueError("format must be json or ndjson")
+        return v
+
+    @field_validator("label_type")
+    def validate_label_type(cls, v):
+        if v and v not in CATEGORY_INDEX:
+            raise ValueError(f"label_type must be one of {', '.join(CATEGORIES)}")
+        return v
+
+    def query(self) -> dict:
+        # 没有标注的数据直接在 MongoDB 中过滤掉
+        query = errors_query(self.env,
+                             self.date,
+                             labeled=True,
+                             language=self.language,
+                             client_type=self.client_type,
+                             provider=self.provider)
+        if self.label_type:
+            query["$expr"] = {"$eq": [RECEIVE_INTENT, self.label_type]}
+        return query
+
+
+LIST_ERRORS_LIMIT = 100
+LIST_ERRORS_MAX_LIMIT = 1000
+# ndjson 每次写出的行数
+NDJSON_CHUNK_ROWS = 200
+
+
+async def ndjson_rows(docs: AsyncIterator[dict], compress: bool = False):
+    """把游标中的文档逐批转换成 NDJSON，compress 时边生成边 gzip 压缩"""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    batch = []
+    async for doc in docs:
+        batch.append(doc)
+        if len(batch) >= NDJSON_CHUNK_ROWS:
+            chunk = b"".join(dumps(r) + b"\n" for r in error_rows(batch))
+            batch = []
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    chunk = b"".join(dumps(r) + b"\n" for r in error_rows(batch))
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
 async def ListErrorsHandler(request: HttpRequest):
-    """列出所有错误"""
-    env = request.GET.get("env")
-    date = request.GET.get("date")
-    docs = await mongo_client.find_errors(env=env, date=date)
-    result = []
-    for doc in docs:
-        r = NluData(**doc["custom"]).model_dump()
-        evaluation = doc["evaluation"]["message_evaluation"]
-        if not evaluation:
-            # 没有标注
-            # r["label_type"] = ""
-            # result.append(r)
-            continue
-        for _, value in evaluation.items():
-            if value["__sys_message_type"] == "receive":
-                eval_result = value["intent"]
-                # `eval_result` is one of the following:
-                # - "ERROR_STT", "ERROR_INTENT", "ERROR_TASK_RUNNING", "ERROR_LANGUAGE",
-                # - "ERROR_TRANSLATE", "ERROR_LLM_ANSWER", "ERROR_UNKNOWN"
-                r["label_type"] = eval_result
-                break
-        result.append(r)
-    return result
+    """
+    列出所有错误，按 start_time 倒序
+    format=json 时分页返回，next_cursor 为空表示没有下一页
+    format=ndjson 时直接从游标流式返回，客户端支持时 gzip 压缩
+    """
+    req = parse_params(ListErrorsRequest, request)
+    after = decode_cursor(req.cursor)
+    if req.format == "ndjson":
+        docs = mongo_client.iter_errors(req.query(),
+                                        projection=LIST_ERRORS_PROJECTION,
+                                        after=after,
+                                        limit=req.limit,
+                                        max_time_ms=settings.MONGO_EXPORT_MAX_TIME_MS)
+        compress = "gzip" in request.headers.get("Accept-Encoding", "")
+        response = StreamingHttpResponse(ndjson_rows(docs, compress),
+                                         content_type="application/x-ndjson")
+        response["Vary"] = "Accept-Encoding"
+        if compress:
+            response["Content-Encoding"] = "gzip"
+        return response
+
+    limit = min(req.limit or LIST_ERRORS_LIMIT, LIST_ERRORS_MAX_LIMIT)
+    # 多取一条判断是否还有下一页
+    docs = await mongo_client.find_errors(query=req.query(),
+                                          projection=LIST_ERRORS_PROJECTION,
+                                          after=after,
+                                          limit=limit + 1)
+    items = error_rows(docs[:limit])
+    next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
@@ -0,0 +1,66 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main import benchmarks
+from main.benchmarks import dataset, render, stats
+
+SUITES = {
+    "stats": stats.run,
+    "render": render.run,
+}
+
+
+class Command(BaseCommand):
+    help = "用生成的数据运行性能基准测试，可保存结果并和之前的结果对比"
+
+    def add_arguments(self, parser):
+        parser.add_argument("suites", nargs="*", help=f"{', '.join(SUITES)}，默认全部运行")
+        parser.add_argument("--size", default="10k", choices=list(dataset.SIZES))
+        parser.add_argument("--rows", type=int, help="文档数，指定后忽略 --size")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--save", action="store_true",
+                            help="保存到 settings.BENCHMARK_RESULTS_DIR")
+        parser.add_argument("--compare", help="之前保存的结果文件，耗时退化时命令失败")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="耗时超过对比结果的 (1 + threshold) 倍视为退化")
+
+    def handle(self, *args, **options):
+        unknown = [name for name in options["suites"] if name not in SUITES]
+        if unknown:
+            raise CommandError(f"Unknown suites: {', '.join(unknown)} "
+                               f"(choose from {', '.join(SUITES)})")
+        rows = options["rows"] or dataset.SIZES[options["size"]]
+        start = time.perf_counter()
+        docs = dataset.make_docs(rows, options["seed"])
+        self.stdout.write(f"Generated {rows} documents in {time.perf_counter() - start:.1f}s")
+
+        results = {}
+        for name in options["suites"] or SUITES:
+            for case, stats in SUITES[name](docs, options["repeat"]).items():
+                results[f"{name}.{case}"] = stats
+                self.stdout.write(f"{name}.{case}: {json.dumps(stats)}")
+        current = {"rows": rows, "seed": options["seed"], "results": results}
+
+        if options["save"]:
+            name = options["size"] if not options["rows"] else str(rows)
+            path = benchmarks.save(current, settings.BENCHMARK_RESULTS_DIR, name)
+            self.stdout.write(f"Saved to {path}")
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+            if baseline["rows"] != rows:
+                self.stderr.write(f"Baseline has {baseline['rows']} rows, current run has {rows}")
+            regressions = []
+            for case, before, after, ratio, regressed in benchmarks.compare(
+                    current, baseline, options["threshold"]):
+                self.stdout.write(f"{case}: {before:.6f}s -> {after:.6f}s ({ratio:.2f}x)"
+                                  f"{' REGRESSION' if regressed else ''}")
+                if regressed:
+                    regressions.append(case)
+            if regressions:
+                raise CommandError(f"Regressions: {', '.join(regressions)}")
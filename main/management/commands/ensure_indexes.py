@@ -0,0 +1,32 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.utils.mongo import INDEXES, mongo_client, query_shapes
+
+
+class Command(BaseCommand):
+    help = "创建 MongoDB 索引，并用 explain 检查所有查询都走索引"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--collection", default="Data", choices=list(INDEXES))
+        parser.add_argument("--check-only", action="store_true", help="只检查，不创建索引")
+
+    def handle(self, *args, **options):
+        collection_name = options["collection"]
+        collscans = asyncio.run(self.run(collection_name, options["check_only"]))
+        if collscans:
+            raise CommandError(f"COLLSCAN in {collection_name}: {', '.join(collscans)}")
+        self.stdout.write(self.style.SUCCESS("All queries use an index"))
+
+    async def run(self, collection_name: str, check_only: bool) -> list:
+        if not check_only:
+            names = await mongo_client.ensure_indexes(collection_name)
+            self.stdout.write(f"Indexes: {', '.join(names)}")
+        collscans = []
+        for name, query, sort in query_shapes():
+            stages = await mongo_client.explain(query, collection_name, sort=sort)
+            self.stdout.write(f"{name}: {' <- '.join(stages)}")
+            if "COLLSCAN" in stages:
+                collscans.append(name)
+        return collscans
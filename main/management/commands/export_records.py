@@ -0,0 +1,35 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from main.handlers.export import ExportRequest, export_records
+
+
+class Command(BaseCommand):
+    help = "导出 NLU 记录到 parquet/arrow/csv 文件"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="输出文件路径")
+        parser.add_argument("--env", default="")
+        parser.add_argument("--date", default="", help="只导出这一天")
+        parser.add_argument("--start-date", help="YYYY-MM-DD，默认 30 天前")
+        parser.add_argument("--end-date", help="YYYY-MM-DD，默认今天")
+        parser.add_argument("--format", default="parquet", choices=["parquet", "arrow", "csv"])
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        params = {
+            "env": options["env"],
+            "date": options["date"],
+            "format": options["format"],
+            "batch_size": options["batch_size"],
+        }
+        if options["start_date"]:
+            params["start_date"] = options["start_date"]
+        if options["end_date"]:
+            params["end_date"] = options["end_date"]
+        req = ExportRequest(**params)
+        with open(options["output"], "wb") as fileobj:
+            result = asyncio.run(export_records(req, fileobj))
+        self.stdout.write(f"{result['rows']} rows ({result['format']}) in {result['seconds']}s, "
+                          f"{result['rows_per_second']} rows/s")
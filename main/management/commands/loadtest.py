@@ -0,0 +1,76 @@
+import json
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main import benchmarks
+from main.benchmarks import dataset, load
+
+
+class Command(BaseCommand):
+    help = "离线压测 ASGI 应用：MongoDB 换成内存数据，统计各接口的延迟分位数、吞吐和错误率"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", default="10k", choices=list(dataset.SIZES))
+        parser.add_argument("--rows", type=int, help="文档数，指定后忽略 --size")
+        parser.add_argument("--days", type=int, default=28, help="数据覆盖到今天为止的天数")
+        parser.add_argument("--clients", type=int, default=50)
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--mix", help="接口及权重，如 daily_accuracy=3,list_errors=1")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--no-cache", action="store_true", help="关闭统计接口的结果缓存")
+        parser.add_argument("--rollups", action="store_true",
+                            help="读写 DailyStats/WeeklyStats，需要可用的数据库")
+        parser.add_argument("--save", action="store_true",
+                            help="保存到 settings.BENCHMARK_RESULTS_DIR")
+        parser.add_argument("--max-p99", type=float, help="任一接口 p99（毫秒）超过时命令失败")
+        parser.add_argument("--max-error-rate", type=float, default=0,
+                            help="任一接口错误率超过时命令失败")
+
+    def handle(self, *args, **options):
+        from llm_reports.asgi import application
+
+        try:
+            mix = load.parse_mix(options["mix"]) if options["mix"] else load.DEFAULT_MIX
+        except ValueError as e:
+            raise CommandError(str(e))
+        rows = options["rows"] or dataset.SIZES[options["size"]]
+        dates = load.recent_dates(options["days"])
+        docs = dataset.make_docs(rows, options["seed"], start_date=dates[0], days=len(dates))
+        self.stdout.write(f"{rows} documents, {options['clients']} clients, "
+                          f"{options['requests']} requests")
+
+        with load.memory_backend(docs, cache=not options["no_cache"], rollups=options["rollups"]):
+            report = asyncio.run(
+                load.run(application,
+                         dates,
+                         mix,
+                         clients=options["clients"],
+                         requests=options["requests"],
+                         seed=options["seed"]))
+
+        self.stdout.write(f"{'endpoint':<22}{'requests':>9}{'errors':>8}{'rps':>9}"
+                          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for name, r in report.items():
+            self.stdout.write(f"{name:<22}{r['requests']:>9}{r['errors']:>8}{r['rps']:>9}"
+                              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+        if options["save"]:
+            path = benchmarks.save({
+                "rows": rows,
+                "seed": options["seed"],
+                "clients": options["clients"],
+                "mix": mix,
+                "report": report,
+            }, settings.BENCHMARK_RESULTS_DIR, f"load-{options['clients']}")
+            self.stdout.write(f"Saved to {path}")
+
+        failures = []
+        for name, r in report.items():
+            if r["error_rate"] > options["max_error_rate"]:
+                failures.append(f"{name} error rate {r['error_rate']}")
+            if options["max_p99"] is not None and r["p99_ms"] > options["max_p99"]:
+                failures.append(f"{name} p99 {r['p99_ms']}ms")
+        if failures:
+            raise CommandError(json.dumps(failures))
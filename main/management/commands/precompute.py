@@ -0,0 +1,37 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from main.handlers.precompute import Precomputer
+
+
+class Command(BaseCommand):
+    help = "补齐过去日期/周的 DailyStats/WeeklyStats，--serve 时之后每天零点后计算昨天的统计"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--env", action="append", dest="envs",
+                            help="可以指定多次，默认为 settings.PRECOMPUTE_ENVS；\"\" 为全部环境")
+        parser.add_argument("--days", type=int, default=0, help="从昨天往前补齐的天数")
+        parser.add_argument("--concurrency", type=int, default=0)
+        parser.add_argument("--restart", action="store_true", help="忽略上次的进度，从昨天重新开始")
+        parser.add_argument("--serve", action="store_true", help="补齐后继续运行，定时滚动")
+
+    def handle(self, *args, **options):
+        precomputer = Precomputer(envs=options["envs"],
+                                  days=options["days"],
+                                  concurrency=options["concurrency"],
+                                  progress=self.progress)
+        if options["serve"]:
+            asyncio.run(self.serve(precomputer, options["restart"]))
+            return
+        computed = asyncio.run(precomputer.backfill(restart=options["restart"]))
+        for env, days in computed.items():
+            self.stdout.write(f"{env or '(all)'}: {days} days computed")
+
+    async def serve(self, precomputer: Precomputer, restart: bool):
+        await precomputer.backfill(restart=restart)
+        # 结果缓存在进程内，在这里预热对 web worker 没有用
+        await precomputer.run(backfill=False, warm=False)
+
+    def progress(self, env: str, done: int, total: int, seconds: float):
+        self.stdout.write(f"{env or '(all)'}: {done}/{total} weeks ({seconds:.1f}s)")
@@ -0,0 +1,23 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from main.handlers.rollups import SYNC_MODES, RollupMaintainer
+
+
+class Command(BaseCommand):
+    help = "按 Data 的变更增量更新 DailyStats/WeeklyStats"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mode", default="", choices=["", *SYNC_MODES],
+                            help="默认为 settings.ROLLUP_SYNC_MODE")
+        parser.add_argument("--batch-size", type=int, default=0)
+        parser.add_argument("--interval", type=int, default=0, help="没有变更时的等待秒数")
+        parser.add_argument("--once", action="store_true", help="处理完当前积压的变更后退出")
+
+    def handle(self, *args, **options):
+        maintainer = RollupMaintainer(mode=options["mode"],
+                                      batch_size=options["batch_size"],
+                                      interval=options["interval"])
+        processed = asyncio.run(maintainer.run(once=options["once"]))
+        self.stdout.write(f"{processed} changes processed")
@@ -1,12 +1,31 @@
 import time
+import random
 import logging
 import json
 
+from django.conf import settings
 from django.http import HttpRequest
 from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 
+from main.utils.metrics import IN_FLIGHT, REQUEST_SECONDS, REQUESTS, RESPONSE_BYTES
+
 logger = logging.getLogger(__name__)
 
+
+def get_route(request: HttpRequest) -> str:
+    """用 URL 的路由而不是实际路径作为指标的 label，避免 label 数量无限增长"""
+    match = getattr(request, "resolver_match", None)
+    return match.route if match else "unmatched"
+
+
+def should_log(duration: float, status_code: int) -> bool:
+    """慢请求和服务端错误总是记录，其余请求按 REQUEST_LOG_SAMPLE_RATE 采样"""
+    if status_code >= 500 or duration >= settings.REQUEST_LOG_SLOW_SECONDS:
+        return True
+    rate = settings.REQUEST_LOG_SAMPLE_RATE
+    return rate >= 1 or random.random() < rate
+
+
 class RequestTimerMiddleware:
     async_capable = True
     sync_capable = False
@@ -18,22 +37,32 @@ class RequestTimerMiddleware:
 
     async def __call__(self, request: HttpRequest):
         # 记录开始时间
-        start_time = time.time()
-
-        # 获取 GET 参数
-        query_params = dict(request.GET.items())
+        start_time = time.perf_counter()
 
         # 处理请求
-        response = await self.get_response(request)
+        IN_FLIGHT.inc()
+        try:
+            response = await self.get_response(request)
+        finally:
+            IN_FLIGHT.dec()
 
         # 计算耗时
-        duration = time.time() - start_time
+        duration = time.perf_counter() - start_time
+
+        # 按路由统计请求数、耗时和响应大小
+        route, method = get_route(request), request.method
+        REQUESTS.inc(route, method, str(response.status_code))
+        REQUEST_SECONDS.observe(duration, route, method)
+        if not response.streaming:
+            RESPONSE_BYTES.observe(len(response.content), route, method)
 
         # 记录请求路径、参数和耗时
-        logger.info(
-            f"Path: {request.path} | "
-            f"Query: {json.dumps(query_params, ensure_ascii=False)} | "
-            f"Duration: {duration:.3f}s"
-        )
+        if should_log(duration, response.status_code):
+            logger.info(
+                f"Path: {request.path} | "
+                f"Query: {json.dumps(dict(request.GET.items()), ensure_ascii=False)} | "
+                f"Status: {response.status_code} | "
+                f"Duration: {duration:.3f}s"
+            )
 
         return response
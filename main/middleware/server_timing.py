@@ -0,0 +1,41 @@
+import time
+import logging
+
+from django.conf import settings
+from django.http import HttpRequest
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from main.utils.timing import RequestTiming, current_timing
+
+logger = logging.getLogger(__name__)
+
+
+class ServerTimingMiddleware:
+    """
+    为每个请求创建 RequestTiming，响应中加上 Server-Timing 头，并检查 MongoDB 命令数是否超出预算
+    流式响应在发送响应头之后才执行的查询不会计入
+    """
+    async_capable = True
+    sync_capable = False
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    async def __call__(self, request: HttpRequest):
+        start_time = time.perf_counter()
+        timing = RequestTiming()
+        token = current_timing.set(timing)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timing.reset(token)
+        response["Server-Timing"] = timing.server_timing(time.perf_counter() - start_time)
+
+        budget = settings.MONGO_QUERY_BUDGET
+        if budget and timing.queries > budget:
+            logger.warning(f"Query budget exceeded: {request.path} | "
+                           f"Queries: {timing.queries} | "
+                           f"Budget: {budget}")
+        return response
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.5 on 2026-10-17 02:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0002_dailystats"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="dailystats",
+            constraint=models.UniqueConstraint(
+                fields=("env", "date"), name="daily_stats_env_date"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="weeklystats",
+            constraint=models.UniqueConstraint(
+                fields=("env", "week_start_date"),
+                name="weekly_stats_env_week_start_date",
+            ),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.5 on 2026-10-17 01:35
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0003_stats_rollup_constraints"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Checkpoint",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("created", models.DateTimeField(default=django.utils.timezone.now)),
+                ("updated", models.DateTimeField(default=django.utils.timezone.now)),
+                ("status", models.BooleanField(default=True)),
+                ("name", models.CharField(max_length=64, unique=True)),
+                ("value", models.JSONField(null=True)),
+            ],
+            options={
+                "verbose_name": "任务进度",
+                "verbose_name_plural": "任务进度",
+                "db_table": "checkpoint",
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.5 on 2026-10-17 01:39
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0004_checkpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BreakdownStats",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("created", models.DateTimeField(default=django.utils.timezone.now)),
+                ("updated", models.DateTimeField(default=django.utils.timezone.now)),
+                ("status", models.BooleanField(default=True)),
+                ("env", models.CharField(max_length=10)),
+                ("date", models.CharField(max_length=20)),
+                ("dimensions", models.CharField(max_length=100)),
+                ("groups", models.JSONField()),
+            ],
+            options={
+                "verbose_name": "分组统计",
+                "verbose_name_plural": "分组统计",
+                "db_table": "breakdown_stats",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("env", "date", "dimensions"),
+                        name="breakdown_stats_env_date_dimensions",
+                    )
+                ],
+            },
+        ),
+    ]
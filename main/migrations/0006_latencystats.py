@@ -0,0 +1,36 @@
+# Generated by Django 5.1.5 on 2026-10-17 01:41
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0005_breakdownstats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LatencyStats",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("created", models.DateTimeField(default=django.utils.timezone.now)),
+                ("updated", models.DateTimeField(default=django.utils.timezone.now)),
+                ("status", models.BooleanField(default=True)),
+                ("env", models.CharField(max_length=10)),
+                ("date", models.CharField(max_length=20)),
+                ("groups", models.JSONField()),
+            ],
+            options={
+                "verbose_name": "耗时统计",
+                "verbose_name_plural": "耗时统计",
+                "db_table": "latency_stats",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("env", "date"), name="latency_stats_env_date"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -1,2 +1,5 @@
+from main.models.breakdown import BreakdownStats
+from main.models.checkpoint import Checkpoint
 from main.models.daily import DailyStats
+from main.models.latency import LatencyStats
 from main.models.weekly import WeeklyStats
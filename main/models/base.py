@@ -1,4 +1,7 @@
-from django.db import models
+from typing import Tuple
+
+from django.db import connections, models, router
+from django.db.models import Count, Max, Q
 from django.utils import timezone
 from django.forms.models import model_to_dict
 
@@ -15,3 +18,29 @@ class BaseModel(models.Model):
     @classmethod
     async def get_by_uid(cls, uid):
         return await cls.objects.filter(uid=uid, status=True).afirst()
+
+    @classmethod
+    async def filter_version(cls, expected: int, **filters) -> Tuple[str, bool]:
+        """
+        filters 匹配的记录的版本 "<有效条数>-<总条数>-<最后更新时间>"，和有效的记录是否至少有 expected 条
+        失效的记录也计入版本：记录保存、覆盖或失效后版本都会变化，可以作为结果缓存和 ETag 的版本
+        """
+        r = await cls.objects.filter(**filters).aaggregate(valid=Count("id", filter=Q(status=True)),
+                                                           total=Count("id"),
+                                                           updated=Max("updated"))
+        updated = r["updated"].timestamp() if r["updated"] else 0
+        return f"{r['valid']}-{r['total']}-{updated}", r["valid"] >= expected
+
+    @classmethod
+    async def abulk_upsert(cls, objs: list, unique_fields: list, update_fields: list) -> list:
+        """
+        按唯一约束插入或覆盖
+        MySQL 的 ON DUPLICATE KEY UPDATE 由唯一约束决定冲突，不能（也不需要）指定 unique_fields
+        """
+        features = connections[router.db_for_write(cls)].features
+        return await cls.objects.abulk_create(
+            objs,
+            update_conflicts=True,
+            unique_fields=unique_fields if features.supports_update_conflicts_with_target else None,
+            update_fields=update_fields,
+        )
@@ -0,0 +1,62 @@
+from typing import Tuple
+
+from django.db import models
+from django.utils import timezone
+
+from main.models.base import BaseModel
+
+
+class BreakdownStats(BaseModel):
+    """按维度分组的每日统计，dimensions 为逗号分隔的维度，groups 为 [{"values": [...], counts, rates, labels}]"""
+    env = models.CharField(max_length=10)
+    date = models.CharField(max_length=20)
+    dimensions = models.CharField(max_length=100)
+    groups = models.JSONField()
+
+    class Meta:
+        db_table = "breakdown_stats"
+        verbose_name = "分组统计"
+        verbose_name_plural = "分组统计"
+        constraints = [
+            models.UniqueConstraint(fields=["env", "date", "dimensions"],
+                                    name="breakdown_stats_env_date_dimensions"),
+        ]
+
+    @classmethod
+    async def get_rollups(cls, env: str, dimensions: str, dates: list) -> dict:
+        """{date: BreakdownStats}，失效的不返回"""
+        return {
+            r.date: r async for r in cls.objects.filter(
+                env=env, dimensions=dimensions, date__in=dates, status=True)
+        }
+
+    @classmethod
+    async def save_rollups(cls, env: str, dimensions: str, groups: dict) -> None:
+        """groups 为 {date: [{"values": [...], counts, rates, labels}]}，已存在的记录直接覆盖"""
+        now = timezone.now()
+        await cls.abulk_upsert(
+            [
+                cls(env=env,
+                    date=date,
+                    dimensions=dimensions,
+                    groups=items,
+                    status=True,
+                    updated=now) for date, items in groups.items()
+            ],
+            unique_fields=["env", "date", "dimensions"],
+            update_fields=["groups", "status", "updated"],
+        )
+
+    @classmethod
+    async def rollup_version(cls, env: str, dimensions: list, dates: list) -> Tuple[str, bool]:
+        """每组维度在 dates 中的统计的版本，和是否全部有有效的统计"""
+        return await cls.filter_version(len(set(dimensions)) * len(set(dates)),
+                                        env=env,
+                                        dimensions__in=dimensions,
+                                        date__in=dates)
+
+    @classmethod
+    async def invalidate(cls, env: str, dates: list) -> int:
+        # 所有维度组合的统计都失效
+        return await cls.objects.filter(env__in={env, ""}, date__in=dates).aupdate(
+            status=False, updated=timezone.now())
@@ -0,0 +1,33 @@
+from django.db import models
+from django.utils import timezone
+
+from main.models.base import BaseModel
+
+
+class Checkpoint(BaseModel):
+    """后台任务的进度（如 change stream 的 resume token），重启后从这里继续"""
+    name = models.CharField(max_length=64, unique=True)
+    value = models.JSONField(null=True)
+
+    class Meta:
+        db_table = "checkpoint"
+        verbose_name = "任务进度"
+        verbose_name_plural = "任务进度"
+
+    @classmethod
+    async def get_value(cls, name: str, default=None):
+        r = await cls.objects.filter(name=name, status=True).afirst()
+        return r.value if r else default
+
+    @classmethod
+    async def set_value(cls, name: str, value) -> None:
+        await cls.objects.aupdate_or_create(name=name,
+                                            defaults={
+                                                "value": value,
+                                                "status": True,
+                                                "updated": timezone.now()
+                                            })
+
+    @classmethod
+    async def reset(cls, name: str) -> int:
+        return await cls.objects.filter(name=name).aupdate(status=False, updated=timezone.now())
@@ -1,4 +1,7 @@
+from typing import Tuple
+
 from django.db import models
+from django.utils import timezone
 
 from main.models.base import BaseModel
 
@@ -14,4 +17,42 @@ class DailyStats(BaseModel):
         db_table = "daily_stats"
         verbose_name = "每日统计"
         verbose_name_plural = "每日统计"
+        constraints = [
+            models.UniqueConstraint(fields=["env", "date"], name="daily_stats_env_date"),
+        ]
+
+    @classmethod
+    async def get_rollups(cls, env: str, dates: list) -> dict:
+        """{date: DailyStats}，失效的不返回"""
+        return {
+            r.date: r async for r in cls.objects.filter(env=env, date__in=dates, status=True)
+        }
+
+    @classmethod
+    async def save_rollups(cls, env: str, stats: dict) -> None:
+        """stats 为 {date: docs_stats 结果}，已存在的记录直接覆盖"""
+        now = timezone.now()
+        await cls.abulk_upsert(
+            [
+                cls(env=env,
+                    date=date,
+                    counts=s["counts"],
+                    rates=s["rates"],
+                    labels=s["labels"],
+                    status=True,
+                    updated=now) for date, s in stats.items()
+            ],
+            unique_fields=["env", "date"],
+            update_fields=["counts", "rates", "labels", "status", "updated"],
+        )
+
+    @classmethod
+    async def rollup_version(cls, env: str, dates: list) -> Tuple[str, bool]:
+        """dates 的统计的版本，和 dates 是否全部有有效的统计"""
+        return await cls.filter_version(len(set(dates)), env=env, date__in=dates)
 
+    @classmethod
+    async def invalidate(cls, env: str, dates: list) -> int:
+        # 全部环境 (env="") 的统计也包含这个环境的数据
+        return await cls.objects.filter(env__in={env, ""}, date__in=dates).aupdate(
+            status=False, updated=timezone.now())
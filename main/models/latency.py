@@ -0,0 +1,55 @@
+from typing import Tuple
+
+from django.db import models
+from django.utils import timezone
+
+from main.models.base import BaseModel
+
+
+class LatencyStats(BaseModel):
+    """
+    每日的耗时草图，groups 为 [{"detector", "provider", "detect": DDSketch, "total": DDSketch}]
+    重新标注不影响这里的统计；草图不能减去数据，插入或删除文档后让所在日期的草图失效
+    """
+    env = models.CharField(max_length=10)
+    date = models.CharField(max_length=20)
+    groups = models.JSONField()
+
+    class Meta:
+        db_table = "latency_stats"
+        verbose_name = "耗时统计"
+        verbose_name_plural = "耗时统计"
+        constraints = [
+            models.UniqueConstraint(fields=["env", "date"], name="latency_stats_env_date"),
+        ]
+
+    @classmethod
+    async def get_rollups(cls, env: str, dates: list) -> dict:
+        """{date: LatencyStats}，失效的不返回"""
+        return {
+            r.date: r async for r in cls.objects.filter(env=env, date__in=dates, status=True)
+        }
+
+    @classmethod
+    async def save_rollups(cls, env: str, groups: dict) -> None:
+        """groups 为 {date: [...]}，已存在的记录直接覆盖"""
+        now = timezone.now()
+        await cls.abulk_upsert(
+            [
+                cls(env=env, date=date, groups=items, status=True, updated=now)
+                for date, items in groups.items()
+            ],
+            unique_fields=["env", "date"],
+            update_fields=["groups", "status", "updated"],
+        )
+
+    @classmethod
+    async def rollup_version(cls, env: str, dates: list) -> Tuple[str, bool]:
+        """dates 的草图的版本，和 dates 是否全部有有效的草图"""
+        return await cls.filter_version(len(set(dates)), env=env, date__in=dates)
+
+    @classmethod
+    async def invalidate(cls, env: str, dates: list) -> int:
+        # 全部环境 (env="") 的草图也包含这个环境的数据
+        return await cls.objects.filter(env__in={env, ""}, date__in=dates).aupdate(
+            status=False, updated=timezone.now())
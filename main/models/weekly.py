@@ -1,4 +1,7 @@
+from typing import Tuple
+
 from django.db import models
+from django.utils import timezone
 
 from main.models.base import BaseModel
 
@@ -15,4 +18,45 @@ class WeeklyStats(BaseModel):
         db_table = "weekly_stats"
         verbose_name = "每周统计"
         verbose_name_plural = "每周统计"
+        constraints = [
+            models.UniqueConstraint(fields=["env", "week_start_date"],
+                                    name="weekly_stats_env_week_start_date"),
+        ]
+
+    @classmethod
+    async def get_rollups(cls, env: str, week_start_dates: list) -> dict:
+        """{week_start_date: WeeklyStats}，失效的不返回"""
+        return {
+            r.week_start_date: r async for r in cls.objects.filter(
+                env=env, week_start_date__in=week_start_dates, status=True)
+        }
+
+    @classmethod
+    async def save_rollups(cls, env: str, stats: dict) -> None:
+        """stats 为 {(week_start_date, week_end_date): docs_stats 结果}，已存在的记录直接覆盖"""
+        now = timezone.now()
+        await cls.abulk_upsert(
+            [
+                cls(env=env,
+                    week_start_date=week_start_date,
+                    week_end_date=week_end_date,
+                    counts=s["counts"],
+                    rates=s["rates"],
+                    labels=s["labels"],
+                    status=True,
+                    updated=now) for (week_start_date, week_end_date), s in stats.items()
+            ],
+            unique_fields=["env", "week_start_date"],
+            update_fields=["week_end_date", "counts", "rates", "labels", "status", "updated"],
+        )
+
+    @classmethod
+    async def rollup_version(cls, env: str) -> Tuple[str, bool]:
+        """env 所有每周统计的版本，和是否有有效的统计"""
+        return await cls.filter_version(1, env=env)
 
+    @classmethod
+    async def invalidate(cls, env: str, week_start_dates: list) -> int:
+        return await cls.objects.filter(env__in={env, ""},
+                                        week_start_date__in=week_start_dates).aupdate(
+                                            status=False, updated=timezone.now())
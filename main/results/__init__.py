@@ -1,2 +1,3 @@
+from main.results.breakdown import BreakdownStats
 from main.results.weekly import WeeklyStats
 from main.results.daily import DailyStats
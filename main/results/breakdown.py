@@ -0,0 +1,22 @@
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class BreakdownGroup(BaseModel):
+    values: dict
+    counts: dict
+    rates: dict
+    labels: dict
+
+
+class Breakdown(BaseModel):
+    dimensions: List[str]
+    groups: List[BreakdownGroup]
+
+
+class BreakdownStats(BaseModel):
+    env: Optional[str] = ""
+    start_date: str
+    end_date: str
+    breakdowns: List[Breakdown]
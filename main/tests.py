@@ -1,3 +1,1376 @@
-from django.test import TestCase
+import io
+import csv
+import gzip
+import json
+import random
+import asyncio
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import bson
+from pymongo.errors import OperationFailure
+from django.core.management import CommandError, call_command
+from django.db import NotSupportedError, connection
+from django.http import HttpResponse
+from django.utils import timezone as django_timezone
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from motor.frameworks.asyncio import run_on_executor
+
+from llm_reports.lifespan import lifespan
+from main import benchmarks, models
+from main.benchmarks import dataset, load
+from main.handlers import export, latency, precompute, rollups, stats
+from main.middleware import request_timer
+from main.middleware.server_timing import ServerTimingMiddleware
+from main.utils import export as export_utils
+from main.utils import metrics, timing
+from main.utils.sketch import DDSketch
+from main.utils import mongo as mongo_utils
+from main.utils.cache import ResultCache
+from main.benchmarks.memory_mongo import MemoryCursor, MemoryDatabase
+from main.utils.mongo import mongo_client, date_query, range_query
+
+INTENTS = [
+    "SUCCESS",
+    "ERROR_STT",
+    "ERROR_INTENT",
+    "ERROR_TASK_RUNNING",
+    "ERROR_LANGUAGE",
+    "ERROR_TRANSLATE",
+    "ERROR_LLM_ANSWER",
+    "ERROR_UNKNOWN",
+]
+
+
+def make_doc(date="2025-01-18", env="dev", intent=None, receive=True, **custom):
+    message_evaluation = {}
+    if intent:
+        message_evaluation["m-send"] = {"__sys_message_type": "send", "intent": "SUCCESS"}
+        message_evaluation["m-receive"] = {
+            "__sys_message_type": "receive" if receive else "send",
+            "intent": intent,
+        }
+    return {
+        "custom": {
+            "input1": "how much energy did i use for charging",
+            "input1_text": "how much energy did i use for charging",
+            "input2": [{"role": "user", "content": "how much energy did i use for charging"}],
+            "output1": "View_history_charging_energy",
+            "output2": {"intent": "用户历史充电电量", "slots": {}, "model_version": "llama0.3.1"},
+            "detect_time_cost": 0.93,
+            "total_time_cost": 1.05,
+            "client_type": "app",
+            "language": "english",
+            "provider": "LLMAppEnglishProvider",
+            "detector": "EndpointVllmClient",
+            "start_time": f"{date}T02:01:43.212783+00:00",
+            "end_time": f"{date}T02:01:44.268714+00:00",
+            "timezone_str": "UTC",
+            "env": env,
+            "session_text": "",
+            "date": date,
+            "week_start_date": stats.get_week_start_date(date),
+            "week_end_date": stats.get_week_end_date(stats.get_week_start_date(date)),
+            **custom,
+        },
+        "evaluation": {"message_evaluation": message_evaluation},
+    }
+
+
+def make_docs(n=300, seed=7):
+    rnd = random.Random(seed)
+    return [
+        make_doc(date=f"2025-01-{rnd.randint(10, 20)}",
+                 env=rnd.choice(["dev", "prod"]),
+                 intent=rnd.choice([None, *INTENTS]),
+                 receive=rnd.random() > 0.05,
+                 language=rnd.choice(["english", "chinese"]),
+                 start_time=f"2025-01-18T02:{rnd.randint(0, 20):02d}:00+00:00") for _ in range(n)
+    ]
+
+
+class AccuracyPipelineTest(SimpleTestCase):
+
+    def setUp(self):
+        self.docs = make_docs()
+        patcher = mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_aggregate_matches_scan(self):
+        for query in [{}, date_query("2025-01-15", "dev"), range_query("2025-01-12", "2025-01-17")]:
+            with self.subTest(query=query):
+                self.assertEqual(await stats.query_grouped_stats(query, {}, "aggregate"),
+                                 await stats.query_grouped_stats(query, {}, "scan"))
+
+    async def test_empty_result(self):
+        self.assertEqual(await stats.query_grouped_stats(date_query("2024-01-01"), {}), {})
+        self.assertTrue(stats.is_empty(stats.groups_stats([])))
+        self.assertEqual(stats.groups_stats([]), stats.docs_stats([]))
+
+    @override_settings(MONGO_FETCH_REPORT=True)
+    async def test_fetch_report(self):
+        with self.assertLogs("main.utils.mongo", "INFO") as logs:
+            docs = await mongo_client.find(date_query("2025-01-15"),
+                                           projection=stats.ACCURACY_PROJECTION,
+                                           label="daily_accuracy")
+        self.assertTrue(docs)
+        self.assertEqual(set(docs[0]), {"evaluation"})
+        self.assertIn("Fetch: daily_accuracy", logs.output[0])
+
+    async def test_grouped_by_date_matches_per_day_queries(self):
+        for mode in stats.STATS_MODES:
+            with self.subTest(mode=mode):
+                grouped = await stats.query_grouped_stats(
+                    range_query("2025-01-08", "2025-01-15", "dev"), {"date": "custom.date"}, mode)
+                expected = {}
+                for day in range(8, 16):
+                    date = f"2025-01-{day:02d}"
+                    result = stats.docs_stats(await mongo_client.find(date_query(date, "dev")))
+                    if not stats.is_empty(result):
+                        expected[(date,)] = result
+                self.assertEqual(grouped, expected)
+
+
+class StatsAccumulatorTest(SimpleTestCase):
+
+    def test_result(self):
+        docs = [make_doc(intent="SUCCESS")] * 3 + [make_doc(intent="ERROR_STT"), make_doc()]
+        self.assertEqual(
+            stats.docs_stats(docs), {
+                "counts": {
+                    "SUCCESS": 3,
+                    "ERROR_STT": 1,
+                    "ERROR_INTENT": 0,
+                    "ERROR_TASK_RUNNING": 0,
+                    "ERROR_LANGUAGE": 0,
+                    "ERROR_TRANSLATE": 0,
+                    "ERROR_LLM_ANSWER": 0,
+                    "ERROR_UNKNOWN": 0,
+                    "labels": {"labeled": 4, "unlabeled": 1},
+                },
+                "rates": {
+                    "SUCCESS": "75.0%",
+                    "SUCCESS_STT_RATE": "75.0%",
+                    "SUCCESS_INTENT_RATE": "100.0%",
+                    "SUCCESS_TASK_RUNNING_RATE": "100.0%",
+                },
+                "labels": {"labeled": 4, "unlabeled": 1},
+            })
+        self.assertEqual(stats.docs_stats([])["rates"]["SUCCESS"], "0%")
+
+    def test_merge(self):
+        docs = make_docs()
+        left, right = stats.StatsAccumulator(), stats.StatsAccumulator()
+        for doc in docs[:100]:
+            stats.count_doc(left, doc)
+        rates = left.rates
+        for doc in docs[100:]:
+            stats.count_doc(right, doc)
+        self.assertEqual(left.merge(right).result(), stats.docs_stats(docs))
+        self.assertNotEqual(left.rates, rates)
+
+    def test_unknown_category(self):
+        with self.assertRaises(ValueError):
+            stats.StatsAccumulator().increment("UNKNOWN")
+
+
+@override_settings(STATS_ROLLUPS=False)
+class WeeklyAccuracyTest(SimpleTestCase):
+
+    def setUp(self):
+        stats.stats_cache.clear()
+
+    def week(self, weeks_ago: int) -> str:
+        today = datetime.now()
+        return (today - timedelta(days=today.weekday() + 7 * weeks_ago)).strftime("%Y-%m-%d")
+
+    async def test_stops_after_five_empty_weeks(self):
+        # 第 3 周为空，第 5 ~ 8 周为空，第 9 周有数据但在停止条件之后
+        docs = [
+            make_doc(date=self.week(n), intent="SUCCESS")
+            for n in (0, 1, 2, 4, 9)
+        ]
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": docs})):
+            for mode in stats.STATS_MODES:
+                with self.subTest(mode=mode):
+                    request = RequestFactory().get("/", {"env": "dev", "mode": mode})
+                    result = await stats.WeeklyAccuracyHandler(request)
+                    self.assertEqual([r.week_start_date for r in result],
+                                     [self.week(1), self.week(2), self.week(4)])
+                    self.assertEqual(result[0].counts["SUCCESS"], 1)
+
+    async def test_no_data(self):
+        with mock.patch.object(mongo_client, "db", MemoryDatabase()):
+            request = RequestFactory().get("/", {"env": "dev"})
+            self.assertEqual(await stats.WeeklyAccuracyHandler(request), [])
+
+
+class RollupTest(TestCase):
+
+    def setUp(self):
+        self.yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+        self.today = stats.today()
+        self.docs = [
+            make_doc(date=self.yesterday, intent="SUCCESS"),
+            make_doc(date=self.yesterday, intent="ERROR_STT"),
+            make_doc(date=self.today, intent="SUCCESS"),
+        ]
+
+    async def daily(self, db):
+        stats.stats_cache.clear()
+        with mock.patch.object(mongo_client, "db", db):
+            request = RequestFactory().get("/", {
+                "env": "dev",
+                "start_date": self.yesterday,
+                "end_date": self.today
+            })
+            return await stats.RangeDailyAccuracyHandler(request)
+
+    async def test_closed_days_are_persisted(self):
+        first = await self.daily(MemoryDatabase({"Data": self.docs}))
+        self.assertEqual([r.date for r in first], [self.today, self.yesterday])
+        self.assertEqual(await models.DailyStats.objects.filter(env="dev").acount(), 1)
+        # 过去的日期直接读统计结果，当天实时计算
+        second = await self.daily(MemoryDatabase())
+        self.assertEqual([r.date for r in second], [self.yesterday])
+        self.assertEqual(second[0].counts, first[1].counts)
+
+    async def test_recompute(self):
+        await self.daily(MemoryDatabase({"Data": self.docs}))
+        relabeled = [make_doc(date=self.yesterday, intent="SUCCESS")] * 2
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": relabeled})):
+            await stats.recompute_rollups("dev", [self.yesterday])
+        r = await models.DailyStats.objects.aget(env="dev", date=self.yesterday)
+        self.assertTrue(r.status)
+        self.assertEqual(r.counts["SUCCESS"], 2)
+        self.assertEqual(r.counts["ERROR_STT"], 0)
+
+    async def test_invalidate(self):
+        await self.daily(MemoryDatabase({"Data": self.docs}))
+        result = await stats.invalidate_rollups("dev", [self.yesterday])
+        self.assertEqual(result["daily"], 1)
+        self.assertEqual(await self.daily(MemoryDatabase()), [])
+
+    async def test_weekly_rollups(self):
+        stats.stats_cache.clear()
+        week = stats.get_week_start_date((datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d"))
+        docs = [make_doc(date=week, intent="SUCCESS")]
+        request = RequestFactory().get("/", {"env": "dev"})
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": docs})):
+            first = await stats.WeeklyAccuracyHandler(request)
+        self.assertEqual([r.week_start_date for r in first], [week])
+        self.assertTrue(await models.WeeklyStats.objects.filter(week_start_date=week).aexists())
+        # 只剩最早一周的查询，统计结果从 WeeklyStats 读取
+        stats.stats_cache.clear()
+        db = MemoryDatabase({"Data": docs[:1]})
+        with mock.patch.object(mongo_client, "db", db), \
+                mock.patch.object(mongo_client, "aggregate", side_effect=AssertionError):
+            second = await stats.WeeklyAccuracyHandler(request)
+        self.assertEqual(second, first)
+
+    async def test_upsert_without_conflict_target(self):
+        """MySQL 不支持指定冲突字段（supports_update_conflicts_with_target=False）"""
+        test = self
+
+        def on_conflict_suffix_sql(ops, fields, on_conflict, update_fields, unique_fields):
+            # 和 ON DUPLICATE KEY UPDATE 一样，由唯一约束决定冲突
+            test.assertFalse(list(unique_fields))
+            return "ON CONFLICT DO UPDATE SET " + ", ".join(
+                f"{ops.quote_name(name)} = EXCLUDED.{ops.quote_name(name)}"
+                for name in update_fields)
+
+        stats_ = stats.docs_stats([make_doc(date=self.yesterday, intent="SUCCESS")])
+        # 数据库操作在其他线程中执行，替换类属性而不是当前线程的连接
+        with mock.patch.object(type(connection.features), "supports_update_conflicts_with_target",
+                               False), \
+                mock.patch.object(type(connection.ops), "on_conflict_suffix_sql",
+                                  on_conflict_suffix_sql):
+            with self.assertRaises(NotSupportedError):
+                await models.DailyStats.objects.abulk_create(
+                    [models.DailyStats(env="dev", date=self.yesterday, **stats_)],
+                    update_conflicts=True,
+                    unique_fields=["env", "date"],
+                    update_fields=["counts"])
+            await models.DailyStats.save_rollups("dev", {self.yesterday: stats_})
+            stats_["counts"]["SUCCESS"] = 5
+            await models.DailyStats.save_rollups("dev", {self.yesterday: stats_})
+            await models.WeeklyStats.save_rollups("dev", {("2025-01-06", "2025-01-13"): stats_})
+            await models.WeeklyStats.save_rollups("dev", {("2025-01-06", "2025-01-13"): stats_})
+            for _ in range(2):
+                await models.BreakdownStats.save_rollups("dev", "language", {self.yesterday: []})
+                await models.LatencyStats.save_rollups("dev", {self.yesterday: []})
+        r = await models.DailyStats.objects.aget(env="dev", date=self.yesterday)
+        self.assertEqual(r.counts["SUCCESS"], 5)
+        self.assertEqual(await models.WeeklyStats.objects.acount(), 1)
+        self.assertEqual(await models.BreakdownStats.objects.acount(), 1)
+        self.assertEqual(await models.LatencyStats.objects.acount(), 1)
+
+    async def test_unknown_env_is_not_persisted(self):
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs})):
+            await stats.daily_stats("devv", [self.yesterday])
+            with self.assertRaises(stats.HttpError) as e:
+                await stats.daily_stats("x" * 11, [self.yesterday])
+        self.assertEqual(e.exception.status_code, 400)
+        self.assertFalse(await models.DailyStats.objects.aexists())
+
+    async def test_malformed_date_is_not_persisted(self):
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs})):
+            for date in (f"{self.yesterday}junk", "2025-1-5", "x" * 30):
+                with self.subTest(date=date):
+                    response = await self.async_client.get("/api/stats/daily_accuracy",
+                                                           {"env": "dev", "date": date})
+                    self.assertEqual(response.status_code, 400)
+            response = await self.async_client.post("/api/stats/rollups/invalidate",
+                                                    {"env": "dev", "dates": ["2025-01-5x"]},
+                                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(await models.DailyStats.objects.aexists())
+
+    async def test_days_before_first_data_are_not_persisted(self):
+        start_date = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs})):
+            await stats.daily_stats("dev", stats.get_dates(start_date, self.yesterday))
+            with self.assertRaises(stats.HttpError) as e:
+                stats.range_dates("1990-01-01", self.yesterday)
+        self.assertEqual(e.exception.status_code, 400)
+        first_week_start_date = stats.get_week_start_date(self.yesterday)
+        self.assertFalse(await models.DailyStats.objects.filter(
+            date__lt=first_week_start_date).aexists())
+        self.assertTrue(await models.DailyStats.objects.filter(date=self.yesterday).aexists())
+
+    async def test_range_merges_daily_rollups(self):
+        docs = make_docs()
+        query = {"start_date": "2025-01-12", "end_date": "2025-01-17", "env": "dev"}
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": docs})):
+            expected = stats.docs_stats(
+                await mongo_client.find(range_query("2025-01-12", "2025-01-17", "dev")))
+            first = await stats.RangeAccuracyHandler(RequestFactory().get("/", query))
+        stats.stats_cache.clear()
+        with mock.patch.object(mongo_client, "db", MemoryDatabase()):
+            second = await stats.RangeAccuracyHandler(RequestFactory().get("/", query))
+        self.assertEqual(first,
+                         dict(expected, start_date="2025-01-12", end_date="2025-01-17"))
+        self.assertEqual(second, first)
+
+
+class ResultCacheTest(SimpleTestCase):
+
+    async def test_single_flight(self):
+        cache, calls = ResultCache(), []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*[cache.get_or_compute("key", compute, 60) for _ in range(5)])
+        self.assertEqual(results, ["value"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(await cache.get_or_compute("key", compute, 60), "value")
+        self.assertEqual((cache.misses, cache.coalesced, cache.hits), (1, 4, 1))
+
+    async def test_error_is_shared_and_not_cached(self):
+        cache = ResultCache()
+
+        async def compute():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(cache.get_or_compute("key", compute, 60),
+                                       cache.get_or_compute("key", compute, 60),
+                                       return_exceptions=True)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    async def test_cancelled_leader_does_not_cancel_waiters(self):
+        cache = ResultCache()
+
+        async def compute():
+            await asyncio.sleep(0.02)
+            return "value"
+
+        leader = asyncio.ensure_future(cache.get_or_compute("key", compute, 60))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.get_or_compute("key", compute, 60))
+        await asyncio.sleep(0)
+        leader.cancel()
+        self.assertEqual(await follower, "value")
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(cache.get("key"), "value")
+
+    def test_ttl_and_lru(self):
+        cache = ResultCache(maxsize=2)
+        cache.set("a", 1, 60)
+        cache.set("b", 2, 60)
+        cache.get("a")
+        cache.set("c", 3, 60)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        self.assertEqual(cache.evictions, 1)
+        with mock.patch("main.utils.cache.time.monotonic", return_value=10**9):
+            self.assertIsNone(cache.get("a"))
+
+
+class ListErrorsTest(SimpleTestCase):
+
+    def setUp(self):
+        self.docs = make_docs()
+        patcher = mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def list_all(self, **params):
+        rows, cursor = [], ""
+        while True:
+            request = RequestFactory().get("/", dict(params, limit=7, cursor=cursor))
+            page = await stats.ListErrorsHandler(request)
+            self.assertLessEqual(len(page["items"]), 7)
+            rows.extend(page["items"])
+            cursor = page["next_cursor"]
+            if not cursor:
+                return rows
+
+    async def test_pages_cover_all_labeled_rows(self):
+        rows = await self.list_all(env="dev")
+        expected = [doc for doc in self.docs
+                    if doc["custom"]["env"] == "dev" and doc["evaluation"]["message_evaluation"]]
+        self.assertEqual(len(rows), len(expected))
+        keys = [row["start_time"] for row in rows]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    async def test_filters(self):
+        rows = await self.list_all(label_type="ERROR_STT", language="chinese")
+        expected = [doc for doc in self.docs if doc["custom"]["language"] == "chinese" and
+                    doc["evaluation"]["message_evaluation"].get("m-receive", {}).get(
+                        "__sys_message_type") == "receive" and
+                    doc["evaluation"]["message_evaluation"]["m-receive"]["intent"] == "ERROR_STT"]
+        self.assertEqual(len(rows), len(expected))
+        self.assertTrue(rows)
+        self.assertTrue(all(row["label_type"] == "ERROR_STT" for row in rows))
+
+    async def test_bad_params(self):
+        for params in [{"cursor": "NQ=="}, {"cursor": "!!"}, {"limit": "abc"}, {"format": "xml"},
+                       {"label_type": "FOO"}]:
+            with self.subTest(params=params), self.assertRaises(stats.HttpError) as e:
+                await stats.ListErrorsHandler(RequestFactory().get("/", params))
+            self.assertEqual(e.exception.status_code, 400)
+
+    async def read_ndjson(self, **headers):
+        request = RequestFactory().get("/", {"env": "dev", "format": "ndjson"}, headers=headers)
+        response = await stats.ListErrorsHandler(request)
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        if response.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return [json.loads(line) for line in body.decode().splitlines()]
+
+    async def test_ndjson_matches_pages(self):
+        rows = await self.list_all(env="dev")
+        self.assertEqual(await self.read_ndjson(), rows)
+        self.assertEqual(await self.read_ndjson(accept_encoding="gzip, deflate"), rows)
+
+    def test_error_rows_match_model_dump(self):
+        docs = self.docs[:20]
+        del docs[0]["custom"]["env"]
+        expected = [stats.NluData(**doc["custom"]).model_dump() for doc in docs]
+        rows = stats.error_rows(docs)
+        for row in rows:
+            row.pop("label_type", None)
+        self.assertEqual(rows, expected)
+        # JSON 中的字段顺序也相同
+        self.assertEqual([list(row) for row in rows], [list(row) for row in expected])
+
+
+class ExportTest(SimpleTestCase):
+
+    def setUp(self):
+        self.docs = make_docs()
+        patcher = mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.req = export.ExportRequest(env="dev", start_date="2025-01-12", end_date="2025-01-17")
+        self.expected = [
+            doc for doc in self.docs
+            if doc["custom"]["env"] == "dev" and "2025-01-12" <= doc["custom"]["date"] <= "2025-01-17"
+        ]
+
+    async def test_csv_fallback(self):
+        fileobj = io.BytesIO()
+        with mock.patch("main.utils.export.pa", None):
+            result = await export.export_records(self.req, fileobj)
+        self.assertEqual(result["format"], "csv")
+        rows = list(csv.DictReader(io.StringIO(fileobj.getvalue().decode())))
+        self.assertEqual(len(rows), len(self.expected))
+        self.assertEqual(list(rows[0]), [name for name, _ in export.EXPORT_COLUMNS])
+        self.assertEqual(rows[0]["output_intent"], "用户历史充电电量")
+
+    @skipUnless(export_utils.pa, "pyarrow is not installed")
+    async def test_parquet(self):
+        fileobj = io.BytesIO()
+        self.req.batch_size = 10
+        result = await export.export_records(self.req, fileobj)
+        self.assertEqual((result["format"], result["rows"]), ("parquet", len(self.expected)))
+        fileobj.seek(0)
+        table = export_utils.pq.read_table(fileobj)
+        self.assertEqual(table.num_rows, len(self.expected))
+        labels = [stats.receive_intent(doc) or "" for doc in self.expected]
+        self.assertEqual(table.column("label").to_pylist(), labels)
+
+    async def stream(self, **params):
+        request = RequestFactory().get("/", {"env": "dev", "start_date": "2025-01-12",
+                                             "end_date": "2025-01-17", "batch_size": 10, **params})
+        response = await export.ExportHandler(request)
+        self.assertTrue(response.streaming)
+        chunks = [chunk async for chunk in response.streaming_content]
+        return chunks
+
+    @override_settings(MONGO_EXPORT_MAX_TIME_MS=0)
+    async def test_stream_csv(self):
+        # 导出的游标不受 MONGO_MAX_TIME_MS 限制
+        with mock.patch.object(mongo_client, "max_time_ms", 30000), \
+                mock.patch.object(MemoryCursor, "max_time_ms", side_effect=AssertionError):
+            chunks = await self.stream(format="csv")
+        # 表头和每批数据分别发送
+        self.assertGreater(len(chunks), len(self.expected) // 10)
+        rows = list(csv.DictReader(io.StringIO(b"".join(chunks).decode())))
+        self.assertEqual(len(rows), len(self.expected))
+
+    async def test_bad_batch_size(self):
+        for batch_size in ("abc", -5, export.EXPORT_MAX_BATCH_SIZE + 1):
+            with self.subTest(batch_size=batch_size):
+                with self.assertRaises(stats.HttpError) as e:
+                    await export.ExportHandler(RequestFactory().get(
+                        "/", {"format": "csv", "batch_size": batch_size}))
+                self.assertEqual(e.exception.status_code, 400)
+
+    @skipUnless(export_utils.pa, "pyarrow is not installed")
+    async def test_stream_arrow(self):
+        chunks = await self.stream(format="arrow")
+        table = export_utils.pa.ipc.open_stream(b"".join(chunks)).read_all()
+        self.assertEqual(table.num_rows, len(self.expected))
+
+
+class EnsureIndexesTest(SimpleTestCase):
+
+    def test_plan_stages(self):
+        classic = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}
+        self.assertEqual(mongo_utils.plan_stages(classic), ["FETCH", "IXSCAN"])
+        sbe = {"queryPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}}
+        self.assertEqual(mongo_utils.plan_stages(sbe), ["SORT", "COLLSCAN"])
+        merged = {"stage": "SORT_MERGE",
+                  "inputStages": [{"stage": "IXSCAN"}, {"stage": "COLLSCAN"}]}
+        self.assertIn("COLLSCAN", mongo_utils.plan_stages(merged))
+
+    def test_command_fails_on_collscan(self):
+
+        async def explain(query, collection_name="Data", sort=None):
+            return ["COLLSCAN"] if "custom.start_time" in str(query) else ["FETCH", "IXSCAN"]
+
+        with mock.patch.object(mongo_client, "explain", explain):
+            with self.assertRaisesMessage(CommandError, "errors_after"):
+                call_command("ensure_indexes", "--check-only", stdout=io.StringIO())
+
+    def test_command_creates_indexes(self):
+        ensure = mock.AsyncMock(return_value=["env_date"])
+        explain = mock.AsyncMock(return_value=["FETCH", "IXSCAN"])
+        stdout = io.StringIO()
+        with mock.patch.object(mongo_client, "ensure_indexes", ensure), \
+                mock.patch.object(mongo_client, "explain", explain):
+            call_command("ensure_indexes", stdout=stdout)
+        ensure.assert_awaited_once_with("Data")
+        self.assertEqual(explain.await_count, len(mongo_utils.query_shapes()))
+        self.assertIn("All queries use an index", stdout.getvalue())
+
+
+class MongoClientTest(SimpleTestCase):
+
+    def test_lazy_client_options(self):
+        client = mongo_utils.MongoClient("mongodb://localhost:1", "reports",
+                                         max_pool_size=5,
+                                         min_pool_size=2,
+                                         compressors="zlib",
+                                         read_preference="secondaryPreferred")
+        self.assertNotIn("client", client.__dict__)
+        self.assertEqual(client.db.read_preference.mongos_mode, "secondaryPreferred")
+        pool_options = client.client.options.pool_options
+        self.assertEqual((pool_options.max_pool_size, pool_options.min_pool_size), (5, 2))
+        client.close()
+        self.assertNotIn("client", client.__dict__)
+
+    async def test_max_time_ms(self):
+        client = mongo_utils.MongoClient("mongodb://localhost:1", "reports", max_time_ms=500)
+        db = mock.MagicMock()
+        cursor = db["Data"].find.return_value
+        cursor.max_time_ms.return_value.batch_size.return_value.__aiter__.return_value = []
+        db["Data"].find_one = mock.AsyncMock(return_value=None)
+        with mock.patch.object(client, "db", db, create=True):
+            await client.find({"custom.date": "2025-01-10"})
+            await client.find_one({"custom.date": "2025-01-10"})
+        cursor.max_time_ms.assert_called_once_with(500)
+        self.assertEqual(db["Data"].find_one.await_args.kwargs["maxTimeMS"], 500)
+
+
+class LifespanTest(SimpleTestCase):
+
+    async def run_lifespan(self, *messages):
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        messages = [{"type": message} for message in messages]
+        await lifespan({"type": "lifespan"}, mock.AsyncMock(side_effect=messages), send)
+        return sent
+
+    async def test_startup_and_shutdown(self):
+        warm_up = mock.AsyncMock(return_value=10)
+        with mock.patch.object(mongo_client, "warm_up", warm_up), \
+                mock.patch.object(mongo_client, "close") as close:
+            sent = await self.run_lifespan("lifespan.startup", "lifespan.shutdown")
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        warm_up.assert_awaited_once()
+        close.assert_called_once()
+
+    async def test_warm_up_failure_does_not_block_startup(self):
+        warm_up = mock.AsyncMock(side_effect=ConnectionError("unreachable"))
+        with mock.patch.object(mongo_client, "warm_up", warm_up), \
+                mock.patch.object(mongo_client, "close"):
+            with self.assertLogs("main.utils.mongo", "WARNING"):
+                sent = await self.run_lifespan("lifespan.startup", "lifespan.shutdown")
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+
+    @override_settings(LIFESPAN_STARTUP=["main.tests.failing_hook"])
+    async def test_startup_failure(self):
+        with self.assertLogs("llm_reports.lifespan", "ERROR"):
+            sent = await self.run_lifespan("lifespan.startup")
+        self.assertEqual(sent, ["lifespan.startup.failed"])
+
+
+async def failing_hook():
+    raise RuntimeError("boom")
+
+
+class BenchmarkTest(SimpleTestCase):
+
+    def test_dataset(self):
+        docs = dataset.make_docs(2000, seed=3)
+        self.assertEqual(docs, dataset.make_docs(2000, seed=3))
+        for doc in docs[:50]:
+            stats.NluData(**doc["custom"])
+        result = stats.docs_stats(docs)
+        self.assertEqual(result["labels"]["labeled"] + result["labels"]["unlabeled"], 2000)
+        self.assertTrue(all(result["counts"][category] for category in stats.CATEGORIES))
+        success = [doc for doc in docs if stats.receive_intent(doc) == "SUCCESS"]
+        self.assertTrue(success)
+        for doc in success:
+            self.assertIn(mongo_utils.SUCCESS_MESSAGE_ID, doc["evaluation"]["message_evaluation"])
+
+    def test_compare(self):
+        baseline = {"results": {"a": {"seconds": 1.0}, "b": {"seconds": 1.0}}}
+        current = {"results": {"a": {"seconds": 1.1}, "b": {"seconds": 1.5}, "c": {"seconds": 1}}}
+        self.assertEqual(benchmarks.compare(current, baseline, threshold=0.2), [
+            ("a", 1.0, 1.1, 1.1, False),
+            ("b", 1.0, 1.5, 1.5, True),
+        ])
+
+    def test_unknown_suite(self):
+        with self.assertRaisesMessage(CommandError, "Unknown suites: nope"):
+            call_command("benchmark", "nope")
+
+    def test_measure(self):
+        result = benchmarks.measure(lambda: [0] * 100000, rows=100, repeat=2)
+        self.assertEqual(result["rows"], 100)
+        self.assertGreater(result["peak_memory_bytes"], 100000 * 8)
+
+
+class LoadTest(SimpleTestCase):
+
+    def test_percentile(self):
+        values = [i / 1000 for i in range(1, 101)]
+        self.assertEqual(load.percentile(values, 50), 0.05)
+        self.assertEqual(load.percentile(values, 99), 0.099)
+        self.assertEqual(load.percentile([], 99), 0)
+
+    def test_parse_mix(self):
+        self.assertEqual(load.parse_mix("daily_accuracy=3,list_errors"),
+                         {"daily_accuracy": 3, "list_errors": 1})
+        with self.assertRaises(ValueError):
+            load.parse_mix("unknown=1")
+
+    async def test_run(self):
+        from llm_reports.asgi import application
+
+        dates = load.recent_dates(14)
+        docs = dataset.make_docs(300, start_date=dates[0], days=len(dates))
+        with load.memory_backend(docs, cache=False):
+            report = await load.run(application, dates, clients=5, requests=40)
+        self.assertEqual(set(report), {*load.DEFAULT_MIX, "total"})
+        self.assertEqual(report["total"]["requests"], 40)
+        self.assertEqual(report["total"]["errors"], 0)
+        self.assertLessEqual(report["total"]["p50_ms"], report["total"]["p99_ms"])
+        self.assertNotIsInstance(mongo_client.__dict__.get("db"), MemoryDatabase)
+
+
+class MetricsTest(SimpleTestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("latency", "Latency", ("route",), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, "a")
+        self.assertEqual(histogram.render(), [
+            "# HELP latency Latency",
+            "# TYPE latency histogram",
+            'latency_bucket{route="a",le="0.1"} 2',
+            'latency_bucket{route="a",le="1"} 3',
+            'latency_bucket{route="a",le="+Inf"} 4',
+            'latency_sum{route="a"} 3.65',
+            'latency_count{route="a"} 4',
+        ])
+
+    @override_settings(STATS_ROLLUPS=False)
+    async def test_metrics_endpoint(self):
+        stats.stats_cache.clear()
+        docs = make_docs()
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": docs})):
+            for _ in range(2):
+                response = await self.async_client.get("/api/stats/daily_accuracy",
+                                                        {"date": "2025-01-12"})
+                self.assertEqual(response.status_code, 200)
+        response = await self.async_client.get("/api/metrics")
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        body = response.content.decode()
+        route = 'route="api/stats/daily_accuracy",method="GET"'
+        self.assertIn(f'http_requests_total{{{route},status="200"}}', body)
+        self.assertIn(f'http_request_duration_seconds_count{{{route}}}', body)
+        self.assertIn(f'http_response_size_bytes_count{{{route}}}', body)
+        self.assertIn("http_requests_in_flight 1", body)
+        self.assertIn('result_cache_hits_total{cache="stats"}', body)
+
+    @override_settings(REQUEST_LOG_SAMPLE_RATE=0, REQUEST_LOG_SLOW_SECONDS=1)
+    def test_log_sampling(self):
+        self.assertFalse(request_timer.should_log(0.1, 200))
+        self.assertTrue(request_timer.should_log(2, 200))
+        self.assertTrue(request_timer.should_log(0.1, 500))
+        with override_settings(REQUEST_LOG_SAMPLE_RATE=1):
+            self.assertTrue(request_timer.should_log(0.1, 200))
+
+
+def command_event(request_id=1, duration_micros=2000, **attrs):
+    return SimpleNamespace(request_id=request_id, duration_micros=duration_micros, **attrs)
+
+
+class ServerTimingTest(SimpleTestCase):
+
+    def test_query_shape(self):
+        command = {
+            "find": "Data",
+            "filter": {"custom.date": {"$in": ["2025-01-10", "2025-01-11"]}, "custom.env": "dev"},
+            "sort": {"custom.start_time": -1},
+            "batchSize": 1000,
+        }
+        self.assertEqual(timing.command_shape(command), {
+            "find": "Data",
+            "filter": {"custom.date": {"$in": "?"}, "custom.env": "?"},
+            "sort": {"custom.start_time": "?"},
+        })
+
+    @override_settings(MONGO_SLOW_QUERY_MS=5, MONGO_MONITOR_BYTES=True)
+    async def test_command_timer_in_executor_thread(self):
+        listener = timing.CommandTimer()
+        reply = {"cursor": {"firstBatch": [{"a": 1}, {"a": 2}]}, "ok": 1}
+
+        def run_command(request_id, duration_micros):
+            # 和 Motor 一样在线程池中执行，contextvar 由 run_on_executor 复制过去
+            listener.started(command_event(request_id, command={"find": "Data", "filter": {}}))
+            listener.succeeded(command_event(request_id, duration_micros,
+                                             command_name="find",
+                                             reply=reply))
+
+        request_timing = timing.RequestTiming()
+        token = timing.current_timing.set(request_timing)
+        try:
+            loop = asyncio.get_running_loop()
+            await run_on_executor(loop, run_command, 1, 2000)
+            with self.assertLogs("main.utils.timing", "WARNING") as logs:
+                await run_on_executor(loop, run_command, 2, 8000)
+        finally:
+            timing.current_timing.reset(token)
+        self.assertIn("Slow query: find", logs.output[0])
+        self.assertEqual((request_timing.queries, request_timing.documents), (2, 4))
+        self.assertAlmostEqual(request_timing.mongo_seconds, 0.01)
+        self.assertEqual(request_timing.bytes, 2 * len(bson.encode(reply)))
+        self.assertEqual(listener.commands, {})
+
+    @override_settings(STATS_ROLLUPS=False)
+    async def test_server_timing_header(self):
+        stats.stats_cache.clear()
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": make_docs()})):
+            response = await self.async_client.get("/api/stats/daily_accuracy",
+                                                    {"date": "2025-01-12"})
+        names = [entry.split(";")[0] for entry in response["Server-Timing"].split(", ")]
+        self.assertEqual(names, ["mongo", "render", "app", "total"])
+
+    @override_settings(MONGO_QUERY_BUDGET=2)
+    async def test_query_budget(self):
+
+        async def get_response(request):
+            timing.current_timing.get().queries += 3
+            return HttpResponse()
+
+        middleware = ServerTimingMiddleware(get_response)
+        with self.assertLogs("main.middleware.server_timing", "WARNING") as logs:
+            response = await middleware(RequestFactory().get("/api/stats/weekly_accuracy"))
+        self.assertIn("Queries: 3", logs.output[0])
+        self.assertTrue(response["Server-Timing"].startswith('mongo;dur=0.0;desc="queries=3 '))
+        self.assertIsNone(timing.current_timing.get())
+
+
+class ConditionalRequestTest(TestCase):
+
+    def setUp(self):
+        stats.stats_cache.clear()
+        self.yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+        self.docs = [make_doc(date=self.yesterday, intent="SUCCESS"),
+                     make_doc(date=self.yesterday, intent="ERROR_STT")]
+
+    async def get(self, path, params, db=None, **headers):
+        with mock.patch.object(mongo_client, "db", db or MemoryDatabase({"Data": self.docs})):
+            return await self.async_client.get(path, params, headers=headers)
+
+    async def test_closed_range_not_modified(self):
+        path = "/api/stats/range_accuracy"
+        params = {"env": "dev", "start_date": self.yesterday, "end_date": self.yesterday}
+        first = await self.get(path, params)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first["Cache-Control"], "private, max-age=300, must-revalidate")
+        etag = first["ETag"]
+
+        # 304 只查询保存的统计，不访问 MongoDB，也不依赖结果缓存
+        stats.stats_cache.clear()
+        db = mock.MagicMock(side_effect=AssertionError)
+        db.__getitem__.side_effect = AssertionError
+        second = await self.get(path, params, db, if_none_match=etag)
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second["ETag"], etag)
+        self.assertEqual(second.content, b"")
+
+        # 重新标注后统计版本变化，ETag 随之变化
+        await stats.invalidate_rollups("dev", [self.yesterday])
+        third = await self.get(path, params, if_none_match=etag)
+        self.assertEqual(third.status_code, 200)
+        self.assertNotEqual(third["ETag"], etag)
+        self.assertEqual(json.loads(third.content), json.loads(first.content))
+
+    async def test_cached_result_follows_rollup_version(self):
+        path = "/api/stats/daily_accuracy"
+        params = {"env": "dev", "date": self.yesterday}
+        first = await self.get(path, params)
+        self.assertEqual(json.loads(first.content)["counts"]["SUCCESS"], 1)
+        # 其他进程（如 sync_rollups）更新了统计，本进程的结果缓存没有清空
+        counts = dict(json.loads(first.content)["counts"], SUCCESS=5)
+        await models.DailyStats.objects.filter(env="dev", date=self.yesterday).aupdate(
+            counts=counts, updated=django_timezone.now())
+        second = await self.get(path, params, if_none_match=first["ETag"])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second["ETag"], first["ETag"])
+        self.assertEqual(json.loads(second.content)["counts"]["SUCCESS"], 5)
+        third = await self.get(path, params, if_none_match=second["ETag"])
+        self.assertEqual(third.status_code, 304)
+
+    async def test_open_date_has_no_etag(self):
+        response = await self.get("/api/stats/daily_accuracy", {"date": stats.today()})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+        self.assertEqual(response["Cache-Control"], "private, max-age=30, must-revalidate")
+
+    async def test_weekly_not_modified(self):
+        week = stats.get_week_start_date((datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d"))
+        self.docs = [make_doc(date=week, intent="SUCCESS")]
+        first = await self.get("/api/stats/weekly_accuracy", {"env": "dev"})
+        self.assertEqual(len(json.loads(first.content)), 1)
+        second = await self.get("/api/stats/weekly_accuracy", {"env": "dev"},
+                                if_none_match=first["ETag"])
+        self.assertEqual(second.status_code, 304)
+        other_env = await self.get("/api/stats/weekly_accuracy", {"env": "prod"},
+                                   if_none_match=first["ETag"])
+        self.assertEqual(other_env.status_code, 200)
+
+
+class RollupSyncTest(TestCase):
+
+    def setUp(self):
+        stats.stats_cache.clear()
+        # 上周一：每天和每周的统计都已经结束
+        last_week = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+        self.date = stats.get_week_start_date(last_week)
+        self.week = self.date
+        self.docs = [make_doc(date=self.date, intent="SUCCESS"),
+                     make_doc(date=self.date, intent="ERROR_STT")]
+        self.docs[1]["_id"] = 1
+
+    async def save_rollups(self, docs):
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": docs})):
+            await stats.weekly_stats("dev", [self.week])
+
+    def relabel(self, intent, **change):
+        before = self.docs[1]
+        after = make_doc(date=self.date, intent=intent)
+        after["_id"] = 1
+        return {
+            "operationType": "update",
+            "documentKey": {"_id": 1},
+            "updateDescription": {"updatedFields": {"evaluation.message_evaluation": {}}},
+            "fullDocumentBeforeChange": before,
+            "fullDocument": after,
+            "wallTime": datetime.utcnow(),
+            **change,
+        }
+
+    async def counts(self):
+        daily = await models.DailyStats.objects.aget(env="dev", date=self.date)
+        weekly = await models.WeeklyStats.objects.aget(env="dev", week_start_date=self.week)
+        return daily.status and daily.counts, weekly.status and weekly.counts
+
+    async def test_relabel_applies_delta(self):
+        await self.save_rollups(self.docs)
+        maintainer = rollups.RollupMaintainer(mode="change_stream")
+        with mock.patch.object(mongo_client, "db", MemoryDatabase()):
+            result = await maintainer.apply_changes([self.relabel("SUCCESS")])
+        self.assertEqual(result, {"daily": 1, "weekly": 1, "breakdown": 0, "latency": 0,
+                                  "recomputed": 0})
+        daily, weekly = await self.counts()
+        self.assertEqual((daily["SUCCESS"], daily["ERROR_STT"]), (2, 0))
+        self.assertEqual((weekly["SUCCESS"], weekly["ERROR_STT"]), (2, 0))
+        # 增量结果和重新统计一致
+        after = [self.docs[0], self.relabel("SUCCESS")["fullDocument"]]
+        self.assertEqual(daily, stats.docs_stats(after)["counts"])
+
+    async def test_cached_results_follow_applied_deltas(self):
+        await self.save_rollups(self.docs)
+        request = RequestFactory().get("/", {"env": "dev", "date": self.date})
+        with mock.patch.object(mongo_client, "db", MemoryDatabase()):
+            before = await stats.DailyAccuracyHandler(request)
+            await rollups.RollupMaintainer(mode="change_stream").apply_changes(
+                [self.relabel("SUCCESS")])
+            # 不清空结果缓存，统计的版本变化后取到新的结果
+            after = await stats.DailyAccuracyHandler(
+                RequestFactory().get("/", {"env": "dev", "date": self.date}))
+        self.assertEqual((before.counts["SUCCESS"], after.counts["SUCCESS"]), (1, 2))
+
+    async def test_insert_invalidates_latency_sketches(self):
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs})):
+            await latency.latency_stats("dev", [self.date])
+        insert = {
+            "operationType": "insert",
+            "documentKey": {"_id": 2},
+            "fullDocument": dict(make_doc(date=self.date, intent="SUCCESS"), _id=2),
+            "wallTime": datetime.utcnow(),
+        }
+        maintainer = rollups.RollupMaintainer(mode="change_stream")
+        with mock.patch.object(mongo_client, "db", MemoryDatabase()):
+            result = await maintainer.apply_changes([insert])
+        self.assertEqual(result["latency"], 1)
+        self.assertFalse(await models.LatencyStats.get_rollups("dev", [self.date]))
+
+    async def test_latency_update_invalidates_latency_sketches(self):
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs})):
+            await latency.latency_stats("dev", [self.date])
+        maintainer = rollups.RollupMaintainer(mode="change_stream")
+        for name in ("custom.total_time_cost", "custom"):
+            with self.subTest(name=name):
+                self.assertTrue(rollups.touches_rollups(self.relabel(
+                    "ERROR_STT", updateDescription={"updatedFields": {name: 2.5}})))
+        change = self.relabel("ERROR_STT", updateDescription={
+            "updatedFields": {"custom.total_time_cost": 2.5}})
+        change["fullDocument"]["custom"]["total_time_cost"] = 2.5
+        result = await maintainer.apply_changes([change])
+        self.assertEqual(result["latency"], 1)
+        self.assertFalse(await models.LatencyStats.get_rollups("dev", [self.date]))
+
+    async def test_dimension_update_invalidates_breakdowns(self):
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs})):
+            await stats.breakdown_stats("dev", [self.date], [("language",)])
+        change = self.relabel("ERROR_STT", updateDescription={
+            "updatedFields": {"custom.language": "chinese"}})
+        change["fullDocument"]["custom"]["language"] = "chinese"
+        result = await rollups.RollupMaintainer(mode="change_stream").apply_changes([change])
+        # 标注没有变化，只有维度值变化
+        self.assertEqual((result["daily"], result["breakdown"]), (0, 1))
+        self.assertFalse(await models.BreakdownStats.get_rollups("dev", "language", [self.date]))
+
+    async def test_unrelated_and_older_changes_are_skipped(self):
+        await self.save_rollups(self.docs)
+        maintainer = rollups.RollupMaintainer(mode="change_stream")
+        unrelated = self.relabel("SUCCESS",
+                                 updateDescription={"updatedFields": {"custom.note": ""}})
+        older = self.relabel("SUCCESS", wallTime=datetime.utcnow() - timedelta(hours=1))
+        result = await maintainer.apply_changes([unrelated, older])
+        self.assertEqual(result["daily"], 0)
+        daily, _ = await self.counts()
+        self.assertEqual((daily["SUCCESS"], daily["ERROR_STT"]), (1, 1))
+
+    async def test_batch_spanning_save_invalidates(self):
+        # 第一次修改之后、第二次修改之前保存的统计只包含了第一次修改
+        success = self.relabel("SUCCESS")["fullDocument"]
+        await self.save_rollups([self.docs[0], success])
+        first = self.relabel("SUCCESS", wallTime=datetime.utcnow() - timedelta(hours=1))
+        second = self.relabel("ERROR_INTENT", fullDocumentBeforeChange=success,
+                              wallTime=datetime.utcnow() + timedelta(hours=1))
+        maintainer = rollups.RollupMaintainer(mode="change_stream")
+        result = await maintainer.apply_changes([first, second])
+        self.assertEqual((result["daily"], result["weekly"]), (0, 0))
+        self.assertEqual(await self.counts(), (False, False))
+
+    async def test_drift_invalidates(self):
+        await self.save_rollups(self.docs[:1])
+        maintainer = rollups.RollupMaintainer(mode="change_stream")
+        await maintainer.apply_changes([self.relabel("SUCCESS")])
+        self.assertEqual(await self.counts(), (False, False))
+
+    async def test_missing_pre_image_recomputes(self):
+        await self.save_rollups(self.docs)
+        change = self.relabel("SUCCESS", fullDocumentBeforeChange=None)
+        relabeled = [self.docs[0], change["fullDocument"]]
+        with mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": relabeled})):
+            result = await rollups.RollupMaintainer(mode="change_stream").apply_changes([change])
+        self.assertEqual(result["recomputed"], 2)
+        daily, weekly = await self.counts()
+        self.assertEqual((daily["SUCCESS"], daily["ERROR_STT"]), (2, 0))
+        self.assertEqual((weekly["SUCCESS"], weekly["ERROR_STT"]), (2, 0))
+
+    @override_settings(ROLLUP_WATERMARK_FIELD="updated_at")
+    async def test_poll_fallback(self):
+        await self.save_rollups(self.docs)
+        start = datetime(2025, 1, 1)
+        for i, doc in enumerate(self.docs):
+            doc["updated_at"] = start + timedelta(minutes=i)
+        db = MemoryDatabase({"Data": self.docs})
+        unsupported = OperationFailure("not a replica set", code=40573)
+        with mock.patch.object(mongo_client, "db", db), \
+                mock.patch.object(rollups.RollupMaintainer, "watch", side_effect=unsupported):
+            # 第一次只记录当前的水位线
+            self.assertEqual(await rollups.RollupMaintainer().run(once=True), 0)
+            relabeled = make_doc(date=self.date, intent="SUCCESS")
+            relabeled["_id"], relabeled["updated_at"] = 1, start + timedelta(hours=1)
+            db["Data"].documents[1] = relabeled
+            self.assertEqual(await rollups.RollupMaintainer().run(once=True), 1)
+            self.assertEqual(await rollups.RollupMaintainer().run(once=True), 0)
+        daily, _ = await self.counts()
+        self.assertEqual((daily["SUCCESS"], daily["ERROR_STT"]), (2, 0))
+
+
+class PrecomputeTest(TestCase):
+
+    def setUp(self):
+        stats.stats_cache.clear()
+        self.dates = [(datetime.now() - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(15)]
+        self.docs = [make_doc(date=date, env=env, intent="SUCCESS")
+                     for date in self.dates for env in ("dev", "prod")]
+        patcher = mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_backfill_and_resume(self):
+        progress = mock.Mock()
+        precomputer = precompute.Precomputer(days=10, concurrency=2, progress=progress)
+        computed = await precomputer.backfill()
+        self.assertEqual(computed, {"": 10, "dev": 10, "prod": 10})
+        # 每周的统计需要整周的每天的统计，最早一周在范围之外的日期也会保存
+        first_week = stats.get_week_start_date(self.dates[10])
+        self.assertEqual(await models.DailyStats.objects.filter(env="dev").acount(),
+                         len(stats.get_dates(first_week, self.dates[1])))
+        r = await models.DailyStats.objects.aget(env="", date=self.dates[1])
+        self.assertEqual(r.counts["SUCCESS"], 2)
+        env, done, total, _ = progress.call_args.args
+        self.assertEqual(done, total)
+        # 补齐完成后清除进度
+        self.assertEqual(await models.Checkpoint.get_value(precompute.BACKFILL_CHECKPOINT), {})
+
+        # 停止运行期间缺失的日期，下次补齐时计算
+        await models.DailyStats.objects.filter(date=self.dates[1]).adelete()
+        self.assertEqual(await precomputer.backfill(), {"": 1, "dev": 1, "prod": 1})
+        # 中断后从记录的周继续，更晚的周已经完成，不再查询
+        await models.DailyStats.objects.filter(date=self.dates[1]).adelete()
+        done_until = stats.get_week_start_date(self.dates[10])
+        await models.Checkpoint.set_value(precompute.BACKFILL_CHECKPOINT,
+                                          {"": done_until, "dev": done_until, "prod": done_until})
+        with mock.patch.object(models.DailyStats, "get_rollups", side_effect=AssertionError):
+            self.assertEqual(await precomputer.backfill(), {"": 0, "dev": 0, "prod": 0})
+        self.assertEqual(await models.Checkpoint.get_value(precompute.BACKFILL_CHECKPOINT), {})
+        # 从头开始时只计算失效的统计，和上面跳过的缺失日期
+        await stats.invalidate_rollups("dev", [self.dates[3]])
+        self.assertEqual(await precomputer.backfill(restart=True), {"": 2, "dev": 2, "prod": 1})
+
+    async def test_warm(self):
+        precomputer = precompute.Precomputer(envs=["", "dev"])
+        count = await precomputer.warm()
+        self.assertEqual(count, 2 * (2 + 2 * len(precompute.settings.PRECOMPUTE_WARM_RANGES)))
+        # 计算时保存了统计的结果，按保存前后的版本各缓存一份
+        self.assertGreaterEqual(stats.stats_cache.stats()["size"], count)
+        request = RequestFactory().get("/api/stats/daily_accuracy",
+                                       {"env": "dev", "date": precompute.yesterday()})
+        hits = stats.stats_cache.hits
+        await stats.DailyAccuracyHandler(request)
+        self.assertEqual(stats.stats_cache.hits, hits + 1)
+
+    async def test_rollover(self):
+        timezones = ["UTC", "Asia/Shanghai", "Pacific/Kiritimati"]
+        dates = await precompute.Precomputer(envs=["dev"]).rollover(timezones)
+        self.assertEqual(dates, sorted({precompute.yesterday(tz) for tz in timezones}))
+        # 按各自的时区判断是否结束，比服务器时区更早结束的日期也会保存
+        self.assertEqual(await models.DailyStats.objects.filter(env="dev", date__in=dates).acount(),
+                         len(dates))
+
+    async def test_rollover_recomputes_saved_rollups(self):
+        date = precompute.yesterday("UTC")
+        await stats.daily_stats("dev", [date], tz="UTC")
+        # 结束前已经保存的部分数据
+        await models.DailyStats.objects.filter(env="dev", date=date).aupdate(counts={})
+        await precompute.Precomputer(envs=["dev"]).rollover(["UTC"])
+        r = await models.DailyStats.objects.aget(env="dev", date=date)
+        self.assertEqual(r.counts["SUCCESS"], 1)
+
+    def test_serve_does_not_warm(self):
+        # 结果缓存在进程内，命令进程中预热的缓存不会被 web worker 用到
+        with mock.patch.object(precompute.Precomputer, "backfill", mock.AsyncMock()), \
+                mock.patch.object(precompute.Precomputer, "run", mock.AsyncMock()) as run:
+            call_command("precompute", "--serve", stdout=io.StringIO())
+        run.assert_awaited_once_with(backfill=False, warm=False)
+
+    def test_seconds_until_rollover(self):
+        now = datetime(2025, 1, 1, 23, 0, tzinfo=timezone.utc)
+        self.assertEqual(precompute.seconds_until_rollover(["UTC"], 600, now), 4200)
+        self.assertEqual(precompute.seconds_until_rollover(["Asia/Shanghai"], 600, now),
+                         17 * 3600 + 600)
+        self.assertEqual(precompute.seconds_until_rollover(["Asia/Shanghai", "UTC"], 600, now),
+                         4200)
+        # 零点之后、延迟之前，当天的滚动还没有执行
+        now = datetime(2025, 1, 2, 0, 5, tzinfo=timezone.utc)
+        self.assertEqual(precompute.seconds_until_rollover(["UTC"], 600, now), 300)
+
+    @override_settings(PRECOMPUTE_IN_LIFESPAN=True)
+    async def test_lifespan(self):
+        started = asyncio.Event()
+
+        async def run(self):
+            started.set()
+            await asyncio.Event().wait()
+
+        with mock.patch.object(precompute.Precomputer, "run", run):
+            await precompute.start()
+            await asyncio.wait_for(started.wait(), 1)
+            task = precompute._task
+            await precompute.stop()
+        self.assertTrue(task.cancelled())
+        self.assertIsNone(precompute._task)
+
+
+class BreakdownTest(TestCase):
+
+    def setUp(self):
+        stats.stats_cache.clear()
+        rnd = random.Random(5)
+        self.docs = make_docs()
+        for doc in self.docs:
+            doc["custom"]["provider"] = rnd.choice(["LLMAppEnglishProvider", "LLMCarProvider"])
+            doc["custom"]["output2"] = dict(doc["custom"]["output2"],
+                                            model_version=rnd.choice(["llama0.3.1", "qwen1.0"]))
+        self.dates = stats.get_dates("2025-01-12", "2025-01-17")
+        patcher = mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_dimensions(self):
+        self.assertEqual(stats.parse_dimensions(["model_version,language", "language"]),
+                         [("language", "model_version"), ("language",)])
+        self.assertEqual(len(stats.parse_dimensions([])), len(stats.DIMENSIONS))
+        with self.assertRaises(stats.HttpError):
+            stats.parse_dimensions(["language,gpu"])
+
+    async def test_slices_match_filtered_stats(self):
+        slices = [("language",), ("provider", "model_version")]
+        aggregate = await stats.breakdown_stats("dev", self.dates, slices, "aggregate")
+        stats.stats_cache.clear()
+        await models.BreakdownStats.objects.all().adelete()
+        scan = await stats.breakdown_stats("dev", self.dates, slices, "scan")
+        self.assertEqual(aggregate, scan)
+        expected = stats.docs_stats(
+            await mongo_client.find(range_query("2025-01-12", "2025-01-17", "dev")))
+        for dimension_slice in slices:
+            self.assertEqual(stats.merge_stats(aggregate[dimension_slice].values()), expected)
+        english = [doc for doc in self.docs
+                   if doc["custom"]["env"] == "dev" and doc["custom"]["language"] == "english"
+                   and "2025-01-12" <= doc["custom"]["date"] <= "2025-01-17"]
+        self.assertEqual(aggregate[("language",)][("english",)], stats.docs_stats(english))
+
+    async def test_rollups(self):
+        slices = [("language", "model_version")]
+        first = await stats.breakdown_stats("", self.dates, slices)
+        self.assertEqual(
+            await models.BreakdownStats.objects.filter(dimensions="language,model_version").acount(),
+            len(self.dates))
+        # 已经保存的日期和维度不再查询 MongoDB
+        with mock.patch.object(mongo_client, "aggregate", side_effect=AssertionError):
+            self.assertEqual(await stats.breakdown_stats("", self.dates, slices), first)
+        result = await stats.invalidate_rollups("dev", self.dates[:1])
+        self.assertEqual(result["breakdown"], 1)
+
+    async def test_endpoint(self):
+        params = {"env": "dev", "start_date": "2025-01-12", "end_date": "2025-01-17"}
+        response = await self.async_client.get("/api/stats/breakdown", {
+            **params, "dimensions": ["language", "provider,model_version"]})
+        self.assertEqual(response.status_code, 200)
+        breakdowns = json.loads(response.content)["breakdowns"]
+        self.assertEqual([b["dimensions"] for b in breakdowns],
+                         [["language"], ["provider", "model_version"]])
+        groups = breakdowns[1]["groups"]
+        self.assertEqual(set(groups[0]["values"]), {"provider", "model_version"})
+        labeled = [group["labels"]["labeled"] for group in groups]
+        self.assertEqual(labeled, sorted(labeled, reverse=True))
+        # 不同的维度组合不共用缓存
+        response = await self.async_client.get("/api/stats/breakdown",
+                                               {**params, "dimensions": ["language"]})
+        self.assertEqual(len(json.loads(response.content)["breakdowns"]), 1)
+        response = await self.async_client.get("/api/stats/breakdown",
+                                               {**params, "dimensions": "gpu"})
+        self.assertEqual(response.status_code, 400)
+        for path in ("breakdown", "range_accuracy", "range_daily_accuracy"):
+            with self.subTest(path=path):
+                response = await self.async_client.get(f"/api/stats/{path}",
+                                                       {**params, "start_date": "2025-01"})
+                self.assertEqual(response.status_code, 400)
+
+
+    async def test_cached_result_follows_rollup_version(self):
+        params = {"env": "dev", "start_date": "2025-01-12", "end_date": "2025-01-17",
+                  "dimensions": "language"}
+        first = json.loads((await self.async_client.get("/api/stats/breakdown", params)).content)
+        # 其他进程让统计失效，并且数据已经变化
+        await models.BreakdownStats.invalidate("dev", self.dates)
+        for doc in self.docs:
+            doc["custom"]["language"] = "english"
+        second = json.loads((await self.async_client.get("/api/stats/breakdown", params)).content)
+        self.assertEqual(len(first["breakdowns"][0]["groups"]), 2)
+        self.assertEqual(len(second["breakdowns"][0]["groups"]), 1)
+
+
+class SketchTest(SimpleTestCase):
+
+    def setUp(self):
+        rnd = random.Random(11)
+        self.values = [rnd.lognormvariate(-0.3, 0.8) for _ in range(5000)]
+
+    def exact(self, values, q):
+        values = sorted(values)
+        return values[int(q * (len(values) - 1))]
+
+    def test_relative_error(self):
+        sketch = DDSketch()
+        for value in self.values:
+            sketch.add(value)
+        for q in (0.5, 0.9, 0.99):
+            exact = self.exact(self.values, q)
+            self.assertLessEqual(abs(sketch.quantile(q) - exact) / exact, sketch.alpha)
+        self.assertEqual(sketch.quantile(1), max(self.values))
+        self.assertEqual(sketch.summary()["count"], len(self.values))
+
+    def test_merge_and_serialize(self):
+        left, right, whole = DDSketch(), DDSketch(), DDSketch()
+        for i, value in enumerate(self.values + [0]):
+            (left if i % 2 else right).add(value)
+            whole.add(value)
+        merged = DDSketch.from_dict(json.loads(json.dumps(left.to_dict()))).merge(right)
+        self.assertEqual(merged.summary(), whole.summary())
+        self.assertEqual(merged.quantile(0), 0)
+        self.assertIsNone(DDSketch().quantile(0.5))
+        with self.assertRaises(ValueError):
+            DDSketch(0.02).merge(whole)
+
+
+class LatencyTest(TestCase):
+
+    def setUp(self):
+        stats.stats_cache.clear()
+        self.docs = dataset.make_docs(600, seed=2, start_date="2025-01-06", days=14)
+        patcher = mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dates = stats.get_dates("2025-01-06", "2025-01-19")
+
+    async def test_aggregate_matches_scan(self):
+        aggregate = await latency.query_latency(range_query("2025-01-06", "2025-01-19"))
+        scan = await latency.query_latency(range_query("2025-01-06", "2025-01-19"), "scan")
+        by = ("provider",)
+        self.assertEqual(latency.latency_groups(list(aggregate.values()), by),
+                         latency.latency_groups(list(scan.values()), by))
+        [overall] = latency.latency_groups(list(aggregate.values()), ())
+        self.assertEqual(overall["total"]["count"], len(self.docs))
+        self.assertEqual(overall["detect"]["max"],
+                         max(doc["custom"]["detect_time_cost"] for doc in self.docs))
+
+    async def test_rollups_merge_without_documents(self):
+        first = await latency.latency_stats("prod", self.dates)
+        self.assertEqual(await models.LatencyStats.objects.filter(env="prod").acount(),
+                         len(self.dates))
+        with mock.patch.object(mongo_client, "aggregate", side_effect=AssertionError):
+            second = await latency.latency_stats("prod", self.dates)
+        self.assertEqual(latency.latency_groups(list(first.values()), ("detector",)),
+                         latency.latency_groups(list(second.values()), ("detector",)))
+
+    async def test_endpoint(self):
+        params = {"start_date": "2025-01-06", "end_date": "2025-01-19", "by": "provider"}
+        response = await self.async_client.get("/api/stats/latency",
+                                               {**params, "interval": "week"})
+        self.assertEqual(response.status_code, 200)
+        items = json.loads(response.content)["items"]
+        self.assertEqual([item["week_start_date"] for item in items], ["2025-01-13", "2025-01-06"])
+        group = items[0]["groups"][0]
+        self.assertEqual(set(group), {"provider", "detect", "total"})
+        self.assertLessEqual(group["total"]["p50"], group["total"]["p99"])
+        response = await self.async_client.get("/api/stats/latency", {**params, "by": "gpu"})
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.get("/api/stats/latency",
+                                               {**params, "start_date": "20250106"})
+        self.assertEqual(response.status_code, 400)
+
+
+class IntentErrorsTest(TestCase):
+
+    def setUp(self):
+        stats.stats_cache.clear()
+        self.docs = dataset.make_docs(800, seed=4, start_date="2025-01-06", days=7)
+        patcher = mock.patch.object(mongo_client, "db", MemoryDatabase({"Data": self.docs}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.params = {"start_date": "2025-01-06", "end_date": "2025-01-12"}
+
+    async def get(self, **params):
+        return await self.async_client.get("/api/stats/intent_errors", {**self.params, **params})
+
+    async def test_counts_match_documents(self):
+        response = await self.get(top_k=0)
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        expected = {}
+        for doc in self.docs:
+            intent = stats.receive_intent(doc)
+            if intent and intent != "SUCCESS":
+                counts = expected.setdefault(doc["custom"]["output2"]["intent"], {})
+                counts[intent] = counts.get(intent, 0) + 1
+        self.assertEqual(result["intents"], len(dataset.QUERIES))
+        for item in result["items"]:
+            self.assertEqual({k: v for k, v in item["counts"].items() if v},
+                             expected[item["output_intent"]])
+            self.assertEqual(item["errors"], sum(item["counts"].values()))
+        errors = [item["errors"] for item in result["items"]]
+        self.assertEqual(errors, sorted(errors, reverse=True))
+        # 每天按意图分组的统计已经保存
+        self.assertEqual(
+            await models.BreakdownStats.objects.filter(dimensions="output_intent").acount(), 7)
+
+    async def test_top_k(self):
+        result = json.loads((await self.get(top_k=2)).content)
+        self.assertEqual(len(result["items"]), 2)
+        self.assertEqual(result["intents"], len(dataset.QUERIES))
+        self.assertEqual((await self.get(top_k="x")).status_code, 400)
+        self.assertEqual((await self.get(end_date="2025-01-12x")).status_code, 400)
@@ -2,9 +2,13 @@ from ninja import Redoc
 from ninja import NinjaAPI
 
 from main.utils.router import MyRouter
-from main.handlers import stats
+from main.utils.renderer import FastJSONRenderer
+from main.handlers import stats, export, latency, metrics
 
-main_api = NinjaAPI(title="llm reports api", docs=Redoc(), version="0.1.0")
+main_api = NinjaAPI(title="llm reports api",
+                    docs=Redoc(),
+                    version="0.1.0",
+                    renderer=FastJSONRenderer())
 
 stats_router = MyRouter(tags=["统计"])
 main_api.add_router(prefix="", router=stats_router)
@@ -14,4 +18,15 @@ stats_router.get("/stats/weekly_accuracy", stats.WeeklyAccuracyHandler)
 stats_router.get("/stats/range_accuracy", stats.RangeAccuracyHandler)
 stats_router.get("/stats/range_daily_accuracy",
                  stats.RangeDailyAccuracyHandler)
+stats_router.get("/stats/breakdown", stats.BreakdownHandler)
+stats_router.get("/stats/intent_errors", stats.IntentErrorsHandler)
+stats_router.get("/stats/latency", latency.LatencyHandler)
 stats_router.get("/stats/list_errors", stats.ListErrorsHandler)
+stats_router.post("/stats/rollups/invalidate", stats.InvalidateRollupsHandler)
+stats_router.get("/stats/cache", stats.CacheStatsHandler)
+stats_router.get("/stats/export", export.ExportHandler)
+
+metrics_router = MyRouter(tags=["监控"])
+main_api.add_router(prefix="", router=metrics_router)
+
+metrics_router.get("/metrics", metrics.MetricsHandler, include_in_schema=False)
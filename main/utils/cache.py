@@ -0,0 +1,186 @@
+import time
+import asyncio
+import hashlib
+import functools
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional, Tuple
+
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+
+class ResultCache:
+    """
+    进程内的结果缓存：按 TTL 过期，超过 maxsize 时淘汰最久未使用的结果
+    相同 key 的并发请求只计算一次，其余请求等待同一个结果（single-flight）
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]],
+                             ttl: float) -> Any:
+        """
+        compute 在单独的 task 中运行，所有请求（包括发起计算的请求）都通过 shield 等待它：
+        某个请求被取消（如客户端断开）时只取消它自己的等待，计算继续，结果照常进入缓存
+        """
+        value = self.get(key, self)
+        if value is not self:
+            self.hits += 1
+            return value
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._compute(key, compute, ttl))
+            # 所有等待者都被取消时没有人取结果，避免 "exception was never retrieved"
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]],
+                       ttl: float) -> Any:
+        try:
+            value = await compute()
+        finally:
+            self._inflight.pop(key, None)
+        self.set(key, value, ttl)
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+
+def request_key(request: HttpRequest) -> tuple:
+    """请求路径和 GET 参数，同一个参数指定多次时保留所有的值"""
+    params = sorted((name, tuple(values)) for name, values in request.GET.lists())
+    return request.path, tuple(params)
+
+
+# validator 返回 (max_age, version, complete)：version 为接口依赖的保存的统计的版本，
+# 统计保存、覆盖或失效后变化，None 表示没有版本；complete 为结果是否完全由保存的统计决定，可以生成 ETag
+Validator = Callable[[HttpRequest], Awaitable[Tuple[int, Optional[str], bool]]]
+
+
+async def validate(request: HttpRequest, validator: Validator, refresh: bool = False) -> tuple:
+    """同一个请求中 cached 和 conditional 共用 validator 的结果，refresh 时重新取"""
+    validated = request.__dict__.setdefault("_validated", {})
+    if refresh or validator not in validated:
+        validated[validator] = await validator(request)
+    return validated[validator]
+
+
+def cached(cache: ResultCache, ttl: Callable[[HttpRequest], float],
+           validator: Optional[Validator] = None):
+    """
+    按请求路径和 GET 参数缓存接口的返回值，ttl 根据请求计算
+    有 validator 时统计的版本也是 key 的一部分：统计在任何进程中更新后（如 sync_rollups），
+    各个进程都不会再用旧版本的结果，不需要清空缓存
+    """
+
+    def decorator(handler):
+
+        @functools.wraps(handler)
+        async def wrapper(request: HttpRequest):
+            key = request_key(request)
+            if validator is None:
+                return await cache.get_or_compute(key, lambda: handler(request), ttl(request))
+            _, version, complete = await validate(request, validator)
+
+            async def compute():
+                result = await handler(request)
+                if not complete:
+                    # 计算时保存了缺失的统计，版本随之变化，结果同时按新的版本缓存
+                    _, saved_version, _ = await validate(request, validator, refresh=True)
+                    if saved_version != version:
+                        cache.set((*key, saved_version), result, ttl(request))
+                return result
+
+            return await cache.get_or_compute((*key, version), compute, ttl(request))
+
+        return wrapper
+
+    return decorator
+
+
+def make_etag(request: HttpRequest, version: str) -> str:
+    """强 ETag：相同的路径、参数和统计版本对应相同的响应内容"""
+    path, params = request_key(request)
+    key = f"{path}?{params}#{version}"
+    return f'"{hashlib.sha1(key.encode()).hexdigest()[:32]}"'
+
+
+def conditional(validator: Validator):
+    """
+    HTTP 条件请求：validator 只查询保存的统计，不访问 MongoDB
+    complete 为 False 时没有 ETag（包含当天的数据，或者统计还没有保存），计算完成后会再取一次
+    If-None-Match 命中时直接返回 304，不调用 handler；response 为 Ninja 传入的临时响应，用于设置响应头
+    和 cached 一起使用时传入同一个 validator，结果缓存和 ETag 对应同一个版本
+    """
+
+    def decorator(handler):
+
+        # Ninja 按函数签名（参数注解为 HttpResponse）传入 response，不能沿用 handler 的签名
+        @functools.wraps(handler, assigned=("__module__", "__name__", "__qualname__", "__doc__"))
+        async def wrapper(request: HttpRequest, response: HttpResponse = None):
+            max_age, version, complete = await validate(request, validator)
+            etag = make_etag(request, version) if complete else None
+            cache_control = f"private, max-age={max_age}, must-revalidate"
+            if etag and etag in parse_etags(request.headers.get("If-None-Match", "")):
+                not_modified = HttpResponseNotModified()
+                not_modified["ETag"] = etag
+                not_modified["Cache-Control"] = cache_control
+                return not_modified
+
+            result = await handler(request)
+            if etag is None:
+                _, version, complete = await validate(request, validator, refresh=True)
+                etag = make_etag(request, version) if complete else None
+            if response is not None:
+                if etag:
+                    response["ETag"] = etag
+                response["Cache-Control"] = cache_control
+            return result
+
+        del wrapper.__wrapped__
+        return wrapper
+
+    return decorator
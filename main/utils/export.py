@@ -0,0 +1,164 @@
+"""
+按批写出列式文件：有 pyarrow 时支持 parquet/arrow，否则只能写 csv
+"""
+import io
+import csv
+import time
+import logging
+from typing import AsyncIterator, BinaryIO, List, Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("parquet", "arrow", "csv")
+# 可以边写边发送的格式，parquet 的元数据在文件末尾，先写到临时文件
+STREAM_FORMATS = ("arrow", "csv")
+CONTENT_TYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def resolve_format(format: str) -> str:
+    """没有安装 pyarrow 时 parquet/arrow 退回 csv"""
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if format != "csv" and pa is None:
+        logger.warning(f"pyarrow is not installed, exporting csv instead of {format}")
+        return "csv"
+    return format
+
+
+class CsvWriter:
+
+    def __init__(self, fileobj: BinaryIO, columns: List[tuple]):
+        self.text = io.TextIOWrapper(fileobj, encoding="utf-8", newline="", write_through=True)
+        self.writer = csv.DictWriter(self.text, fieldnames=[name for name, _ in columns])
+        self.writer.writeheader()
+
+    def write_batch(self, rows: List[dict]) -> None:
+        self.writer.writerows(rows)
+
+    def close(self) -> None:
+        self.text.flush()
+        self.text.detach()
+
+
+class ArrowWriter:
+    """columns 为 [(name, "string" | "float"), ...]"""
+
+    def __init__(self, fileobj: BinaryIO, columns: List[tuple], format: str):
+        types = {"string": pa.string(), "float": pa.float64()}
+        self.schema = pa.schema([(name, types[type_]) for name, type_ in columns])
+        if format == "parquet":
+            self.writer = pq.ParquetWriter(fileobj, self.schema, compression="zstd")
+        else:
+            self.writer = pa.ipc.new_stream(fileobj, self.schema)
+
+    def write_batch(self, rows: List[dict]) -> None:
+        self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class ChunkBuffer(io.RawIOBase):
+    """只写的文件对象，写入的数据暂存在内存中，由 drain 取出，用于边写边发送"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def get_writer(format: str, fileobj: BinaryIO, columns: List[tuple]):
+    if format == "csv":
+        return CsvWriter(fileobj, columns)
+    return ArrowWriter(fileobj, columns, format)
+
+
+def throughput(rows: int, start: float) -> dict:
+    seconds = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds) if seconds else 0,
+    }
+
+
+async def write_batches(rows: AsyncIterator[dict], writer, batch_size: int) -> AsyncIterator[int]:
+    """每攒够 batch_size 行写一次，返回每批的行数，写完后关闭 writer；内存中最多保留一批数据"""
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            writer.write_batch(batch)
+            yield len(batch)
+            batch = []
+    if batch:
+        writer.write_batch(batch)
+        yield len(batch)
+    writer.close()
+
+
+async def write_rows(rows: AsyncIterator[dict],
+                     fileobj: BinaryIO,
+                     format: str,
+                     columns: List[tuple],
+                     batch_size: int = 10000) -> dict:
+    """按批写到 fileobj，返回行数和耗时"""
+    start, count = time.perf_counter(), 0
+    async for n in write_batches(rows, get_writer(format, fileobj, columns), batch_size):
+        count += n
+    return throughput(count, start)
+
+
+async def stream_rows(rows: AsyncIterator[dict],
+                      format: str,
+                      columns: List[tuple],
+                      batch_size: int = 10000,
+                      result: Optional[dict] = None) -> AsyncIterator[bytes]:
+    """
+    和 write_rows 一样按批写出，每写完一批就返回这一批的字节，用于 StreamingHttpResponse；
+    只支持可以顺序写出的 csv/arrow（IPC stream），写完后把行数和耗时更新到 result
+    """
+    if format not in STREAM_FORMATS:
+        raise ValueError(f"cannot stream {format}")
+    start, count = time.perf_counter(), 0
+    buffer = ChunkBuffer()
+    writer = get_writer(format, buffer, columns)
+    # 先发出 csv 表头/arrow schema
+    chunk = buffer.drain()
+    if chunk:
+        yield chunk
+    async for n in write_batches(rows, writer, batch_size):
+        count += n
+        chunk = buffer.drain()
+        if chunk:
+            yield chunk
+    chunk = buffer.drain()
+    if chunk:
+        yield chunk
+    if result is not None:
+        result.update(throughput(count, start))
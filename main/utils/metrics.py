@@ -0,0 +1,165 @@
+"""
+进程内的指标：Counter/Gauge/Histogram，按 Prometheus 文本格式导出
+只在事件循环线程中更新，不加锁；每个指标按 label 取值保存一组数字，更新时只有字典查找和加法
+"""
+import bisect
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# 请求耗时（秒）和响应大小（字节）的默认分桶
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple, object] = {}
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """[(name, labels, value)]"""
+        return [(self.name, format_labels(self.labelnames, labels), value)
+                for labels, value in self.values.items()]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {format_value(value)}"
+                     for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value: float, *labels) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """values[labels] 为 [各个桶的计数..., +Inf 桶的计数, sum]，桶的计数不累加，导出时再累加"""
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels) -> None:
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        for labels, counts in self.values.items():
+            total = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                total += count
+                le = f'le="{format_value(bound)}"'
+                samples.append(
+                    (f"{self.name}_bucket", format_labels(self.labelnames, labels, le), total))
+            labels = format_labels(self.labelnames, labels)
+            samples.append((f"{self.name}_sum", labels, counts[-1]))
+            samples.append((f"{self.name}_count", labels, total))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Callable[[], Iterable[Metric]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, collect: Callable[[], Iterable[Metric]]):
+        """导出时才调用 collect 生成指标，用于已经在别处计数的数据（如缓存命中数）"""
+        self.collectors.append(collect)
+        return collect
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            for metric in collect():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.counter("http_requests_total", "HTTP requests", ("route", "method", "status"))
+REQUEST_SECONDS = registry.histogram("http_request_duration_seconds", "HTTP request latency",
+                                     ("route", "method"))
+RESPONSE_BYTES = registry.histogram("http_response_size_bytes",
+                                    "HTTP response body size, streaming responses excluded",
+                                    ("route", "method"),
+                                    buckets=SIZE_BUCKETS)
+IN_FLIGHT = registry.gauge("http_requests_in_flight", "HTTP requests being processed")
+
+
+def cache_collector(name: str, cache) -> Callable[[], List[Metric]]:
+    """把 ResultCache.stats() 导出为指标，cache label 为 name"""
+
+    def collect() -> List[Metric]:
+        stats = cache.stats()
+        metrics = []
+        for key in ("hits", "misses", "coalesced", "evictions"):
+            counter = Counter(f"result_cache_{key}_total", f"Result cache {key}", ("cache",))
+            counter.inc(name, amount=stats[key])
+            metrics.append(counter)
+        for key in ("size", "inflight"):
+            gauge = Gauge(f"result_cache_{key}", f"Result cache {key}", ("cache",))
+            gauge.set(stats[key], name)
+            metrics.append(gauge)
+        return metrics
+
+    return collect
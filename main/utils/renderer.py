@@ -0,0 +1,41 @@
+from typing import Any
+
+from bson import ObjectId
+from pydantic import BaseModel
+from ninja.renderers import JSONRenderer
+from ninja.responses import NinjaJSONEncoder
+from django.http import HttpRequest
+
+from main.utils.timing import span
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+_encoder = NinjaJSONEncoder()
+
+
+def default(obj: Any) -> Any:
+    """orjson 不认识的类型，其余的交给 NinjaJSONEncoder"""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    return _encoder.default(obj)
+
+
+def dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return _encoder.encode(data).encode()
+
+
+class FastJSONRenderer(JSONRenderer):
+    """安装了 orjson 时用 orjson 序列化，否则和 Ninja 默认的 JSONRenderer 一样"""
+
+    def render(self, request: HttpRequest, data: Any, *, response_status: int) -> Any:
+        with span("render"):
+            if orjson is None:
+                return super().render(request, data, response_status=response_status)
+            return dumps(data)
@@ -0,0 +1,106 @@
+"""
+DDSketch：按对数分桶的分位数草图，分位数的相对误差不超过 alpha，两个草图的桶计数相加即可合并
+桶的下标为 ceil(log(x) / log(gamma))，gamma = (1 + alpha) / (1 - alpha)，MongoDB 中可以用 $ln/$ceil 算出同样的下标
+"""
+import math
+from typing import Dict, Iterable, Optional
+
+DEFAULT_ALPHA = 0.01
+# 小于等于这个值的数计入 zero 桶（耗时单位为秒，即 1 微秒）
+MIN_VALUE = 1e-6
+
+
+class DDSketch:
+    __slots__ = ("alpha", "ln_gamma", "bins", "zero", "count", "min", "max", "sum")
+
+    def __init__(self, alpha: float = DEFAULT_ALPHA):
+        self.alpha = alpha
+        self.ln_gamma = math.log((1 + alpha) / (1 - alpha))
+        self.bins: Dict[int, int] = {}
+        self.zero = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+
+    def index(self, value: float) -> Optional[int]:
+        """value 所在的桶，zero 桶为 None"""
+        if value <= MIN_VALUE:
+            return None
+        return math.ceil(math.log(value) / self.ln_gamma)
+
+    def add(self, value: float) -> None:
+        self.add_bin(self.index(value), 1, value, value, value)
+
+    def add_bin(self, index: Optional[int], count: int, min: float, max: float,
+                sum: float) -> None:
+        """直接累加一个桶的计数，用于 MongoDB 中分桶计数的结果"""
+        if index is None:
+            self.zero += count
+        else:
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += count
+        self.min = min if min < self.min else self.min
+        self.max = max if max > self.max else self.max
+        self.sum += sum
+
+    def merge(self, other: "DDSketch") -> "DDSketch":
+        if other.alpha != self.alpha:
+            raise ValueError(f"cannot merge sketches with alpha {self.alpha} and {other.alpha}")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        """q 分位数，没有数据时返回 None；结果限制在 [min, max] 之内"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero:
+            return max(self.min, 0)
+        seen = self.zero
+        gamma = math.exp(self.ln_gamma)
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                # 桶 (gamma^(i-1), gamma^i] 中相对误差最小的值
+                value = 2 * gamma**index / (gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self, quantiles: Iterable[float] = (0.5, 0.9, 0.99)) -> dict:
+        result = {"count": self.count}
+        for q in quantiles:
+            value = self.quantile(q)
+            result[f"p{round(q * 100):d}"] = round(value, 6) if value is not None else None
+        result["max"] = round(self.max, 6) if self.count else None
+        result["mean"] = round(self.sum / self.count, 6) if self.count else None
+        return result
+
+    def to_dict(self) -> dict:
+        """保存到 JSONField，JSON 的 key 只能是字符串"""
+        return {
+            "alpha": self.alpha,
+            "bins": {str(index): count for index, count in self.bins.items()},
+            "zero": self.zero,
+            "count": self.count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "sum": self.sum,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DDSketch":
+        sketch = cls(data["alpha"])
+        sketch.bins = {int(index): count for index, count in data["bins"].items()}
+        sketch.zero = data["zero"]
+        sketch.count = data["count"]
+        if sketch.count:
+            sketch.min, sketch.max = data["min"], data["max"]
+        sketch.sum = data["sum"]
+        return sketch
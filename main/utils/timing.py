@@ -0,0 +1,119 @@
+"""
+按请求统计耗时：MongoDB 命令的次数/耗时/返回文档数/字节数，以及渲染等阶段的耗时
+当前请求的 RequestTiming 保存在 contextvar 中；Motor 在线程池中执行命令时会复制 context，
+pymongo 的 CommandListener 在该线程中被调用，因此能取到发起命令的请求
+"""
+import time
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+import bson
+from django.conf import settings
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTiming:
+    __slots__ = ("queries", "mongo_seconds", "documents", "bytes", "spans")
+
+    def __init__(self):
+        self.queries = 0
+        self.mongo_seconds = 0.0
+        self.documents = 0
+        self.bytes = 0
+        self.spans: Dict[str, float] = {}
+
+    def server_timing(self, total: float) -> str:
+        """Server-Timing 响应头，app 为总耗时减去 MongoDB 和其他阶段的耗时"""
+        app = total - self.mongo_seconds - sum(self.spans.values())
+        entries = [
+            f'mongo;dur={self.mongo_seconds * 1000:.1f};'
+            f'desc="queries={self.queries} docs={self.documents} bytes={self.bytes}"',
+            *(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.spans.items()),
+            f"app;dur={max(app, 0) * 1000:.1f}",
+            f"total;dur={total * 1000:.1f}",
+        ]
+        return ", ".join(entries)
+
+
+current_timing: ContextVar[Optional[RequestTiming]] = ContextVar("current_timing", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """把代码块的耗时计入当前请求的 name 阶段，不在请求中时什么也不做"""
+    timing = current_timing.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.spans[name] = timing.spans.get(name, 0) + time.perf_counter() - start
+
+
+def query_shape(value):
+    """把查询中的值替换为 "?"，只保留字段名和操作符，用于日志"""
+    if isinstance(value, dict):
+        return {key: query_shape(v) for key, v in value.items()}
+    if isinstance(value, list):
+        if value and all(isinstance(v, dict) for v in value):
+            return [query_shape(v) for v in value]
+        return "?"
+    return "?"
+
+
+def command_shape(command: dict) -> dict:
+    """命令名、集合和查询形状"""
+    name = next(iter(command), "")
+    shape = {name: command.get(name)}
+    for key in ("filter", "sort", "pipeline", "projection"):
+        if key in command:
+            shape[key] = query_shape(command[key])
+    return shape
+
+
+def reply_documents(reply: dict) -> int:
+    cursor = reply.get("cursor")
+    if not isinstance(cursor, dict):
+        return 0
+    return len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+
+
+class CommandTimer(monitoring.CommandListener):
+    """记录每个命令的耗时和返回的数据量，超过 MONGO_SLOW_QUERY_MS 的命令记录慢查询日志"""
+
+    def __init__(self):
+        # request_id -> 命令形状，只在慢查询日志中使用
+        self.commands: Dict[int, dict] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        self.commands[event.request_id] = command_shape(event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        shape = self.commands.pop(event.request_id, None)
+        seconds = event.duration_micros / 1_000_000
+        documents = reply_documents(event.reply)
+        timing = current_timing.get()
+        if timing is not None:
+            timing.queries += 1
+            timing.mongo_seconds += seconds
+            timing.documents += documents
+            if settings.MONGO_MONITOR_BYTES:
+                timing.bytes += len(bson.encode(event.reply))
+        if seconds * 1000 >= settings.MONGO_SLOW_QUERY_MS:
+            logger.warning(f"Slow query: {event.command_name} | "
+                           f"Duration: {seconds:.3f}s | "
+                           f"Documents: {documents} | "
+                           f"Shape: {shape}")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self.commands.pop(event.request_id, None)
+        timing = current_timing.get()
+        if timing is not None:
+            timing.queries += 1
+            timing.mongo_seconds += event.duration_micros / 1_000_000